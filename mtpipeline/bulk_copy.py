@@ -0,0 +1,217 @@
+"""Concurrent copies of archive files into a working tree.
+
+`bulk_copy` copies a list of files into a destination directory on a
+thread pool, the copies being I/O bound. A file is only copied when
+the destination is missing or out of date:
+
+    1. A destination the copy manifest says was made from the source
+       as it is now (same size and modification time) is kept. Every
+       copy is made under a temporary name and renamed into place, so
+       such a destination is complete even if the pipeline edited its
+       headers since.
+    2. Otherwise a destination with the size and modification time of
+       the source is kept, as is one with the same size and md5
+       checksum when checksums are enabled. Anything else, e.g. a
+       truncated copy or a copy of an older version, is copied again.
+
+The copy manifest, `copy_manifest.json` in the destination directory,
+records the source, size, modification time, and action of every file.
+With the `copy_hardlinks` setting files on the same file system as the
+destination are hard linked instead of copied. A hard link shares the
+file with the archive, so edits like updatewcs reach the archive copy
+too; leave it off unless the archive is read only to the pipeline.
+"""
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from multiprocessing.pool import ThreadPool
+
+from mtpipeline.get_settings import SETTINGS
+
+MANIFEST_NAME = 'copy_manifest.json'
+
+# The size of the blocks read for the checksums.
+CHUNK_SIZE = 1024 * 1024
+
+# -----------------------------------------------------------------------------
+# Functions (alphabetical)
+# -----------------------------------------------------------------------------
+
+def bulk_copy(file_list, dst_root, threads=None, checksum_switch=True,
+              recopy_switch=False, hardlink_switch=None):
+    """Copy files into a directory, skipping the ones that are current.
+
+    Parameters:
+        file_list : list
+            The paths to the source files.
+        dst_root : string
+            The destination directory, created if needed.
+        threads : int
+            The number of concurrent copies. Defaults to the
+            `copy_threads` setting, or 4.
+        checksum_switch : bool
+            Compare the md5 checksums of sources and destinations with
+            the same size but different modification times.
+        recopy_switch : bool
+            Copy every file, even if it is current.
+        hardlink_switch : bool
+            Hard link files on the same file system. Defaults to the
+            `copy_hardlinks` setting.
+
+    Returns:
+        records : list
+            One dictionary per file, see copy_file.
+
+    Outputs:
+        The copied files and the copy manifest in dst_root.
+    """
+    if threads is None:
+        threads = SETTINGS.get('copy_threads') or 4
+    if hardlink_switch is None:
+        hardlink_switch = bool(SETTINGS.get('copy_hardlinks'))
+    if not os.path.isdir(dst_root):
+        os.makedirs(dst_root)
+    manifest_name = os.path.join(dst_root, MANIFEST_NAME)
+    manifest = read_manifest(manifest_name)
+
+    jobs = []
+    for src in file_list:
+        dst = os.path.join(dst_root, os.path.basename(src))
+        jobs.append((src, dst, manifest.get(os.path.basename(src)),
+                     checksum_switch, recopy_switch, hardlink_switch))
+    pool = ThreadPool(processes=threads)
+    try:
+        records = pool.map(copy_file, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    for record in records:
+        manifest[os.path.basename(record['dst'])] = record
+    write_manifest(manifest_name, manifest)
+    return records
+
+# -----------------------------------------------------------------------------
+
+def copy_file(job):
+    """Pool worker, copy or link one file if its destination is stale.
+
+    Parameters:
+        job : tuple
+            The source, the destination, the manifest record of the
+            destination or None, and the checksum, recopy, and hardlink
+            switches of bulk_copy.
+
+    Returns:
+        record : dict
+            Has keys 'src', 'dst', 'size', 'mtime' (of the source), and
+            'action', one of 'skipped', 'copied', or 'linked'.
+
+    Outputs:
+        The copied file.
+    """
+    src, dst, previous, checksum_switch, recopy_switch, hardlink_switch = job
+    stat = os.stat(src)
+    record = {'src' : os.path.abspath(src), 'dst' : os.path.abspath(dst),
+              'size' : stat.st_size, 'mtime' : stat.st_mtime}
+    if not recopy_switch and is_current(src, dst, stat, previous,
+                                        checksum_switch):
+        record['action'] = 'skipped'
+        return record
+
+    dst_root = os.path.dirname(os.path.abspath(dst))
+    tmp = tempfile.NamedTemporaryFile(prefix='.' + os.path.basename(dst) + '_',
+                                      dir=dst_root, delete=False)
+    tmp.close()
+    try:
+        record['action'] = 'copied'
+        if hardlink_switch and os.stat(dst_root).st_dev == stat.st_dev:
+            os.remove(tmp.name)
+            try:
+                os.link(src, tmp.name)
+                record['action'] = 'linked'
+            except OSError as err:
+                if err.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK]:
+                    raise
+        if record['action'] == 'copied':
+            print 'Copying: ' + src + ' -> ' + dst
+            shutil.copy2(src, tmp.name)
+        os.rename(tmp.name, dst)
+    except:
+        if os.path.exists(tmp.name):
+            os.remove(tmp.name)
+        raise
+    return record
+
+# -----------------------------------------------------------------------------
+
+def get_md5(filename):
+    """Return the md5 checksum of a whole file."""
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+# -----------------------------------------------------------------------------
+
+def is_current(src, dst, stat, previous, checksum_switch):
+    """Check if a destination is a complete copy of the source.
+
+    Parameters:
+        src : string
+            The source file.
+        dst : string
+            The destination file.
+        stat : os.stat_result
+            The stat of the source.
+        previous : dict
+            The manifest record of the destination, or None.
+        checksum_switch : bool
+            Compare checksums when the modification times differ.
+
+    Returns:
+        current : bool
+            True if the destination doesn't need to be copied again.
+
+    Outputs:
+        nothing
+    """
+    if not os.path.exists(dst):
+        return False
+    if previous is not None and previous['src'] == os.path.abspath(src) and \
+            previous['size'] == stat.st_size and \
+            previous['mtime'] == stat.st_mtime:
+        return True
+    dst_stat = os.stat(dst)
+    if dst_stat.st_size != stat.st_size:
+        return False
+    if dst_stat.st_mtime == stat.st_mtime:
+        return True
+    return checksum_switch and get_md5(src) == get_md5(dst)
+
+# -----------------------------------------------------------------------------
+
+def read_manifest(manifest_name):
+    """Return the copy manifest, or an empty one if there is none."""
+    if not os.path.exists(manifest_name):
+        return {}
+    with open(manifest_name, 'r') as f:
+        return json.load(f)
+
+# -----------------------------------------------------------------------------
+
+def write_manifest(manifest_name, manifest):
+    """Write the copy manifest under a temporary name and rename it.
+    The temporary name has the process id, so runs into the same folder
+    don't write over each other's temporary files.
+    """
+    tmp = '{0}.{1}.tmp'.format(manifest_name, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.rename(tmp, manifest_name)
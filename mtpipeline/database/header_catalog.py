@@ -0,0 +1,327 @@
+#! /usr/bin/env python
+
+"""A persistent catalog of FITS headers shared by all pipeline stages.
+
+The imaging pipeline and the ephem scripts read the same primary
+headers over and over. This module keeps the header cards of every
+file it has seen in a local SQLite database keyed by the file path
+and HDU number. Each record also stores the size and modification time
+of the file, so an edited file is transparently read again.
+
+The catalog location is set with the `header_catalog` setting. When
+the setting is empty the headers are read straight from the FITS
+files. The catalog should live on a local disk, SQLite locking is not
+reliable over NFS.
+
+Use:
+    The catalog can be filled in one parallel scan before a run:
+
+    >>> python header_catalog.py -filelist '/path/to/files/*.fits'
+"""
+
+import argparse
+import glob
+import json
+import logging
+import multiprocessing as mp
+import os
+import sqlite3
+
+from mtpipeline.fits_reader import HeaderCards
+from mtpipeline.fits_reader import read_cards
+from mtpipeline.get_settings import SETTINGS
+
+# Catalog instances, keyed by path and process id because SQLite
+# connections can't be shared across a fork.
+_CATALOGS = {}
+
+# -----------------------------------------------------------------------------
+# Functions (alphabetical)
+# -----------------------------------------------------------------------------
+
+def get_catalog(path=None):
+    """Return the HeaderCatalog for this process.
+
+    Parameters:
+        path : string
+            The path to the SQLite database. Defaults to the
+            `header_catalog` setting.
+
+    Returns:
+        catalog : HeaderCatalog or None
+            None if no catalog is configured.
+
+    Outputs:
+        nothing
+    """
+    if path is None:
+        path = SETTINGS.get('header_catalog')
+    if not path:
+        return None
+    key = (path, os.getpid())
+    if key not in _CATALOGS:
+        _CATALOGS[key] = HeaderCatalog(path)
+    return _CATALOGS[key]
+
+# -----------------------------------------------------------------------------
+
+def get_header(filename, ext=0, keywords=None):
+    """Return the header cards of a FITS file HDU.
+
+    The cards come from the header catalog when one is configured and
+    are read from the file otherwise.
+
+    Parameters:
+        filename : string
+            The path to a FITS file.
+        ext : int
+            The HDU number.
+        keywords : list
+            The keywords the caller needs. Without a catalog only these
+            cards are read and the read stops once all were found. The
+            catalog always holds the full header so they are ignored
+            there. None returns every card.
+
+    Returns:
+        header : HeaderCards
+            The header keyword values.
+
+    Outputs:
+        nothing
+    """
+    catalog = get_catalog()
+    if catalog is None:
+        return read_cards(filename, keywords, ext)
+    return catalog.get_header(filename, ext)
+
+# -----------------------------------------------------------------------------
+
+def read_header(filename, ext=0):
+    """Read the header cards of a FITS file HDU from disk.
+
+    Commentary cards and cards without a value are skipped, see
+    mtpipeline.fits_reader.
+
+    Parameters:
+        filename : string
+            The path to a FITS file.
+        ext : int
+            The HDU number.
+
+    Returns:
+        header : HeaderCards
+            The header keyword values.
+
+    Outputs:
+        nothing
+    """
+    return read_cards(filename, ext=ext)
+
+# -----------------------------------------------------------------------------
+
+def read_header_record(args):
+    """Pool worker for HeaderCatalog.scan.
+
+    Parameters:
+        args : tuple
+            The file path and HDU number.
+
+    Returns:
+        record : tuple or None
+            The path, HDU number, modification time, size and header
+            cards of the file, or None if the file can't be read.
+
+    Outputs:
+        nothing
+    """
+    filename, ext = args
+    try:
+        stat = os.stat(filename)
+        header = read_header(filename, ext)
+    except Exception as err:
+        logging.warning('Failed reading header of {0}: {1}'.format(
+            filename, err))
+        return None
+    return filename, ext, stat.st_mtime, stat.st_size, header
+
+# -----------------------------------------------------------------------------
+
+def record_header(filename, header, ext=0):
+    """Add a header the caller has in memory to the catalog.
+
+    A stage that just wrote a FITS file calls this so the later stages
+    find its header in the catalog without reading the file. Does
+    nothing when no catalog is configured.
+
+    Parameters:
+        filename : string
+            The path to the FITS file, which must not change afterwards.
+        header : HeaderCards
+            The header cards of the HDU, e.g. from
+            mtpipeline.fits_reader.cards_from_header.
+        ext : int
+            The HDU number.
+
+    Returns:
+        nothing
+
+    Outputs:
+        The catalog record.
+    """
+    catalog = get_catalog()
+    if catalog is None:
+        return
+    stat = os.stat(filename)
+    catalog.insert([(filename, ext, stat.st_mtime, stat.st_size, header)])
+
+# -----------------------------------------------------------------------------
+# Main Class
+# -----------------------------------------------------------------------------
+
+class HeaderCatalog(object):
+    """A SQLite backed catalog of FITS header cards."""
+    def __init__(self, path):
+        """Open the catalog, creating the table if needed.
+
+        Parameters:
+            path : string
+                The path to the SQLite database.
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS headers ('
+            'path TEXT NOT NULL, '
+            'ext INTEGER NOT NULL, '
+            'mtime REAL NOT NULL, '
+            'size INTEGER NOT NULL, '
+            'cards TEXT NOT NULL, '
+            'PRIMARY KEY (path, ext))')
+        self.connection.commit()
+
+    def get_header(self, filename, ext=0):
+        """Return the header cards, reading the file on a catalog miss.
+
+        Parameters:
+            filename : string
+                The path to a FITS file.
+            ext : int
+                The HDU number.
+
+        Returns:
+            header : HeaderCards
+                The header keyword values.
+        """
+        header = self.lookup(filename, ext)
+        if header is None:
+            filename = os.path.abspath(filename)
+            stat = os.stat(filename)
+            header = read_header(filename, ext)
+            self.insert([(filename, ext, stat.st_mtime, stat.st_size, header)])
+        return header
+
+    def insert(self, records):
+        """Insert or replace header records.
+
+        Parameters:
+            records : list
+                Tuples of path, HDU number, modification time, size, and
+                header cards.
+        """
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?)',
+            [(os.path.abspath(filename), ext, mtime, size, json.dumps(header))
+             for filename, ext, mtime, size, header in records])
+        self.connection.commit()
+
+    def lookup(self, filename, ext=0):
+        """Return the catalog header cards if they are still current.
+
+        Parameters:
+            filename : string
+                The path to a FITS file.
+            ext : int
+                The HDU number.
+
+        Returns:
+            header : HeaderCards or None
+                None if the file is not in the catalog or changed
+                since it was catalogued.
+        """
+        filename = os.path.abspath(filename)
+        stat = os.stat(filename)
+        row = self.connection.execute(
+            'SELECT mtime, size, cards FROM headers WHERE path = ? AND ext = ?',
+            (filename, ext)).fetchone()
+        if row is None or row[0] != stat.st_mtime or row[1] != stat.st_size:
+            return None
+        # FITS headers are ASCII, convert the strings json returns as
+        # unicode back to str.
+        return HeaderCards((keyword, value.encode('ascii')
+                            if isinstance(value, unicode) else value)
+                           for keyword, value in json.loads(row[2]).items())
+
+    def scan(self, file_list, ext=0, processes=None):
+        """Catalog every file in file_list that is missing or stale.
+
+        Parameters:
+            file_list : list
+                Paths to FITS files.
+            ext : int
+                The HDU number.
+            processes : int
+                The number of processes reading headers. Defaults to
+                the `num_cores` setting.
+
+        Returns:
+            count : int
+                The number of headers read from disk.
+        """
+        if processes is None:
+            processes = SETTINGS['num_cores']
+        todo = [(os.path.abspath(filename), ext) for filename in file_list
+                if self.lookup(filename, ext) is None]
+        if todo == []:
+            return 0
+        pool = mp.Pool(processes=processes)
+        try:
+            records = pool.map(read_header_record, todo)
+        finally:
+            pool.close()
+            pool.join()
+        records = [record for record in records if record is not None]
+        self.insert(records)
+        return len(records)
+
+# -----------------------------------------------------------------------------
+# For command line execution.
+# -----------------------------------------------------------------------------
+
+def parse_args():
+    '''
+    Parse the command line arguments.
+    '''
+    parser = argparse.ArgumentParser(
+        description = 'Add FITS headers to the header catalog.')
+    parser.add_argument(
+        '-filelist',
+        required = True,
+        help = 'Search string for FITS files. Wildcards accepted.')
+    parser.add_argument(
+        '-ext',
+        required = False,
+        type = int,
+        default = 0,
+        help = 'The HDU to catalog. Default is 0.')
+    args = parser.parse_args()
+    return args
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    args = parse_args()
+    catalog = get_catalog()
+    assert catalog is not None, 'The header_catalog setting is empty.'
+    file_list = glob.glob(args.filelist)
+    print 'Read {} headers.'.format(catalog.scan(file_list, args.ext))
@@ -9,9 +9,9 @@ import coords
 import glob
 import logging
 import os
-import pyfits
 
 from mt_logging import setup_logging
+from mtpipeline.database.header_catalog import get_header
 from socket import gethostname
 
 #----------------------------------------------------------------------------
@@ -27,6 +27,10 @@ from sqlalchemy import or_
 from sqlalchemy.orm import subqueryload
 from sqlalchemy.orm import subqueryload_all
 
+# The header keywords read by get_header_info.
+HEADER_KEYWORDS = ['TARGNAME', 'RA_TARG', 'DEC_TARG', 'CRVAL1', 'CRVAL2',
+                   'CRPIX1', 'CRPIX2']
+
 #----------------------------------------------------------------------------
 # Low-Level Functions
 #----------------------------------------------------------------------------
@@ -101,7 +105,7 @@ def get_header_info(filename):
     '''
     assert os.path.splitext(filename)[1] == '.fits', \
         'Expected .fits got ' + filename
-    header = pyfits.getheader(filename)
+    header = get_header(filename, keywords=HEADER_KEYWORDS)
     output = {}
     output['targname'] = header['targname'].lower().split('-')[0]
     output['ra_targ']  = header['ra_targ']
@@ -9,13 +9,18 @@ import glob
 import logging
 import os
 
-from astropy.io import fits
 from mtpipeline.database.database_interface import MasterImages
 from mtpipeline.database.database_interface import session
+from mtpipeline.database.header_catalog import get_catalog
+from mtpipeline.database.header_catalog import get_header
 from mtpipeline.setup_logging import setup_logging
 from sqlalchemy import distinct
 from sqlalchemy.sql import func
 
+# The header keywords used by the MasterImages constructor.
+HEADER_KEYWORDS = ['PROPOSID', 'TARGNAME', 'NAXIS1', 'NAXIS2', 'RA_TARG',
+                   'DEC_TARG', 'FILTNAM1', 'LINENUM']
+
 #----------------------------------------------------------------------------
 # The main controller.
 #----------------------------------------------------------------------------
@@ -66,12 +71,18 @@ def build_master_images_table_main(png_file_list, reproc, reproc_sets):
     if max_set_id == None:
         max_set_id = 0
             
+    # Read all the headers in one parallel scan.
+    fits_file_list = [png_file.replace('png/','').replace('_linear.png','.fits')
+                      for png_file in png_file_list]
+    catalog = get_catalog()
+    if catalog is not None:
+        logging.info('Scanning headers')
+        catalog.scan(fits_file_list)
+
     # Build the new records     
-    for png_file in png_file_list:
+    for png_file, fits_file in zip(png_file_list, fits_file_list):
         logging.info('Processing {}'.format(png_file))
-        fits_file = png_file.replace('png/','').replace('_linear.png','.fits')
-        with fits.open(fits_file) as hdulist:
-            header = hdulist[0].header
+        header = get_header(fits_file, keywords=HEADER_KEYWORDS)
         master_images = MasterImages(header, fits_file, png_file)
         existing_set_dict, max_set_id = master_images.set_set_values(existing_set_dict, max_set_id)
         session.add(master_images)
@@ -9,21 +9,24 @@ import argparse
 import glob
 import os
 import string
+import sys
 
-from .database.database_interface import counter
-from .database.database_interface import check_type
-from .database.database_interface import insert_record
-from .database.database_interface import update_record
+from mtpipeline.database.database_tools import counter
+from mtpipeline.database.database_tools import check_type
+from mtpipeline.database.database_tools import insert_record
+from mtpipeline.database.database_tools import update_record
 
 from PIL import Image
 
+from mtpipeline.imaging.tile_pyramid import read_manifest
+
 #----------------------------------------------------------------------------
 # Load all the SQLAlchemy ORM bindings
 #----------------------------------------------------------------------------
 
-from .database.database_interface import MasterImages
-from .database.database_interface import SubImages
-from .database.database_interface import session
+from mtpipeline.database.database_interface import MasterImages
+from mtpipeline.database.database_interface import SubImages
+from mtpipeline.database.database_interface import session
 
 #----------------------------------------------------------------------------
 # Low-Level Functions
@@ -120,6 +123,69 @@ def build_sub_images_table_main(filename, reproc):
             raise Exception('Something Unexpected happed in line 103') 
 
 
+def build_tile_records_main(manifest_name, reproc):
+    """Insert or update the sub_images records of a tile pyramid.
+
+    Every tile in the manifest written by the png stage, see
+    mtpipeline.imaging.tile_pyramid, becomes a record with its
+    scale_level and its x, y, width and height in the pixels of its
+    level. The master image is the one made from the same FITS file.
+    """
+    manifest = read_manifest(manifest_name)
+    master_images_query = session.query(MasterImages).\
+        filter(MasterImages.fits_file == manifest['fits_file']).one()
+    existing = set(name for name, in session.query(SubImages.name).\
+        filter(SubImages.master_images_id == master_images_query.id))
+    for tile in manifest['tiles']:
+        name = str(tile['name'])
+        if name in existing and reproc == False:
+            continue
+        record_dict = {}
+        record_dict['master_images_id'] = master_images_query.id
+        record_dict['master_images_name'] = master_images_query.name
+        record_dict['name'] = name
+        record_dict['file_location'] = str(manifest['tile_location'])
+        record_dict['image_width'] = tile['width']
+        record_dict['image_height'] = tile['height']
+        record_dict['x'] = tile['x']
+        record_dict['y'] = tile['y']
+        record_dict['width'] = tile['width']
+        record_dict['height'] = tile['height']
+        record_dict['scale_level'] = tile['scale_level']
+        if name in existing:
+            session.query(SubImages).filter(\
+                SubImages.name == name).update(record_dict)
+        else:
+            record = SubImages()
+            insert_record(record_dict, record)
+
+
+def update_thumbnail_locations_main(thumbnail_list, batch_size=500):
+    """Set the thumbnail_location of the records with thumbnails.
+
+    The thumbnails written by the png stage, see
+    mtpipeline.imaging.run_trim.make_thumbnail_name, have the name of
+    their PNG with another extension, in a thumbnails folder. The
+    thumbnail_location of a record is that folder. All the records of a
+    folder are updated with one UPDATE per batch_size names.
+    """
+    folder_dict = {}
+    for thumbnail in thumbnail_list:
+        folder = os.path.dirname(os.path.abspath(thumbnail))
+        name = os.path.splitext(os.path.basename(thumbnail))[0] + '.png'
+        folder_dict.setdefault(folder, []).append(name)
+    count = 0
+    for folder in sorted(folder_dict):
+        names = sorted(folder_dict[folder])
+        for start in range(0, len(names), batch_size):
+            count += session.query(SubImages).\
+                filter(SubImages.name.in_(names[start:start + batch_size])).\
+                update({'thumbnail_location' : folder},
+                       synchronize_session=False)
+    session.commit()
+    return count
+
+
 #----------------------------------------------------------------------------
 # For Command Line Execution
 #----------------------------------------------------------------------------
@@ -142,6 +208,21 @@ def parse_args():
         default = False,
         dest = 'reproc',
         help = 'Overwrite existing entries.')
+    parser.add_argument(
+        '-tiles',
+        required = False,
+        action = 'store_true',
+        default = False,
+        dest = 'tiles',
+        help = 'The files are tile manifests (*_tiles.json) of the png stage.')
+    parser.add_argument(
+        '-thumbnails',
+        required = False,
+        action = 'store_true',
+        default = False,
+        dest = 'thumbnails',
+        help = 'The files are thumbnails of the png stage. Sets the '
+               'thumbnail_location of their records.')
     args = parser.parse_args()
     return args
 
@@ -150,6 +231,17 @@ if __name__ == '__main__':
     args = parse_args()
     filelist = glob.glob(args.filelist)
     print 'Selected ' + str(len(filelist)) + ' files from input.'
+    if args.thumbnails:
+        print 'Updated {} records.'.format(
+            update_thumbnail_locations_main(filelist))
+        session.close()
+        sys.exit()
+    if args.tiles:
+        for manifest_name in filelist:
+            build_tile_records_main(manifest_name, args.reproc)
+            session.commit()
+        session.close()
+        sys.exit()
     filelist = [filename for filename in filelist if \
                 os.path.basename(filename).split('_')[-1] \
                 not in ['ephem.png', 'lb.png']]
@@ -11,7 +11,6 @@ import matplotlib.cbook as cbook
 import matplotlib.cm as cm
 import matplotlib.patches as mpatches 
 import os
-import pyfits
 
 
 from PIL import Image
@@ -23,6 +22,7 @@ from PIL import Image
 from mtpipeline.database.database_interface import MasterImages
 from mtpipeline.database.database_interface import MasterFinders
 from mtpipeline.database.database_interface import session
+from mtpipeline.database.header_catalog import get_header
 
 #----------------------------------------------------------------------------
 # 
@@ -49,8 +49,9 @@ class EphemPlot(object):
         png_path = os.path.split(self.filename)[0]
         png_path = os.path.split(png_path)[0]
         fitsfile = os.path.join(png_path, fitsfile)
-        self.crpix1 = pyfits.getval(fitsfile, 'CRPIX1', 0)
-        self.crpix2 = pyfits.getval(fitsfile, 'CRPIX2', 0)
+        header = get_header(fitsfile, keywords=['CRPIX1', 'CRPIX2'])
+        self.crpix1 = header['CRPIX1']
+        self.crpix2 = header['CRPIX2']
 
     def getEphem(self):
         '''
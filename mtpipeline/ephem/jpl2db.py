@@ -14,7 +14,6 @@ import coords
 import datetime
 import glob
 import os
-import pyfits
 import telnetlib
 import time
 import logging
@@ -30,6 +29,7 @@ from database_interface import counter
 from database_interface import check_type
 
 from mt_logging import setup_logging
+from mtpipeline.database.header_catalog import get_header
 
 from urllib2 import urlopen
 
@@ -44,6 +44,9 @@ from database_interface import session
 
 LOGFOLDER = "/astro/3/mutchler/mt/logs/jpl2db"
 
+# The header keywords read by get_header_info.
+HEADER_KEYWORDS = ['TARGNAME', 'DATE-OBS', 'TIME-OBS']
+
 #----------------------------------------------------------------------------
 # Low-Level Functions
 #----------------------------------------------------------------------------
@@ -90,10 +93,11 @@ def get_header_info(filename):
     '''
     assert os.path.splitext(filename)[1] == '.fits', \
         'Expected .fits got ' + filename
+    header = get_header(filename, keywords=HEADER_KEYWORDS)
     output = {}
-    output['targname'] = pyfits.getval(filename, 'targname').lower().split('-')[0]
-    output['date_obs'] = pyfits.getval(filename, 'date-obs')
-    output['time_obs'] = pyfits.getval(filename, 'time-obs')
+    output['targname'] = header['targname'].lower().split('-')[0]
+    output['date_obs'] = header['date-obs']
+    output['time_obs'] = header['time-obs']
     planet_list = ['mars', 'jupiter', 'saturn', 'uranus', 'neptune', 'pluto']
     assert output['targname'] in planet_list, \
         'Header TARGNAME not in planet_list'
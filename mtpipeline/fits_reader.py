@@ -0,0 +1,259 @@
+"""A lightweight, header-only FITS keyword reader.
+
+Opening a file with `astropy.io.fits.open` or `pyfits.getval` builds a
+full HDU list and parses every card into Card objects just to read a
+few keywords. The functions in this module instead read the raw
+2880-byte header blocks of one HDU, parse only the 80-character cards
+that are needed, and stop reading as soon as every requested keyword
+was found. Data units of earlier HDUs are skipped with a seek.
+
+Only fixed format keyword = value cards are parsed. Commentary cards,
+HIERARCH cards, CONTINUE long strings, and cards without a value are
+skipped. String values keep leading spaces and lose trailing spaces,
+the same as in astropy.
+"""
+
+import os
+
+from multiprocessing.pool import ThreadPool
+
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+
+# -----------------------------------------------------------------------------
+# Header Container
+# -----------------------------------------------------------------------------
+
+class HeaderCards(dict):
+    """A dictionary of header cards with case-insensitive keywords.
+
+    This mimics the keyword access of an astropy Header so existing
+    code like `header['targname']` keeps working.
+    """
+    def __init__(self, cards=()):
+        """Store the keywords in upper case."""
+        dict.__init__(self)
+        if isinstance(cards, dict):
+            cards = cards.items()
+        for keyword, value in cards:
+            self[keyword] = value
+
+    def __contains__(self, keyword):
+        return dict.__contains__(self, keyword.upper())
+
+    def __getitem__(self, keyword):
+        return dict.__getitem__(self, keyword.upper())
+
+    def __setitem__(self, keyword, value):
+        dict.__setitem__(self, keyword.upper(), value)
+
+    def get(self, keyword, default=None):
+        return dict.get(self, keyword.upper(), default)
+
+# -----------------------------------------------------------------------------
+# Functions (alphabetical)
+# -----------------------------------------------------------------------------
+
+def cards_from_header(header):
+    """Return the cards of an astropy Header that read_cards would read.
+
+    For code that already has a header in memory, e.g. after writing a
+    file, and wants the same cards without reading the file again.
+
+    Parameters:
+        header : astropy.io.fits.Header
+            The header.
+
+    Returns:
+        cards : HeaderCards
+            The keyword = value cards, without commentary, HIERARCH,
+            and undefined cards.
+
+    Outputs:
+        nothing
+    """
+    cards = HeaderCards()
+    for card in header.cards:
+        value = card.value
+        if card.keyword in ['', 'COMMENT', 'HISTORY'] or \
+                len(card.keyword) > 8 or \
+                not isinstance(value, (str, unicode, bool, int, long, float)):
+            continue
+        if isinstance(value, unicode):
+            value = value.encode('ascii')
+        cards[card.keyword] = value.rstrip() if isinstance(value, str) \
+            else value
+    return cards
+
+# -----------------------------------------------------------------------------
+
+def get_data_size(header):
+    """Return the size in bytes of the data unit described by a header.
+
+    The size includes the padding to a whole number of 2880-byte
+    blocks.
+
+    Parameters:
+        header : HeaderCards
+            The header cards of the HDU, at least BITPIX, NAXIS, and
+            NAXISn.
+
+    Returns:
+        size : int
+            The padded size of the data unit.
+
+    Outputs:
+        nothing
+    """
+    naxis = header['NAXIS']
+    if naxis == 0:
+        return 0
+    axes = [header['NAXIS{}'.format(i)] for i in range(1, naxis + 1)]
+    # Random groups files have NAXIS1 = 0.
+    if header.get('GROUPS') is True and axes[0] == 0:
+        axes = axes[1:]
+    count = 1
+    for axis in axes:
+        count *= axis
+    size = abs(header['BITPIX']) // 8 * header.get('GCOUNT', 1) * \
+        (header.get('PCOUNT', 0) + count)
+    return ((size + BLOCK_SIZE - 1) // BLOCK_SIZE) * BLOCK_SIZE
+
+# -----------------------------------------------------------------------------
+
+def parse_card(card):
+    """Parse a single 80-character header card.
+
+    Parameters:
+        card : string
+            The raw card.
+
+    Returns:
+        keyword_value : tuple or None
+            The upper case keyword and the value as a str, int, float,
+            or bool. None for cards without a parseable value.
+
+    Outputs:
+        nothing
+    """
+    if card[8:10] != '= ':
+        return None
+    keyword = card[:8].rstrip()
+    text = card[10:].lstrip()
+    if text.startswith("'"):
+        # Strings end at the first single quote that isn't doubled.
+        chars = []
+        i = 1
+        while i < len(text):
+            if text[i] == "'":
+                if text[i + 1:i + 2] == "'":
+                    chars.append("'")
+                    i += 2
+                    continue
+                break
+            chars.append(text[i])
+            i += 1
+        return keyword, ''.join(chars).rstrip()
+    text = text.split('/')[0].strip()
+    if text == '':
+        return None
+    if text == 'T':
+        return keyword, True
+    if text == 'F':
+        return keyword, False
+    try:
+        return keyword, int(text)
+    except ValueError:
+        pass
+    try:
+        return keyword, float(text.replace('D', 'E'))
+    except ValueError:
+        return None
+
+# -----------------------------------------------------------------------------
+
+def read_cards(filename, keywords=None, ext=0):
+    """Read header keywords from one HDU of a FITS file.
+
+    Parameters:
+        filename : string
+            The path to a FITS file.
+        keywords : list
+            The keywords to read, in any case. None reads every card
+            of the HDU.
+        ext : int
+            The HDU number.
+
+    Returns:
+        header : HeaderCards
+            The requested keywords found in the header. Keywords that
+            are not in the header are left out, so looking them up
+            raises a KeyError just like an astropy Header.
+
+    Outputs:
+        nothing
+    """
+    if keywords is not None:
+        wanted = set(keyword.upper() for keyword in keywords)
+    with open(filename, 'rb') as f:
+        for hdu in range(ext + 1):
+            # The structural keywords are needed to skip the data of the
+            # HDUs before ext.
+            skipping = hdu < ext
+            header = HeaderCards()
+            done = False
+            while not done:
+                block = f.read(BLOCK_SIZE)
+                assert len(block) == BLOCK_SIZE, \
+                    'Unexpected end of file reading HDU {} of {}'.format(
+                        hdu, filename)
+                for start in range(0, BLOCK_SIZE, CARD_SIZE):
+                    card = block[start:start + CARD_SIZE]
+                    if card[:8] == 'END     ':
+                        done = True
+                        break
+                    if not skipping and keywords is not None and \
+                            card[:8].rstrip() not in wanted:
+                        continue
+                    keyword_value = parse_card(card)
+                    if keyword_value is not None:
+                        header[keyword_value[0]] = keyword_value[1]
+                if not skipping and keywords is not None and \
+                        len(header) == len(wanted):
+                    return header
+            if skipping:
+                f.seek(get_data_size(header), os.SEEK_CUR)
+    return header
+
+# -----------------------------------------------------------------------------
+
+def read_cards_batch(file_list, keywords=None, ext=0, threads=8):
+    """Read header keywords from many FITS files.
+
+    The reads are I/O bound so they are spread over a thread pool.
+
+    Parameters:
+        file_list : list
+            Paths to FITS files.
+        keywords : list
+            The keywords to read. None reads every card.
+        ext : int
+            The HDU number.
+        threads : int
+            The number of concurrent reads.
+
+    Returns:
+        headers : dict
+            A dictionary of filename to HeaderCards.
+
+    Outputs:
+        nothing
+    """
+    pool = ThreadPool(processes=threads)
+    try:
+        headers = pool.map(lambda filename: read_cards(filename, keywords, ext),
+                           file_list)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(file_list, headers))
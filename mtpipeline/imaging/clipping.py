@@ -0,0 +1,140 @@
+#! /usr/bin/env python
+
+'''
+Order statistics and clipping for the PNG scaling in run_trim.
+
+The clipping limits are the values at given positions of the sorted
+pixels, e.g. the 1st and 99th percentile. Sorting a copy of a 4k x 4k
+drizzled mosaic to read two of its values is wasteful, so the values
+are found by selection instead:
+
+    1. Arrays up to HISTOGRAM_MIN_SIZE pixels are partitioned with
+       N.partition, which places the wanted values in linear time.
+    2. Larger arrays with only finite values are histogrammed first.
+       The bin holding each wanted position is found from the
+       cumulative counts, and only the pixels in that bin are
+       partitioned. This touches the big array with vectorized passes
+       only and never copies all of it.
+
+Both give exactly the value sorting would give, NaNs sorting last.
+The clipping itself is done in place with N.clip.
+'''
+
+import numpy as N
+
+# Arrays with more pixels than this use the histogram selection.
+HISTOGRAM_MIN_SIZE = 2 ** 25
+
+# The number of bins of the histogram selection.
+HISTOGRAM_BINS = 4096
+
+# -----------------------------------------------------------------------------
+# Functions (alphabetical)
+# -----------------------------------------------------------------------------
+
+def clip_in_place(array, minimum=None, maximum=None):
+    '''
+    Clip the values of an array to [minimum, maximum] in place. Either
+    limit can be None. The limits are cast to the array type, NaNs are
+    left as they are. Returns the array.
+    '''
+    assert isinstance(array, N.ndarray), 'array must be numpy array'
+    assert minimum is not None or maximum is not None, \
+        'clip_in_place needs a minimum or a maximum.'
+    if minimum is not None:
+        minimum = array.dtype.type(minimum)
+    if maximum is not None:
+        maximum = array.dtype.type(maximum)
+    N.clip(array, minimum, maximum, out=array)
+    return array
+
+# -----------------------------------------------------------------------------
+
+def get_order_statistics(array, kth_list, method=None):
+    '''
+    Return the values at the positions in kth_list of the sorted,
+    raveled array. Negative positions count from the end, as when
+    indexing. The array is not changed.
+
+    Parameters:
+        array : N.ndarray
+            The input array.
+        kth_list : list
+            The int positions.
+        method : string
+            'partition', 'histogram' or None, which picks 'histogram'
+            for arrays larger than HISTOGRAM_MIN_SIZE.
+
+    Returns:
+        values : list
+            The values, in the order of kth_list.
+
+    Outputs:
+        nothing
+    '''
+    assert isinstance(array, N.ndarray), 'array must be numpy array'
+    assert array.size > 0, 'array must not be empty'
+    assert method in [None, 'partition', 'histogram'], \
+        'method must be "partition", "histogram" or None.'
+    kth_list = [int(kth) for kth in kth_list]
+    for kth in kth_list:
+        assert -array.size <= kth < array.size, \
+            'Position {0} out of range for {1} pixels.'.format(kth, array.size)
+    kth_list = [kth % array.size for kth in kth_list]
+    if method is None:
+        method = 'histogram' if array.size > HISTOGRAM_MIN_SIZE \
+            else 'partition'
+    if method == 'histogram':
+        values = histogram_select(array.ravel(), kth_list)
+        if values is not None:
+            return values
+    flat = N.array(array, copy=True).ravel()
+    flat.partition(sorted(set(kth_list)))
+    return [flat[kth] for kth in kth_list]
+
+# -----------------------------------------------------------------------------
+
+def get_percentile_limits(array, bottom_fraction, top_fraction, method=None):
+    '''
+    Return the values at int(n * bottom_fraction) and
+    int(n * top_fraction) of the n sorted pixels of an array.
+    '''
+    assert 0 <= bottom_fraction < 1, 'bottom_fraction must be in [0, 1).'
+    assert 0 <= top_fraction < 1, 'top_fraction must be in [0, 1).'
+    return get_order_statistics(array, [int(array.size * bottom_fraction),
+                                        int(array.size * top_fraction)],
+                                method)
+
+# -----------------------------------------------------------------------------
+
+def histogram_select(flat, kth_list):
+    '''
+    Return the values at the positions in kth_list (non-negative) of
+    the sorted flat array by histogram bracketing, or None if the array
+    has non-finite values or a bracket doesn't hold the position, so
+    the caller falls back to a full partition.
+    '''
+    minimum, maximum = flat.min(), flat.max()
+    if not (N.isfinite(minimum) and N.isfinite(maximum)):
+        return None
+    if minimum == maximum:
+        return [minimum for kth in kth_list]
+    counts, edges = N.histogram(flat, bins=HISTOGRAM_BINS,
+                                range=(minimum, maximum))
+    cumulative = N.cumsum(counts)
+    values = []
+    for kth in kth_list:
+        index = int(N.searchsorted(cumulative, kth, side='right'))
+        lower = edges[index]
+        # Count and collect the bracket directly, so the result doesn't
+        # depend on how N.histogram rounds values on the bin edges.
+        below = N.count_nonzero(flat < lower)
+        if index == HISTOGRAM_BINS - 1:
+            bracket = flat[flat >= lower]
+        else:
+            bracket = flat[(flat >= lower) & (flat < edges[index + 1])]
+        if not below <= kth < below + bracket.size:
+            return None
+        bracket.partition(kth - below)
+        values.append(bracket[kth - below])
+    return values
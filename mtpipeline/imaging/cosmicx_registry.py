@@ -0,0 +1,187 @@
+"""A registry of the cosmicx parameters of every detector.
+
+All cosmicx_cfg files are loaded and validated once per process, the
+first time parameters are requested. The registry holds them frozen so
+callers can't change them by accident, and get_params returns a fresh
+copy with the header gain and read noise applied.
+"""
+
+import glob
+import os
+
+import yaml
+
+from mtpipeline.get_settings import SETTINGS
+from mtpipeline.imaging.provenance import hash_params
+
+# The cosmicx_cfg directory is at the top of the repository.
+CONFIG_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__)))), 'cosmicx_cfg')
+
+# The type of every parameter an extension must have.
+PARAM_TYPES = {'inmask' : (type(None),),
+               'outmaskfile' : (str,),
+               'pssl' : (int, float),
+               'gain' : (int, float),
+               'readnoise' : (int, float),
+               'sigclip' : (int, float),
+               'sigfrac' : (int, float),
+               'objlim' : (int, float),
+               'satlevel' : (int, float),
+               'robust' : (bool,),
+               'verbose' : (bool,),
+               'niter' : (int,)}
+
+# Optional parameters and their allowed values.
+OPTIONAL_PARAMS = {'backend' : ['lacosmicx', 'numpy']}
+
+# The frozen parameters of each detector, filled by load_registry.
+_REGISTRY = {}
+
+# -----------------------------------------------------------------------------
+# Functions (alphabetical)
+# -----------------------------------------------------------------------------
+
+def freeze(cosmicx_params):
+    """Return a hashable, read-only copy of a detector's parameters.
+
+    Parameters:
+        cosmicx_params : dict
+            Extension numbers mapped to parameter dictionaries.
+
+    Returns:
+        frozen : tuple
+            Sorted (extension, ((name, value), ...)) pairs.
+
+    Outputs:
+        nothing
+    """
+    return tuple((ext, tuple(sorted(params.items())))
+                 for ext, params in sorted(cosmicx_params.items()))
+
+# -----------------------------------------------------------------------------
+
+def get_params(detector, readnoise=None, gain=None):
+    """Return the cosmicx parameters of a detector.
+
+    Parameters:
+        detector : string
+            The detector, e.g. 'WFPC2' or 'UVIS'.
+        readnoise : float
+            The header read noise. Overrides the configured value of
+            every extension when it is set.
+        gain : float
+            The header gain. Overrides the configured value of every
+            extension when it is set.
+
+    Returns:
+        cosmicx_params : dict
+            A new dictionary of extension numbers to parameter
+            dictionaries, which the caller may change.
+
+    Outputs:
+        nothing
+    """
+    load_registry()
+    assert detector in _REGISTRY, \
+        'No cosmicx_cfg file for detector {}'.format(detector)
+    cosmicx_params = {ext : dict(params)
+                      for ext, params in _REGISTRY[detector]}
+
+    # The default backend is left out of the parameters, so the
+    # provenance hash of existing outputs doesn't change.
+    backend = SETTINGS.get('cosmicx_backend')
+    for params in cosmicx_params.values():
+        if readnoise:
+            params['readnoise'] = readnoise
+        if gain:
+            params['gain'] = gain
+        if backend and backend != 'lacosmicx':
+            params.setdefault('backend', backend)
+    return cosmicx_params
+
+# -----------------------------------------------------------------------------
+
+def get_params_hash(cosmicx_params):
+    """Return the provenance hash of a set of cosmicx parameters.
+
+    Parameters:
+        cosmicx_params : dict
+            As returned by get_params.
+
+    Returns:
+        params_hash : string
+            The hexadecimal md5 digest used in the provenance manifests.
+
+    Outputs:
+        nothing
+    """
+    return hash_params(cosmicx_params)
+
+# -----------------------------------------------------------------------------
+
+def load_registry(path=CONFIG_PATH):
+    """Load and validate every cosmicx_cfg file, once per process.
+
+    Parameters:
+        path : string
+            The directory of the <detector>_params.yaml files.
+
+    Returns:
+        nothing
+
+    Outputs:
+        nothing
+    """
+    if _REGISTRY:
+        return
+    registry = {}
+    for config_file in glob.glob(os.path.join(path, '*_params.yaml')):
+        detector = os.path.basename(config_file)[:-len('_params.yaml')]
+        with open(config_file, 'r') as f:
+            cosmicx_params = yaml.safe_load(f)
+        validate(cosmicx_params, config_file)
+        registry[detector] = freeze(cosmicx_params)
+    _REGISTRY.update(registry)
+
+# -----------------------------------------------------------------------------
+
+def validate(cosmicx_params, config_file):
+    """Check a detector's parameters have every key with the right type.
+
+    Parameters:
+        cosmicx_params : dict
+            Extension numbers mapped to parameter dictionaries.
+        config_file : string
+            The file they came from, for the error messages.
+
+    Returns:
+        nothing
+
+    Outputs:
+        nothing
+    """
+    assert isinstance(cosmicx_params, dict) and cosmicx_params, \
+        'Expected extensions in {}'.format(config_file)
+    for ext, params in cosmicx_params.items():
+        assert isinstance(ext, int), \
+            'Expected integer extension, got {0} in {1}'.format(ext,
+                                                               config_file)
+        missing = set(PARAM_TYPES) - set(params)
+        assert not missing, 'Missing {0} for extension {1} in {2}'.format(
+            sorted(missing), ext, config_file)
+        for name, value in params.items():
+            if name in OPTIONAL_PARAMS:
+                assert value in OPTIONAL_PARAMS[name], \
+                    'Unexpected {0} {1} in {2}'.format(name, value,
+                                                       config_file)
+                continue
+            assert name in PARAM_TYPES, \
+                'Unexpected parameter {0} in {1}'.format(name, config_file)
+            # bool is a subclass of int, don't accept it for numbers.
+            assert isinstance(value, PARAM_TYPES[name]) and \
+                (name in ['robust', 'verbose'] or
+                 not isinstance(value, bool)), \
+                'Bad value {0} for {1} in {2}'.format(value, name,
+                                                      config_file)
@@ -14,19 +14,33 @@ import logging
 import os
 import sys
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 from platform import architecture
-from stwcs import updatewcs
 from astropy.io import fits
 
 # Custom Packages
 from mtpipeline.imaging.run_cosmicx import run_cosmicx
 from mtpipeline.imaging.run_cosmicx import get_cosmicx_params
+from mtpipeline.imaging.run_astrodrizzle import get_config_file
 from mtpipeline.imaging.run_astrodrizzle import run_astrodrizzle
 from mtpipeline.imaging.run_trim import run_trim
+from mtpipeline.imaging.run_trim import THRESHOLD_MAXIMUM
+from mtpipeline.imaging.run_trim import THRESHOLD_MINIMUM
+from mtpipeline.imaging.run_trim import wait_for_pngs
+from mtpipeline.imaging import cosmicx_registry
+from mtpipeline.imaging import provenance
+from mtpipeline.imaging import stack_cosmics
+from mtpipeline.imaging import wcs_cache
+from mtpipeline.database.header_catalog import get_header
 #from mtpipeline.ephem.build_masters_finder_table import \
 #     get_planet_and_moons_list
 from mtpipeline.get_settings import SETTINGS
 
+# The header keywords read by get_metadata.
+HEADER_KEYWORDS = ['DATE-OBS', 'INSTRUME', 'DETECTOR', 'CCDGAIN', 'READNSEA',
+                   'READNSEB', 'READNSEC', 'READNSED', 'FILTNAM1', 'FILTER',
+                   'FILTER1', 'FILTER2', 'TARGNAME']
+
 # ----------------------------------------------------------------------------
 # Functions (alphabetical)
 # ----------------------------------------------------------------------------
@@ -69,56 +83,54 @@ def get_metadata(filename):
 
     """
 
-    with fits.open(filename, mode='readonly') as HDUlist:
+    header = get_header(filename, keywords=HEADER_KEYWORDS)
 
-        mainHDU = HDUlist[0]
+    dateobs = header['date-obs']
+    instrument = header['instrume']
 
-        dateobs = mainHDU.header['date-obs']
-        instrument = mainHDU.header['instrume']
-        
-        # Because WFPC2 has no 'detector' keyword:
-        try:
-            detector = mainHDU.header['detector']
-        except KeyError:
-            detector = instrument
-
-        gain = None
-        readnoise = None
-        filtername = "none"
-        targname = "none"
-        
-        # For WFPC2, there is no readnoise information in the header.
-	    # There is gain information, but it leads to bad CR rejection.
-        # For ACS / SBC, there is no readnoise or gain information.
-	    # If None, we use the settings provided in the cfg files.
-        
-        if detector != 'SBC' and instrument != 'WFPC2':
-      	    gain = mainHDU.header['ccdgain']
-            readnoise_a = mainHDU.header['readnsea']
-            readnoise_b = mainHDU.header['readnseb']
-            readnoise_c = mainHDU.header['readnsec']
-            readnoise_d = mainHDU.header['readnsed']
-            readnoise = max(readnoise_a, readnoise_b,readnoise_c,readnoise_d)
-
-        if instrument == 'WFPC2':
-            try:
-                filtername = mainHDU.header['filtnam1']
-            except: print "Failed to find filter keyword."
-        if instrument == 'WFC3':
-            try:
-                filtername = mainHDU.header['filter']
-            except: print "Failed to find filter keyword."
-        if instrument == 'ACS':
-            try:
-                filt1 = mainHDU.header['filter1']
-                filt2 = mainHDU.header['filter2']
-                if filt1[0] == 'F': filtername = filt1 
-                if filt2[0] == 'F': filtername = filt2 
-            except: print "Failed to find filter keyword."
+    # Because WFPC2 has no 'detector' keyword:
+    try:
+        detector = header['detector']
+    except KeyError:
+        detector = instrument
 
+    gain = None
+    readnoise = None
+    filtername = "none"
+    targname = "none"
+
+    # For WFPC2, there is no readnoise information in the header.
+    # There is gain information, but it leads to bad CR rejection.
+    # For ACS / SBC, there is no readnoise or gain information.
+    # If None, we use the settings provided in the cfg files.
+
+    if detector != 'SBC' and instrument != 'WFPC2':
+        gain = header['ccdgain']
+        readnoise_a = header['readnsea']
+        readnoise_b = header['readnseb']
+        readnoise_c = header['readnsec']
+        readnoise_d = header['readnsed']
+        readnoise = max(readnoise_a, readnoise_b,readnoise_c,readnoise_d)
+
+    if instrument == 'WFPC2':
+        try:
+            filtername = header['filtnam1']
+        except: print "Failed to find filter keyword."
+    if instrument == 'WFC3':
         try:
-            targname = mainHDU.header['targname']
-        except: print "Failed to find targname keyword."
+            filtername = header['filter']
+        except: print "Failed to find filter keyword."
+    if instrument == 'ACS':
+        try:
+            filt1 = header['filter1']
+            filt2 = header['filter2']
+            if filt1[0] == 'F': filtername = filt1 
+            if filt2[0] == 'F': filtername = filt2 
+        except: print "Failed to find filter keyword."
+
+    try:
+        targname = header['targname']
+    except: print "Failed to find targname keyword."
 
     header_data = {'instrument' : instrument,
                    'detector' : detector,
@@ -324,81 +336,326 @@ def make_output_file_dict(filename,header_data):
 
     return output_file_dict
 
+# ----------------------------------------------------------------------------
+
+def needs_processing(stage, manifest_name, inputs, outputs, params_hash,
+        reproc_switch=False, incremental_switch=False):
+    '''
+    Decide if a stage has to run.
+
+    The stage runs if reproc_switch is set or any output is missing.
+    In incremental mode it also runs when the provenance manifest shows
+    that its inputs, its parameters, or the pipeline version changed
+    since it last ran.
+
+    Parameters:
+        stage: string
+            The stage name, e.g. 'cr_reject'.
+        manifest_name: string
+            The path to the provenance manifest.
+        inputs: list
+            The input files of the stage.
+        outputs: list
+            The output files of the stage.
+        params_hash: string
+            The hash of the current stage parameters.
+        reproc_switch: bool
+            Reprocess even if the outputs exist.
+        incremental_switch: bool
+            Reprocess if the outputs are stale.
+
+    Returns:
+        run_stage: bool
+            True if the stage should run.
+
+    Outputs: nothing
+    '''
+    if reproc_switch:
+        return True
+    if not check_for_outputs(outputs):
+        return True
+    if incremental_switch:
+        manifest = provenance.read_manifest(manifest_name)
+        return not provenance.is_current(manifest, stage, inputs,
+                                         params_hash)
+    return False
+
+# ----------------------------------------------------------------------------
+# Stage functions
+# ----------------------------------------------------------------------------
+
+def cr_reject_stage(root_filename, header_data, output_file_dict,
+        reproc_switch=False, incremental_switch=False):
+    '''
+    Run the cosmic ray rejection step for a single input file. This is
+    the first stage of the pipeline and can be run on its own by the
+    stage scheduler.
+    '''
+    detector = header_data['detector']
+    cosmicx_params = get_cosmicx_params(header_data) 
+    params_hash = cosmicx_registry.get_params_hash(cosmicx_params)
+    manifest_name = provenance.make_manifest_name(output_file_dict)
+    inputs = [root_filename]
+    outputs = [output_file_dict['cr_reject_output'][1]]
+    if not needs_processing('cr_reject', manifest_name, inputs, outputs,
+            params_hash, reproc_switch, incremental_switch):
+        print 'Not reprocessing cr_reject files.'
+        logging.info("Not reprocessing cr_reject files.")
+    else:
+        logging.info("Running cr_reject")
+        print 'Running cr_reject'
+        started = datetime.now()
+        logging.info(cosmicx_params)
+
+        output_filename = output_file_dict['cr_reject_output'][1]
+        run_cosmicx(root_filename, 
+                    output_filename,
+                    cosmicx_params,
+                    detector)
+        provenance.record_stage(manifest_name, 'cr_reject', inputs,
+                                outputs, params_hash, started)
+        print 'Done running cr_reject'
+        logging.info("Done running cr_reject")
+
+# ----------------------------------------------------------------------------
+
+def cr_reject_group_stage(group, reproc_switch=False, incremental_switch=False):
+    '''
+    Run the cosmic ray rejection step for a stack of exposures from the
+    same visit, see stack_cosmics. Each member of group is a dictionary
+    with the filename, header_data, and output_file_dict of an exposure.
+    Stacks too small for stack rejection run cr_reject_stage on every
+    member. Otherwise the whole stack is rerun when any member needs
+    processing, since every output depends on all of the inputs.
+    '''
+    if len(group) < stack_cosmics.MIN_FRAMES:
+        for member in group:
+            cr_reject_stage(member['filename'], member['header_data'],
+                            member['output_file_dict'], reproc_switch,
+                            incremental_switch)
+        return
+
+    filename_list = [member['filename'] for member in group]
+    output_list = [member['output_file_dict']['cr_reject_output'][1]
+                   for member in group]
+    cosmicx_params_list = [get_cosmicx_params(member['header_data'])
+                           for member in group]
+    params_hash_list = [provenance.hash_params({'mode' : 'stack',
+                                                'cosmicx' : cosmicx_params})
+                        for cosmicx_params in cosmicx_params_list]
+    manifest_list = [provenance.make_manifest_name(member['output_file_dict'])
+                     for member in group]
+    if not any(needs_processing('cr_reject', manifest_name, filename_list,
+                                [output], params_hash, reproc_switch,
+                                incremental_switch)
+               for manifest_name, output, params_hash in zip(
+                   manifest_list, output_list, params_hash_list)):
+        print 'Not reprocessing cr_reject files.'
+        logging.info("Not reprocessing cr_reject files.")
+    else:
+        logging.info("Running stack cr_reject on " + ', '.join(filename_list))
+        print 'Running stack cr_reject'
+        started = datetime.now()
+        stack_cosmics.run_stack_cosmicx(filename_list, output_list,
+                                        cosmicx_params_list,
+                                        group[0]['header_data']['detector'])
+        for manifest_name, output, params_hash in zip(
+                manifest_list, output_list, params_hash_list):
+            provenance.record_stage(manifest_name, 'cr_reject', filename_list,
+                                    [output], params_hash, started)
+        print 'Done running stack cr_reject'
+        logging.info("Done running stack cr_reject")
+
+# ----------------------------------------------------------------------------
+
+def drizzle_product_stage(header_data, output_file_dict, index):
+    '''
+    Run AstroDrizzle for one product of a single input file: index 0
+    is the original file and index 1 the CR rejected one. The products
+    don't depend on each other, so the stage scheduler runs them as
+    separate tasks. Both drizzle runs make a weight file with the same
+    name, only the one of the last product is kept, like when they ran
+    one after the other. Requires drizzle_prep_stage.
+    '''
+    filename = output_file_dict['cr_reject_output'][index]
+    output = output_file_dict['drizzle_output'][index]
+    keep_weight = index == len(output_file_dict['drizzle_output']) - 1
+    logging.info("Running Astrodrizzle on " + filename)
+    run_astrodrizzle(filename, output, header_data['detector'],
+                     header_data['dateobs'], keep_weight)
+
+# ----------------------------------------------------------------------------
+
+def drizzle_prep_stage(header_data, output_file_dict, reproc_switch=False,
+        incremental_switch=False):
+    '''
+    Check whether the drizzle stage of a single input file needs to
+    run and, if so, update the WCS of its inputs. Returns None when
+    the outputs are up to date, else a dictionary with the
+    'params_hash' and 'started' values to pass to drizzle_record once
+    every drizzle_product_stage is done.
+    '''
+    detector = header_data['detector']
+    with open(get_config_file(detector), 'r') as f:
+        params_hash = provenance.hash_params({'detector' : detector,
+                                              'config' : f.read()})
+    manifest_name = provenance.make_manifest_name(output_file_dict)
+    inputs = output_file_dict['cr_reject_output']
+    outputs = output_file_dict['drizzle_output'] + \
+              output_file_dict['drizzle_weight']
+    if not needs_processing('drizzle', manifest_name, inputs, outputs,
+            params_hash, reproc_switch, incremental_switch):
+        logging.info("Not reprocessing astrodrizzle files.")
+        print 'Not reprocessing astrodrizzle files.'
+        return None
+    logging.info("Running Astrodrizzle")
+    print 'Running Astrodrizzle'
+    started = datetime.now()
+    # The original file first, so the CR rejected copy reuses its WCS.
+    for filename in inputs:
+        wcs_cache.update_wcs(filename)
+    return {'params_hash' : params_hash, 'started' : started}
+
+# ----------------------------------------------------------------------------
+
+def drizzle_record(output_file_dict, drizzle_run):
+    '''
+    Record the drizzle stage in the provenance manifest after every
+    product of a single input file is done.
+    '''
+    manifest_name = provenance.make_manifest_name(output_file_dict)
+    inputs = output_file_dict['cr_reject_output']
+    outputs = output_file_dict['drizzle_output'] + \
+              output_file_dict['drizzle_weight']
+    provenance.record_stage(manifest_name, 'drizzle', inputs, outputs,
+                            drizzle_run['params_hash'],
+                            drizzle_run['started'])
+    print 'Done running astrodrizzle'
+    logging.info("Done running astrodrizzle")
+
+# ----------------------------------------------------------------------------
+
+def drizzle_stage(header_data, output_file_dict, reproc_switch=False,
+        incremental_switch=False):
+    '''
+    Run AstroDrizzle on the original and the CR rejected version of a
+    single input file, one after the other. Requires the outputs of
+    cr_reject_stage.
+    '''
+    drizzle_run = drizzle_prep_stage(header_data, output_file_dict,
+                                     reproc_switch, incremental_switch)
+    if drizzle_run is not None:
+        for index in range(len(output_file_dict['drizzle_output'])):
+            drizzle_product_stage(header_data, output_file_dict, index)
+        drizzle_record(output_file_dict, drizzle_run)
+
+# ----------------------------------------------------------------------------
+
+def png_stage(output_file_dict, output_path=None, reproc_switch=False,
+        incremental_switch=False):
+    '''
+    Create the PNG outputs from the drizzled products of a single input
+    file. Requires the outputs of drizzle_stage.
+    '''
+    params = {'threshold_minimum' : THRESHOLD_MINIMUM,
+              'threshold_maximum' : THRESHOLD_MAXIMUM,
+              'log_switch' : True,
+              'output_path' : output_path}
+    # Only hashed when on, so PNGs made before the tiles, thumbnails,
+    # extra stretches and previews stay current.
+    tile_switch = bool(SETTINGS.get('png_tiles'))
+    if tile_switch:
+        params['tile_size'] = SETTINGS.get('tile_size')
+    thumbnail_switch = bool(SETTINGS.get('png_thumbnails'))
+    if thumbnail_switch:
+        params['thumbnail_size'] = SETTINGS.get('thumbnail_size')
+        params['thumbnail_format'] = SETTINGS.get('thumbnail_format')
+        if not tile_switch:
+            logging.warning('png_thumbnails is set without png_tiles: the '
+                            'thumbnails have no sub_images records.')
+    stretch_list = SETTINGS.get('png_stretches') or []
+    if stretch_list:
+        params['stretch_list'] = stretch_list
+    preview_switch = bool(SETTINGS.get('png_previews'))
+    if preview_switch:
+        params['preview_dtype'] = SETTINGS.get('preview_dtype')
+        params['preview_block'] = SETTINGS.get('preview_block')
+    # The statistics don't change the PNGs, so they aren't hashed.
+    stat_switch = bool(SETTINGS.get('png_stats'))
+    params_hash = provenance.hash_params(params)
+    manifest_name = provenance.make_manifest_name(output_file_dict)
+    inputs = output_file_dict['drizzle_output']
+    outputs = output_file_dict['png_output']
+    if not needs_processing('png', manifest_name, inputs, outputs,
+            params_hash, reproc_switch, incremental_switch):
+        print 'Not reprocessing png files.'
+        logging.info("Not reprocessing png files.")
+    else:
+        print 'Running png'
+        logging.info("Running png")
+        started = datetime.now()
+        # The PNGs of all the drizzled products are written by one
+        # thread pool, compressing while the next product is stretched.
+        pool = ThreadPool(processes=SETTINGS.get('png_threads') or 4)
+        try:
+            pending = []
+            for filename in output_file_dict['drizzle_output']:
+                pending.extend(run_trim(filename, output_path,
+                                        log_switch=True, pool=pool,
+                                        stat_switch=stat_switch,
+                                        tile_switch=tile_switch,
+                                        thumbnail_switch=thumbnail_switch,
+                                        stretch_list=stretch_list,
+                                        preview_switch=preview_switch))
+            wait_for_pngs(pending)
+        finally:
+            pool.close()
+            pool.join()
+        provenance.record_stage(manifest_name, 'png', inputs, outputs,
+                                params_hash, started)
+        print 'Done running png'
+        logging.info("Done running png")
+
 # ----------------------------------------------------------------------------
 # The main function.
 # ----------------------------------------------------------------------------
 
 def imaging_pipeline(root_filename, output_path = None, cr_reject_switch=True, 
-        astrodrizzle_switch=True, png_switch=True, reproc_switch=False):
+        astrodrizzle_switch=True, png_switch=True, reproc_switch=False,
+        incremental_switch=False):
     '''
-    This is the main controller for all the steps in the pipeline.
+    This is the main controller for all the steps in the pipeline. The
+    steps are run one after the other for a single file. See
+    mtpipeline.imaging.stage_scheduler for running the steps of many
+    files concurrently. With incremental_switch only the steps whose
+    inputs or parameters changed are rerun, see needs_processing.
     '''
     # Get information from the header
     header_data = get_metadata(root_filename)
-    detector = header_data['detector']
-    dateobs = header_data['dateobs']
 
     # Generate the output filenames 
-    filename = os.path.abspath(root_filename) 
     output_file_dict = make_output_file_dict(root_filename,header_data)
 
     # Run CR reject
     if cr_reject_switch:
-        output_check = check_for_outputs(output_file_dict['cr_reject_output'][1])
-        if reproc_switch == False and output_check == True:
-            print 'Not reprocessing cr_reject files.'
-            logging.info("Not reprocessing cr_reject files.")
-        else:
-            logging.info("Running cr_reject")
-            print 'Running cr_reject'
-
-            cosmicx_params = get_cosmicx_params(header_data) 
-            logging.info(cosmicx_params)
-
-            output_filename = output_file_dict['cr_reject_output'][1]
-            run_cosmicx(root_filename, 
-                        output_filename,
-                        cosmicx_params,
-                        detector)
-            print 'Done running cr_reject'
-            logging.info("Done running cr_reject")
+        cr_reject_stage(root_filename, header_data, output_file_dict,
+                        reproc_switch, incremental_switch)
     else:
         logging.info("Skipping cr_reject ")
         print 'Skipping cr_reject'
     
     # Run astrodrizzle.         
     if astrodrizzle_switch:
-        output_check = check_for_outputs(output_file_dict['drizzle_output'])
-        if reproc_switch == False and output_check == True:
-            logging.info("Not reprocessing astrodrizzle files.")
-            print 'Not reprocessing astrodrizzle files.'
-        else:
-            logging.info("Running Astrodrizzle")
-            print 'Running Astrodrizzle'
-            for filename, output in zip(output_file_dict['cr_reject_output'],
-                                        output_file_dict['drizzle_output']):
-                updatewcs.updatewcs(filename)
-                run_astrodrizzle(filename, output, detector, dateobs)
-            print 'Done running astrodrizzle'
-            logging.info("Done running astrodrizzle")
+        drizzle_stage(header_data, output_file_dict, reproc_switch,
+                      incremental_switch)
     else:
         print 'Skipping astrodrizzle'
         logging.info("Skipping astrodrizzle")
         
     # Run trim.
     if png_switch:
-        output_check = check_for_outputs(output_file_dict['png_output'])
-        if reproc_switch == False and output_check == True:
-            print 'Not reprocessing png files.'
-            logging.info("Not reprocessing png files.")
-        else:
-            print 'Running png'
-            logging.info("Running png")
-            for filename in output_file_dict['drizzle_output']:
-                run_trim(filename, output_path,log_switch=True)
-            print 'Done running png'
-            logging.info("Done running png")
+        png_stage(output_file_dict, output_path, reproc_switch,
+                  incremental_switch)
     else:
         print 'Skipping running png'
         logging.info("Skipping running png")
-        
@@ -1,20 +1,316 @@
-'''
-iterate run_cosmics.py with different parameters 
-'''
-
-import subprocess
-
-
-for iters in range(0,10):
-	readnoise = 2.5
-	while readnoise <= 7.5:
-		subprocess.call(['python', 'run_cosmics.py', '--files', 
-						'../../temp/fits/u2mi0102t_c0m.fits',
-						'-i', str(iters), '-sigmaclip', '3.0', '-readnoise', str(readnoise)]);
-		readnoise = readnoise + 1;
-	sigmaclip = 0.5
-	while sigmaclip <= 6.0:
-		subprocess.call(['python', 'run_cosmics.py', '--files', 
-					'../../temp/fits/u2mi0102t_c0m.fits',
-					'-i', str(iters), '-sigmaclip', str(sigmaclip), '-readnoise', '5.0']);
-		sigmaclip = sigmaclip+1
+#! /usr/bin/env python
+
+"""Parameter sweeps for tuning the cosmic ray rejection settings.
+
+The image is read once. The parts of the first L.A.Cosmic iteration
+that don't depend on the detection limits (the subsampled Laplacian,
+the noise model median, and the fine structure medians) are computed
+once for each gain, sky level, and robust combination and shared by all
+settings, which then run in parallel worker processes. The workers
+inherit the image and these products when the pool forks, so nothing
+large is sent to them.
+
+The result is a table with one row per setting that gives the number
+of cosmic ray pixels and the overlap of its mask with the mask of the
+first setting, the reference.
+
+Use:
+    Sweep readnoise and sigclip for the first chip of a file:
+
+    >>> python iter_cosmics.py -filename u2mi0102t_c0m.fits -ext 1 \
+            -readnoise 2.5 3.5 4.5 5.5 6.5 -sigclip 3 4 5 6 \
+            -output sweep.csv
+"""
+
+import argparse
+import csv
+import itertools
+import multiprocessing as mp
+
+import numpy as N
+
+from astropy.io import fits
+from mtpipeline.get_settings import SETTINGS
+from mtpipeline.imaging.imaging_pipeline import get_metadata
+from mtpipeline.imaging.lacosmic_numpy import get_products
+from mtpipeline.imaging.lacosmic_numpy import lacosmic
+from mtpipeline.imaging.run_cosmicx import get_cosmicx_params
+
+# The parameters that change the image the products are computed from.
+PRODUCT_KEYS = ('gain', 'pssl', 'robust')
+
+# The parameters that can be swept, in table column order.
+SWEEP_KEYS = ['readnoise', 'sigclip', 'sigfrac', 'objlim', 'satlevel',
+              'niter', 'gain', 'pssl', 'robust']
+
+# The image and shared products of the running sweep, set before the
+# pool forks so the workers can read them.
+_SWEEP = {}
+
+# -----------------------------------------------------------------------------
+# Functions (alphabetical)
+# -----------------------------------------------------------------------------
+
+def get_overlap(mask, reference):
+    """Return how much a mask overlaps the reference mask.
+
+    Parameters:
+        mask : numpy array
+            A cosmic ray mask.
+        reference : numpy array
+            The reference cosmic ray mask.
+
+    Returns:
+        overlap : dict
+            Has keys 'common' (pixels in both masks), 'only_setting',
+            'only_reference', and 'jaccard' (common pixels over pixels
+            in either mask, 1.0 if both are empty).
+
+    Outputs:
+        nothing
+    """
+    common = int((mask & reference).sum())
+    either = int((mask | reference).sum())
+    return {'common' : common,
+            'only_setting' : int(mask.sum()) - common,
+            'only_reference' : int(reference.sum()) - common,
+            'jaccard' : float(common) / either if either else 1.0}
+
+# -----------------------------------------------------------------------------
+
+def get_product_key(params):
+    """Return the key of the shared products a setting can use."""
+    return tuple(params[key] for key in PRODUCT_KEYS)
+
+# -----------------------------------------------------------------------------
+
+def make_settings(base_params, grid):
+    """Return one full parameter set per combination of the grid values.
+
+    Parameters:
+        base_params : dict
+            The cosmicx parameters of the extension.
+        grid : dict
+            Parameter names mapped to lists of values to try.
+
+    Returns:
+        settings : list
+            Copies of base_params, one per combination, in the order of
+            itertools.product over the sorted parameter names.
+
+    Outputs:
+        nothing
+    """
+    for key in grid:
+        assert key in SWEEP_KEYS, 'Unexpected sweep parameter ' + key
+    keys = sorted(grid)
+    settings = []
+    for values in itertools.product(*[grid[key] for key in keys]):
+        params = dict(base_params)
+        params.update(zip(keys, values))
+        settings.append(params)
+    return settings
+
+# -----------------------------------------------------------------------------
+
+def run_setting(index):
+    """Pool worker, run the setting with the given index of the sweep.
+
+    Parameters:
+        index : int
+            The index of the setting in _SWEEP['settings'].
+
+    Returns:
+        crmask : numpy array
+            The packed bits of the cosmic ray mask.
+
+    Outputs:
+        nothing
+    """
+    params = _SWEEP['settings'][index]
+    data, products = _SWEEP['products'][get_product_key(params)]
+    mask = _SWEEP['mask']
+    cleanarr, crmask = lacosmic(data, mask, params['sigclip'],
+                                params['objlim'], params['sigfrac'],
+                                params['satlevel'], params['readnoise'],
+                                params['robust'], False, params['niter'],
+                                products)
+    return N.packbits(crmask)
+
+# -----------------------------------------------------------------------------
+
+def sweep(image, settings, mask=None, processes=None):
+    """Run L.A.Cosmic with every setting on one image.
+
+    Parameters:
+        image : numpy array
+            The image in ADU.
+        settings : list
+            Full cosmicx parameter dictionaries, see make_settings. The
+            first one is the reference for the overlap columns.
+        mask : numpy array
+            Bad pixels to ignore, or None.
+        processes : int
+            The number of worker processes. Defaults to the `num_cores`
+            setting.
+
+    Returns:
+        table : list
+            One dictionary per setting with the swept parameters, the
+            number of cosmic ray pixels ('crpix'), and the get_overlap
+            keys.
+
+    Outputs:
+        nothing
+    """
+    assert settings != [], 'Expected at least one setting.'
+    if processes is None:
+        processes = SETTINGS['num_cores']
+    if mask is None:
+        mask = N.zeros(image.shape, dtype=bool)
+
+    # For a cleaner cr rejection, set all very negative pixels to 0,
+    # like run_cosmicx does.
+    image = N.array(image, dtype=N.float32)
+    image[image < -10.0] = 0.0
+
+    products = {}
+    for params in settings:
+        key = get_product_key(params)
+        if key not in products:
+            data = (image + params['pssl']) * params['gain']
+            products[key] = (data, get_products(data, params['robust']))
+    _SWEEP.update({'settings' : settings, 'products' : products,
+                   'mask' : mask})
+
+    try:
+        if processes > 1 and len(settings) > 1:
+            pool = mp.Pool(processes=processes)
+            try:
+                packed = pool.map(run_setting, range(len(settings)))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            packed = [run_setting(index) for index in range(len(settings))]
+    finally:
+        _SWEEP.clear()
+
+    size = image.size
+    masks = [N.unpackbits(bits)[:size].reshape(image.shape).astype(bool)
+             for bits in packed]
+    table = []
+    for params, crmask in zip(settings, masks):
+        row = {key : params[key] for key in SWEEP_KEYS}
+        row['crpix'] = int(crmask.sum())
+        row.update(get_overlap(crmask, masks[0]))
+        table.append(row)
+    return table
+
+# -----------------------------------------------------------------------------
+
+def sweep_file(filename, ext, grid, processes=None):
+    """Sweep the parameters of one extension of a FITS file.
+
+    The base parameters are the cosmicx_cfg parameters of the detector,
+    with the header gain and read noise applied.
+
+    Parameters:
+        filename : string
+            The path to a FITS file.
+        ext : int
+            The extension to clean.
+        grid : dict
+            Parameter names mapped to lists of values to try.
+        processes : int
+            The number of worker processes.
+
+    Returns:
+        table : list
+            See sweep.
+
+    Outputs:
+        nothing
+    """
+    cosmicx_params = get_cosmicx_params(get_metadata(filename))
+    assert ext in cosmicx_params, \
+        'No cosmicx parameters for extension {}'.format(ext)
+    settings = make_settings(cosmicx_params[ext], grid)
+    image = fits.getdata(filename, ext)
+    return sweep(image, settings, processes=processes)
+
+# -----------------------------------------------------------------------------
+
+def write_table(table, output):
+    """Write a sweep table as CSV.
+
+    Parameters:
+        table : list
+            As returned by sweep.
+        output : string
+            The path to the CSV file.
+
+    Returns:
+        nothing
+
+    Outputs:
+        The CSV file.
+    """
+    columns = SWEEP_KEYS + ['crpix', 'common', 'only_setting',
+                            'only_reference', 'jaccard']
+    with open(output, 'wb') as f:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        writer.writerows(table)
+
+# -----------------------------------------------------------------------------
+# For command line execution.
+# -----------------------------------------------------------------------------
+
+def parse_args():
+    '''
+    Parse the command line arguments.
+    '''
+    parser = argparse.ArgumentParser(
+        description = 'Sweep the cosmic ray rejection parameters.')
+    parser.add_argument(
+        '-filename',
+        required = True,
+        help = 'The FITS file to clean.')
+    parser.add_argument(
+        '-ext',
+        required = False,
+        type = int,
+        default = 1,
+        help = 'The extension to clean. Default is 1.')
+    for key in ['readnoise', 'sigclip', 'sigfrac', 'objlim', 'satlevel',
+                'gain', 'pssl']:
+        parser.add_argument(
+            '-' + key,
+            required = False,
+            type = float,
+            nargs = '+',
+            help = 'Values of {} to try.'.format(key))
+    parser.add_argument(
+        '-niter',
+        required = False,
+        type = int,
+        nargs = '+',
+        help = 'Values of niter to try.')
+    parser.add_argument(
+        '-output',
+        required = False,
+        default = 'sweep.csv',
+        help = 'The CSV table to write. Default is sweep.csv.')
+    args = parser.parse_args()
+    return args
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    args = parse_args()
+    grid = {key : getattr(args, key) for key in SWEEP_KEYS
+            if getattr(args, key, None) is not None}
+    table = sweep_file(args.filename, args.ext, grid)
+    write_table(table, args.output)
+    print 'Wrote {} settings to {}'.format(len(table), args.output)
@@ -0,0 +1,354 @@
+""" A NumPy/SciPy implementation of L.A.Cosmic.
+
+This is a vectorized port of the compiled _lacosmicx extension in src/.
+It follows the C++ code step by step, including how the filters treat
+the image borders, so it can stand in for lacosmicx on hosts where the
+extension does not build and serves as a baseline for benchmarks. The
+`run` function takes the same arguments as `lacosmicx.run`.
+
+Select it for every extension with the `cosmicx_backend: numpy` setting,
+or per extension with a `backend : numpy` entry in a cosmicx_cfg file.
+
+Tolerance:
+    Intermediate sums are rounded differently, so cleaned pixel values
+    agree with the C++ backend to float32 rounding, not bit for bit.
+    A cosmic ray mask can only differ where a pixel's Laplacian signal
+    to noise lies within that rounding of sigclip, sigcliplow or
+    objlim. On the synthetic chips of every detector in
+    scripts/benchmarks/benchmark_cosmicx_backends.py the masks are
+    identical. One known difference: the C++ code takes the background
+    level, used for fully flagged 5x5 neighbourhoods, from only the
+    first pixels of the image, while this module uses the lower median
+    of all unmasked pixels.
+"""
+
+import numpy as N
+
+from astropy.io import fits
+from scipy import ndimage
+
+# The 5x5 kernel without corners used to dilate saturated stars.
+DILATE_KERNEL = N.array([[0, 1, 1, 1, 0],
+                         [1, 1, 1, 1, 1],
+                         [1, 1, 1, 1, 1],
+                         [1, 1, 1, 1, 1],
+                         [0, 1, 1, 1, 0]], dtype=bool)
+
+GROW_KERNEL = N.ones((3, 3), dtype=bool)
+
+LAPLACE_KERNEL = N.array([[0, -1, 0],
+                          [-1, 4, -1],
+                          [0, -1, 0]], dtype=N.float32)
+
+# -----------------------------------------------------------------------------
+# Functions (alphabetical)
+# -----------------------------------------------------------------------------
+
+def clean(cleanarr, crmask, backgroundlevel):
+    """ Replace the flagged pixels with the mean of their neighbours.
+
+    Each flagged pixel, except within 2 pixels of the border, is
+    replaced by the mean of the unflagged pixels in the 5x5 box around
+    it, or by the background level if they are all flagged.
+
+    Parameters:
+        cleanarr: numpy array
+            The image, cleaned in place.
+        crmask: numpy array
+            The cosmic ray mask.
+        backgroundlevel: float
+            The value used when no neighbour is unflagged.
+
+    Returns: nothing
+
+    Outputs: nothing
+    """
+
+    good = ~crmask
+    kernel = N.ones((5, 5))
+    total = ndimage.correlate(N.where(good, cleanarr, 0.0).astype(N.float64),
+                              kernel, mode='constant')
+    count = ndimage.correlate(good.astype(N.float64), kernel, mode='constant')
+    replace = crmask.copy()
+    replace[:2, :] = replace[-2:, :] = False
+    replace[:, :2] = replace[:, -2:] = False
+    mean = N.where(count > 0, total / N.maximum(count, 1), backgroundlevel)
+    cleanarr[replace] = mean[replace]
+
+# -----------------------------------------------------------------------------
+
+def copy_border(output, data, width):
+    """ Copy a border of the given width from data into output.
+
+    The C++ filters leave the pixels they can't filter unchanged.
+    """
+
+    output[:width, :] = data[:width, :]
+    output[-width:, :] = data[-width:, :]
+    output[:, :width] = data[:, :width]
+    output[:, -width:] = data[:, -width:]
+    return output
+
+# -----------------------------------------------------------------------------
+
+def find_sat_stars(data, mask, satlevel, robust):
+    """ Return the mask of saturated stars and bad pixels.
+
+    Parameters:
+        data: numpy array
+            The image in electrons.
+        mask: numpy array
+            The input bad pixel mask.
+        satlevel: float
+            The saturation level in electrons.
+        robust: bool
+            Use true medians instead of separable ones.
+
+    Returns:
+        mask: numpy array
+            The dilated saturated stars and the grown input mask.
+
+    Outputs: nothing
+    """
+
+    satpixels = data > satlevel
+    m5 = medfilt(data, 5) if robust else sepmedfilt(data, 5)
+    satpixels &= m5 > satlevel / 10.0
+    dilsatpixels = ndimage.binary_dilation(satpixels, DILATE_KERNEL,
+                                           iterations=2)
+    return dilsatpixels | grow(mask)
+
+# -----------------------------------------------------------------------------
+
+def get_products(cleanarr, robust):
+    """ Return the parts of an iteration that don't depend on the limits.
+
+    The subsampled Laplacian, the noise model median, and the fine
+    structure medians only depend on the image. A parameter sweep can
+    compute them once for the first iteration of every setting.
+
+    Parameters:
+        cleanarr: numpy array
+            The image in electrons.
+        robust: bool
+            Use true medians instead of separable ones.
+
+    Returns:
+        products: dict
+            Has keys 'laplacian', 'm5', 'm3', and 'fmed'.
+
+    Outputs: nothing
+    """
+
+    # Subsample, convolve, clip negative values, and rebin.
+    ny, nx = cleanarr.shape
+    subsam = cleanarr.repeat(2, axis=0).repeat(2, axis=1)
+    conved = ndimage.convolve(subsam, LAPLACE_KERNEL, mode='constant')
+    N.maximum(conved, 0.0, out=conved)
+    laplacian = conved.reshape(ny, 2, nx, 2).mean(axis=(1, 3),
+                                                  dtype=N.float32)
+
+    # The noise model and fine structure medians.
+    m5 = medfilt(cleanarr, 5) if robust else sepmedfilt(cleanarr, 7)
+    m3 = medfilt(cleanarr, 3) if robust else sepmedfilt(cleanarr, 5)
+    fmed = medfilt(m3, 7) if robust else sepmedfilt(m3, 9)
+    return {'laplacian' : laplacian, 'm5' : m5, 'm3' : m3, 'fmed' : fmed}
+
+# -----------------------------------------------------------------------------
+
+def grow(mask):
+    """ Dilate a mask by one pixel, leaving the border unchanged. """
+
+    return copy_border(ndimage.binary_dilation(mask, GROW_KERNEL), mask, 1)
+
+# -----------------------------------------------------------------------------
+
+def iteration(cleanarr, crmask, mask, readnoise, sigclip, sigcliplow,
+              objlim, backgroundlevel, robust, products=None):
+    """ Perform one L.A.Cosmic iteration.
+
+    Parameters:
+        cleanarr: numpy array
+            The image in electrons, cleaned in place.
+        crmask: numpy array
+            The cosmic ray mask, updated in place.
+        mask: numpy array
+            The mask of saturated stars and bad pixels.
+        readnoise: float
+            The read noise in electrons.
+        sigclip, sigcliplow, objlim: float
+            The detection limits.
+        backgroundlevel: float
+            Used to clean fully flagged neighbourhoods.
+        robust: bool
+            Use true medians instead of separable ones.
+        products: dict
+            The get_products of cleanarr, or None to compute them. They
+            are not modified.
+
+    Returns:
+        numcr: int
+            The number of cosmic ray pixels found in this iteration.
+
+    Outputs: nothing
+    """
+
+    if products is None:
+        products = get_products(cleanarr, robust)
+
+    # The noise model.
+    noise = N.sqrt(N.maximum(products['m5'], N.float32(0.0001)) +
+                   N.float32(readnoise * readnoise))
+
+    # The Laplacian signal to noise, without the large structures.
+    s = products['laplacian'] / (2.0 * noise)
+    sp = s - (medfilt(s, 5) if robust else sepmedfilt(s, 7))
+
+    # The fine structure image.
+    f = (products['m3'] - products['fmed']) / noise
+    N.maximum(f, N.float32(0.01), out=f)
+
+    # Candidates, then the neighbours with the relaxed limits.
+    cosmics = (sp > sigclip) & ~mask & ((sp / f) > objlim)
+    growcosmics = (sp > sigclip) & grow(cosmics) & ~mask
+    finalsel = (sp > sigcliplow) & grow(growcosmics) & ~mask
+
+    crmask |= finalsel
+    clean(cleanarr, crmask, backgroundlevel)
+    return int(finalsel.sum())
+
+# -----------------------------------------------------------------------------
+
+def lacosmic(data, mask, sigclip, objlim, sigfrac, satlevel, readnoise,
+             robust, verbose, niter, products=None):
+    """ Run L.A.Cosmic on an image in electrons that includes the sky.
+
+    Parameters:
+        data: numpy array
+            The image in electrons, not modified.
+        mask: numpy array
+            Bad pixels to ignore.
+        sigclip, objlim, sigfrac, satlevel, readnoise, robust, verbose,
+        niter:
+            The L.A.Cosmic parameters, see src/lacosmicx.cpp.
+        products: dict
+            The get_products of data, reused for the first iteration,
+            or None.
+
+    Returns:
+        cleanarr: numpy array
+            The cleaned image in electrons.
+        crmask: numpy array
+            The cosmic ray mask.
+
+    Outputs: nothing
+    """
+
+    good = data[~mask]
+    if good.size == 0:
+        backgroundlevel = 0.0
+    else:
+        backgroundlevel = N.partition(good, (good.size - 1) // 2)[
+            (good.size - 1) // 2]
+    cleanarr = data.copy()
+    crmask = N.zeros(data.shape, dtype=bool)
+
+    mask = find_sat_stars(data, mask, satlevel, robust)
+    for i in range(niter):
+        numcr = iteration(cleanarr, crmask, mask, readnoise, sigclip,
+                          sigclip * sigfrac, objlim, backgroundlevel, robust,
+                          products if i == 0 else None)
+        if verbose:
+            print 'Iteration {0}: {1} cosmic pixels'.format(i + 1, numcr)
+        if numcr == 0:
+            break
+    return cleanarr, crmask
+
+# -----------------------------------------------------------------------------
+
+def medfilt(data, size):
+    """ A size x size median filter leaving the border unchanged. """
+
+    return copy_border(ndimage.median_filter(data, size=size), data,
+                       size // 2)
+
+# -----------------------------------------------------------------------------
+
+def run(inmat, inmask=None, outmaskfile="", sigclip=3.0, objlim=5.0,
+        sigfrac=0.1, satlevel=50000.0, gain=1.0, pssl=0.0, readnoise=6.5,
+        robust=False, verbose=False, niter=4, out=None, copy=True):
+    """ Run L.A.Cosmic on a 2D image and return the cleaned image.
+
+    Takes the same arguments as lacosmicx.run. With copy=False a
+    float32 inmat is scaled in place and scaled back, like the C++
+    engine does.
+
+    Parameters:
+        inmat: numpy array
+            The image in ADU.
+        inmask: numpy array
+            Bad pixels to ignore, or None.
+        outmaskfile: string
+            If not empty, the cosmic ray mask is written to this FITS
+            file.
+        sigclip, objlim, sigfrac, satlevel, gain, pssl, readnoise,
+        robust, verbose, niter:
+            The L.A.Cosmic parameters, see src/lacosmicx.cpp.
+        out: numpy array
+            A float32 array of the same shape for the result, or None.
+        copy: bool
+            Work on a copy of inmat.
+
+    Returns:
+        cleanarray: numpy array
+            The cosmic ray rejected image in ADU.
+
+    Outputs:
+        The mask FITS file if outmaskfile is set.
+    """
+
+    if not isinstance(inmat, N.ndarray):
+        raise TypeError('In inmat, matrix argument is not *NumPy* array')
+    if inmask is None:
+        inmask = N.zeros(inmat.shape, dtype=bool)
+    elif not isinstance(inmask, N.ndarray):
+        raise TypeError('In inmask, matrix argument is not *NumPy* array')
+    if copy:
+        data = N.array(inmat, dtype=N.float32)
+    else:
+        data = N.ascontiguousarray(inmat, dtype=N.float32)
+    mask = N.array(inmask, dtype=bool)
+
+    # Work with the sky and in electrons, like the C++ code.
+    data += pssl
+    data *= gain
+
+    cleanarr, crmask = lacosmic(data, mask, sigclip, objlim, sigfrac,
+                                satlevel, readnoise, robust, verbose, niter)
+
+    # Convert back to ADU and subtract the sky again.
+    data /= gain
+    data -= pssl
+    cleanarr /= gain
+    cleanarr -= pssl
+
+    if outmaskfile != "":
+        fits.writeto(outmaskfile, crmask.astype(N.uint8), clobber=True)
+
+    if out is None:
+        return cleanarr
+    out[...] = cleanarr
+    return out
+
+# -----------------------------------------------------------------------------
+
+def sepmedfilt(data, size):
+    """ A separable size x size median filter leaving the border unchanged.
+
+    The rows are filtered first and the result is filtered along the
+    columns, like the sepmedfilt functions in src/functions.cpp.
+    """
+
+    rowmed = ndimage.median_filter(data, size=(1, size))
+    return copy_border(ndimage.median_filter(rowmed, size=(size, 1)), data,
+                       size // 2)
@@ -5,20 +5,42 @@ Created on May 26, 2011
 '''
 import _lacosmicx
 import numpy
-def run(inmat,inmask=None,outmaskfile="",sigclip=3.0,objlim=5.0,sigfrac=0.1,satlevel=50000.0,gain=1.0,pssl=0.0,readnoise=6.5,robust=False,verbose=False,niter=4):
-    # .... Check arguments, double NumPy matrices?
-    test=numpy.zeros((2,2)) # create a NumPy matrix as a test object to check matin
-    typetest= type(test) # get its type  
-    if type(inmat) != typetest:
+import threading
+
+# One engine per thread, an engine keeps its working arrays between calls
+# and can't be shared by threads running at the same time.
+_local = threading.local()
+
+def get_engine():
+    '''
+    Return the _lacosmicx.Engine of the calling thread.
+    '''
+    if not hasattr(_local, 'engine'):
+        _local.engine = _lacosmicx.Engine()
+    return _local.engine
+
+def run(inmat,inmask=None,outmaskfile="",sigclip=3.0,objlim=5.0,sigfrac=0.1,satlevel=50000.0,gain=1.0,pssl=0.0,readnoise=6.5,robust=False,verbose=False,niter=4,out=None,copy=True):
+    '''
+    Run L.A.Cosmic on a 2D image and return the cleaned image.
+
+    With copy=False a C-contiguous float32 inmat and bool inmask are used
+    in place: inmat is scaled by gain and pssl and scaled back, and inmask
+    is replaced by the mask of saturated stars and bad pixels. Arrays of
+    another type or layout are still converted. The result is written to
+    out, a float32 array of the same shape, when it is given.
+    '''
+    if not isinstance(inmat, numpy.ndarray):
         raise TypeError('In inmat, matrix argument is not *NumPy* array')
     if inmask is None:
-        inmask=numpy.zeros(inmat.shape)
-    if type(inmask) != typetest:
+        inmask=numpy.zeros(inmat.shape, dtype=numpy.bool_)
+    elif not isinstance(inmask, numpy.ndarray):
         raise TypeError('In inmask, matrix argument is not *NumPy* array')
-    this_shape=inmat.shape
-    nx=this_shape[1]
-    ny=this_shape[0]
-    inmat=numpy.cast["float32"](inmat.ravel())
-    inmask=numpy.cast["bool"](inmask.ravel())
-    outmat=_lacosmicx.pyrun(inmat,inmask,outmaskfile,nx,ny,sigclip,objlim,sigfrac,satlevel,gain,pssl,readnoise,robust,verbose,niter)
-    return outmat.reshape(this_shape)
+    elif copy:
+        inmask=numpy.array(inmask, dtype=numpy.bool_)
+    if copy:
+        inmat=numpy.array(inmat, dtype=numpy.float32)
+    inmat=numpy.ascontiguousarray(inmat, dtype=numpy.float32)
+    inmask=numpy.ascontiguousarray(inmask, dtype=numpy.bool_)
+    if out is None:
+        out=numpy.empty(inmat.shape, dtype=numpy.float32)
+    return get_engine().run(inmat,inmask,out,outmaskfile,sigclip,objlim,sigfrac,satlevel,gain,pssl,readnoise,robust,verbose,niter)
@@ -0,0 +1,268 @@
+#! /usr/bin/env python
+
+'''
+Histograms and quantiles of the stretched PNGs, for checking the
+stretches of every image.
+
+With stat_switch, run_trim.render_pngs describes every 8 bit image it
+writes with a record of get_image_stats: the 256 bin histogram of the
+image, the levels of its QUANTILES, the data values mapped to black
+and white, the counts of NaN and threshold clipped pixels, counted
+while the image is stretched and left None for the extra stretches,
+which clip at their own limits, and the QUANTILES of the data from the
+sample the extra stretches use. These all come from the 8 bit image
+in memory and the chunks of the stretch, so they cost a small fraction
+of the PNG compression and can stay on for every image.
+
+The records are appended to `png_stats.jsonl`, one JSON record per
+line, and their summary without the histogram to `png_stats.csv`, in
+the `png_stats_path` folder, or the PNG folder. The plots are an
+offline report made from the records:
+
+    >>> python png_stats.py -stats '/path/to/png/png_stats.jsonl' \
+            -output_path /path/to/report
+'''
+
+import argparse
+import csv
+import fcntl
+import glob
+import json
+import os
+import time
+
+import numpy as N
+
+from mtpipeline.get_settings import SETTINGS
+from mtpipeline.imaging.stretches import CHUNK_ROWS
+
+# The fractions of the pixels below the quantiles in the records.
+QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+
+# The columns of the .csv summary, followed by the quantile levels
+# q<percent> and data quantiles data_q<percent>.
+CSV_COLUMNS = ['created', 'fits_file', 'png_name', 'suffix', 'height',
+               'width', 'low', 'high', 'pixels', 'nan_count',
+               'below_minimum', 'above_maximum', 'black', 'white',
+               'mean_level']
+
+# -----------------------------------------------------------------------------
+# Functions (alphabetical)
+# -----------------------------------------------------------------------------
+
+def append_stats(stats_name, records):
+    '''
+    Append records to the .jsonl and .csv files of stats_name, see
+    get_stats_name. The files are locked while they are written, so
+    the png stage processes can share them. The .csv header is written
+    with the first records.
+    '''
+    if not records:
+        return
+    for extension in ['.jsonl', '.csv']:
+        with open(stats_name + extension, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if extension == '.jsonl':
+                    for record in records:
+                        f.write(json.dumps(record, sort_keys=True) + '\n')
+                else:
+                    columns = get_csv_columns()
+                    writer = csv.writer(f)
+                    f.seek(0, os.SEEK_END)
+                    if f.tell() == 0:
+                        writer.writerow(columns)
+                    for record in records:
+                        row = flatten_record(record)
+                        writer.writerow([row[column] for column in columns])
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+# -----------------------------------------------------------------------------
+
+def flatten_record(record):
+    '''
+    Return the .csv row of a record as a dictionary of CSV_COLUMNS and
+    the quantile columns.
+    '''
+    row = {column : record[column] for column in CSV_COLUMNS
+           if column not in ['height', 'width']}
+    row['height'], row['width'] = record['shape']
+    for quantile in QUANTILES:
+        key = format_quantile(quantile)
+        row['q' + key] = record['quantile_levels'][key]
+        row['data_q' + key] = record['data_quantiles'].get(key)
+    return row
+
+# -----------------------------------------------------------------------------
+
+def format_quantile(quantile):
+    '''
+    Return the key of a quantile in the records, its percent.
+    '''
+    return '{0:g}'.format(quantile * 100)
+
+# -----------------------------------------------------------------------------
+
+def get_csv_columns():
+    '''
+    Return all the columns of the .csv summary.
+    '''
+    keys = [format_quantile(quantile) for quantile in QUANTILES]
+    return CSV_COLUMNS + ['q' + key for key in keys] + \
+        ['data_q' + key for key in keys]
+
+# -----------------------------------------------------------------------------
+
+def get_image_stats(image, fits_file, png_name, suffix, limits,
+        clip_counts=None, sample=None):
+    '''
+    Return the statistics record of one 8 bit image.
+
+    Parameters:
+        image : N.ndarray
+            The uint8 image.
+        fits_file : string
+            The FITS file the image was made from.
+        png_name : string
+            The PNG of the image.
+        suffix : string
+            The stretch suffix of the PNG name, e.g. linscale.
+        limits : tuple
+            The data values mapped to black and white.
+        clip_counts : dict
+            The 'nan_count', 'below_minimum' and 'above_maximum' pixels
+            of the data, see run_trim.stretch_to_uint8, or None to leave
+            them None.
+        sample : N.ndarray
+            The sorted sample of the finite data the data quantiles are
+            taken from, see stretches.get_sample.
+
+    Returns:
+        record : dict
+            The statistics, see the module docstring.
+
+    Outputs:
+        nothing
+    '''
+    assert isinstance(image, N.ndarray), 'image must be numpy array'
+    assert image.dtype == N.uint8, 'Expected a uint8 image, got ' + \
+        str(image.dtype)
+    clip_counts = clip_counts or {}
+    # Counted in chunks, as bincount copies its input to intp.
+    histogram = N.zeros(256, dtype=N.intp)
+    for start in range(0, image.shape[0], CHUNK_ROWS):
+        histogram += N.bincount(image[start:start + CHUNK_ROWS].ravel(),
+                                minlength=256)
+    cumulative = N.cumsum(histogram)
+    pixels = int(cumulative[-1])
+    record = {'created' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'fits_file' : os.path.basename(fits_file),
+              'png_name' : os.path.basename(png_name),
+              'suffix' : suffix,
+              'shape' : list(image.shape),
+              'low' : float(limits[0]),
+              'high' : float(limits[1]),
+              'pixels' : pixels,
+              'nan_count' : clip_counts.get('nan_count'),
+              'below_minimum' : clip_counts.get('below_minimum'),
+              'above_maximum' : clip_counts.get('above_maximum'),
+              'black' : int(histogram[0]),
+              'white' : int(histogram[255]),
+              'mean_level' : float(N.dot(histogram, N.arange(256))) /
+                             max(pixels, 1),
+              'histogram' : histogram.tolist(),
+              'quantile_levels' : {},
+              'data_quantiles' : {}}
+    for quantile in QUANTILES:
+        key = format_quantile(quantile)
+        record['quantile_levels'][key] = int(
+            N.searchsorted(cumulative, quantile * pixels))
+        if sample is not None and sample.size:
+            record['data_quantiles'][key] = float(
+                sample[int((sample.size - 1) * quantile)])
+    return record
+
+# -----------------------------------------------------------------------------
+
+def get_stats_name(output_path):
+    '''
+    Return the path of the statistics files without their extension,
+    in the `png_stats_path` setting folder or output_path.
+    '''
+    return os.path.join(SETTINGS.get('png_stats_path') or output_path,
+                        'png_stats')
+
+# -----------------------------------------------------------------------------
+
+def plot_report(records, output_path):
+    '''
+    Plot the histogram of every record, with its quantile levels, as a
+    `<png root>_stats.png` in output_path. Needs matplotlib, which the
+    png stage doesn't.
+    '''
+    import matplotlib
+    matplotlib.use('agg')
+    import matplotlib.pyplot as plt
+
+    if not os.path.isdir(output_path):
+        os.makedirs(output_path)
+    for record in records:
+        figure, axes = plt.subplots(figsize=(8, 4))
+        axes.bar(N.arange(256), N.maximum(record['histogram'], 0.5),
+                 width=1.0, log=True, color='0.3', align='edge')
+        for key, level in sorted(record['quantile_levels'].items(),
+                                 key=lambda item: float(item[0])):
+            axes.axvline(level, color='r', linewidth=0.5)
+            axes.text(level, axes.get_ylim()[1], key, color='r',
+                      fontsize=6, va='top')
+        axes.set_xlim(0, 256)
+        axes.set_xlabel('8 bit level ({0:.3g} to {1:.3g})'.format(
+            record['low'], record['high']))
+        axes.set_ylabel('Pixels')
+        axes.set_title('{0}: {1} NaN, {2} below, {3} above the clip'.format(
+            record['png_name'], record['nan_count'], record['below_minimum'],
+            record['above_maximum']), fontsize=8)
+        figure.savefig(os.path.join(output_path, os.path.splitext(
+            record['png_name'])[0] + '_stats.png'))
+        plt.close(figure)
+
+# -----------------------------------------------------------------------------
+
+def read_stats(stats_file):
+    '''
+    Return the records of a .jsonl statistics file.
+    '''
+    with open(stats_file, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+# -----------------------------------------------------------------------------
+# For command line execution.
+# -----------------------------------------------------------------------------
+
+def parse_args():
+    '''
+    Parse the command line arguments.
+    '''
+    parser = argparse.ArgumentParser(
+        description = 'Plot the histograms of the PNG statistics records.')
+    parser.add_argument(
+        '-stats',
+        required = True,
+        help = 'Search string for png_stats.jsonl files. Wildcards accepted.')
+    parser.add_argument(
+        '-output_path',
+        required = True,
+        help = 'Folder of the plots.')
+    args = parser.parse_args()
+    return args
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    args = parse_args()
+    stats_list = glob.glob(args.stats)
+    assert stats_list != [], 'Found no files matching ' + args.stats
+    for stats_file in stats_list:
+        plot_report(read_stats(stats_file), args.output_path)
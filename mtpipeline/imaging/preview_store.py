@@ -0,0 +1,373 @@
+#! /usr/bin/env python
+
+'''
+Compact previews of the drizzled products for re-stretching the PNGs.
+
+The png stage can save a preview of every drizzled product it renders:
+the image in its FITS orientation as a .npy file, float32 by default,
+optionally block averaged, next to a JSON file with the statistics of
+the full precision, full resolution image: the finite count, extremes,
+mean and std of all its pixels, and the percentiles of a strided
+sample of about stretches.SAMPLE_SIZE of them, taken as the preview is
+written from the chunks the PNGs are stretched from. The previews are no larger than the drizzled image, without
+its other extensions, or half of it as float16, and are memory mapped
+when read, so the PNGs of a whole archive can be rendered again with
+another stretch without reading the FITS files:
+
+    >>> python preview_store.py -filelist '/path/to/png/*_preview.npy' \
+            -minimum 0.001 -maximum 5e4
+
+float16 holds values up to 65504 with three significant digits, which
+is plenty for an 8 bit stretch. Pixels beyond that range are clipped
+to it in the preview, so the PNGs of a float16 preview are scaled to
+the extremes of the data clipped the same way, and differ from the
+originals when the image is brighter than 65504. The statistics keep
+the true extremes.
+'''
+
+import argparse
+import glob
+import json
+import logging
+import os
+
+from multiprocessing.pool import ThreadPool
+
+import numpy as N
+
+from mtpipeline.get_settings import SETTINGS
+from mtpipeline.imaging import png_stats
+from mtpipeline.imaging.clipping import get_order_statistics
+from mtpipeline.imaging.run_trim import CHUNK_ROWS
+from mtpipeline.imaging.run_trim import THRESHOLD_MAXIMUM
+from mtpipeline.imaging.run_trim import THRESHOLD_MINIMUM
+from mtpipeline.imaging.run_trim import get_fits_data
+from mtpipeline.imaging.run_trim import render_pngs
+from mtpipeline.imaging.run_trim import wait_for_pngs
+from mtpipeline.imaging.stretches import SAMPLE_SIZE
+
+# The percentiles of the finite pixels in the statistics.
+PERCENTILES = [0.1, 1, 5, 25, 50, 75, 95, 99, 99.9]
+
+# -----------------------------------------------------------------------------
+# Functions (alphabetical)
+# -----------------------------------------------------------------------------
+
+def block_average(chunk, block):
+    '''
+    Return the block x block means of a float32 chunk, dropping the
+    last rows and columns that don't fill a block.
+    '''
+    if block == 1:
+        return chunk
+    rows, columns = chunk.shape[0] // block, chunk.shape[1] // block
+    chunk = chunk[:rows * block, :columns * block]
+    return chunk.reshape((rows, block, columns, block)).mean(axis=(1, 3))
+
+# -----------------------------------------------------------------------------
+
+def get_preview_names(output_path, filename):
+    '''
+    Return the .npy and .json preview file names of a drizzled FITS
+    file, in the PNG folder output_path.
+    '''
+    root = os.path.splitext(os.path.basename(filename))[0]
+    root = os.path.join(output_path, root + '_preview')
+    return root + '.npy', root + '.json'
+
+# -----------------------------------------------------------------------------
+
+def read_preview(preview_name):
+    '''
+    Return the memory mapped preview array and the statistics of a
+    .npy preview file.
+    '''
+    data = N.load(preview_name, mmap_mode='r')
+    with open(os.path.splitext(preview_name)[0] + '.json', 'r') as f:
+        stats = json.load(f)
+    return data, stats
+
+# -----------------------------------------------------------------------------
+
+def rerender_previews(preview_list, output_path=None, log_switch=True,
+        minimum=THRESHOLD_MINIMUM, maximum=THRESHOLD_MAXIMUM, threads=None,
+        stretch_list=None):
+    '''
+    Render the PNGs of every preview again with new threshold clip
+    limits, under the names of the PNGs of their FITS files. Like the
+    png stage, the tiles, thumbnails and statistics are made again when
+    the `png_tiles`, `png_thumbnails` and `png_stats` settings are on.
+    Block averaged previews would replace the PNGs with smaller ones,
+    so only previews of block 1 are rendered.
+
+    Parameters:
+        preview_list : list
+            The .npy preview files.
+        output_path : string
+            The folder of the new PNGs. Defaults to the folder of each
+            preview.
+        log_switch : bool
+            Also write the log scaled PNGs.
+        minimum, maximum : float
+            The threshold clip limits.
+        threads : int
+            The number of PNG writing threads. Defaults to the
+            `png_threads` setting, or 4.
+        stretch_list : list
+            The names of extra stretches, see
+            mtpipeline.imaging.stretches.
+
+    Returns:
+        nothing
+
+    Outputs:
+        The PNG files, tile manifests, and statistics records.
+    '''
+    pool = ThreadPool(processes = threads or SETTINGS.get('png_threads') or 4)
+    try:
+        for preview_name in preview_list:
+            logging.info('Rerendering {0}'.format(preview_name))
+            data, stats = read_preview(preview_name)
+            assert stats['block'] == 1, \
+                'Can\'t rerender the block {0} preview {1}'.format(
+                    stats['block'], preview_name)
+            # Scaled to the extremes of the full precision data, clipped
+            # like the preview, so its clipped pixels stay white.
+            limit = float(N.finfo(data.dtype).max)
+            data_range = (max(stats['minimum'], -limit),
+                          min(stats['maximum'], limit))
+            path = output_path or os.path.dirname(os.path.abspath(preview_name))
+            if SETTINGS.get('png_stats'):
+                stats_name = png_stats.get_stats_name(path)
+            else:
+                stats_name = None
+            # Wait for each preview, so only one is in memory at a time.
+            wait_for_pngs(render_pngs(data, path, str(stats['fits_file']),
+                                      log_switch = log_switch, pool = pool,
+                                      stats_name = stats_name,
+                                      tile_switch = bool(
+                                          SETTINGS.get('png_tiles')),
+                                      thumbnail_switch = bool(
+                                          SETTINGS.get('png_thumbnails')),
+                                      minimum = minimum, maximum = maximum,
+                                      data_range = data_range,
+                                      stretch_list = stretch_list))
+    finally:
+        pool.close()
+        pool.join()
+
+# -----------------------------------------------------------------------------
+
+def write_preview(filename, output_path, dtype=None, block=None):
+    '''
+    Write the preview and statistics of a drizzled FITS file with a
+    PreviewWriter. The data is memory mapped and converted CHUNK_ROWS
+    rows at a time. The png stage writes its previews from the chunks
+    of the stretch instead, see run_trim.run_trim.
+
+    Parameters:
+        filename : string
+            The drizzled FITS file.
+        output_path : string
+            The PNG folder the preview is written to.
+        dtype : string
+            The preview type, see PreviewWriter.
+        block : int
+            The block size, see PreviewWriter.
+
+    Returns:
+        stats : dict
+            The statistics written to the .json file.
+
+    Outputs:
+        The .npy preview and .json statistics files.
+    '''
+    data = get_fits_data(filename, flip=False, memmap=True)
+    writer = PreviewWriter(filename, output_path, data.shape, dtype = dtype,
+                           block = block)
+    for start in range(0, data.shape[0], CHUNK_ROWS):
+        writer.add_chunk(N.array(data[start:start + CHUNK_ROWS],
+                                 dtype=N.float32))
+    return writer.close()
+
+# -----------------------------------------------------------------------------
+# Preview Class
+# -----------------------------------------------------------------------------
+
+class PreviewWriter(object):
+    '''
+    Writes the preview and statistics of a drizzled FITS file from the
+    float32 chunks of its data, given in order, so the preview can be
+    made in the chunk loop of run_trim.stretch_to_uint8 without reading
+    the file again. The percentiles are those of the float32 data on
+    the grid of stretches.get_sample, collected from the chunks. Rows
+    that don't fill a block are kept for the next chunk.
+    '''
+    def __init__(self, filename, output_path, shape, dtype=None, block=None):
+        '''
+        Open the temporary .npy preview.
+
+        Parameters:
+            filename : string
+                The drizzled FITS file.
+            output_path : string
+                The PNG folder the preview is written to.
+            shape : tuple
+                The shape of the data.
+            dtype : string
+                The preview type, float32 or float16. Defaults to the
+                `preview_dtype` setting, or float32.
+            block : int
+                Block average block x block pixels. Defaults to the
+                `preview_block` setting, or 1.
+        '''
+        self.dtype = N.dtype(dtype or SETTINGS.get('preview_dtype') or
+                             'float32')
+        self.block = block or SETTINGS.get('preview_block') or 1
+        assert self.dtype in [N.float16, N.float32], \
+            'preview dtype must be float16 or float32, got ' + str(self.dtype)
+        self.filename = filename
+        self.shape = tuple(shape)
+        self.preview_name, self.stats_name = get_preview_names(output_path,
+                                                               filename)
+        self.preview_shape = (self.shape[0] // self.block,
+                              self.shape[1] // self.block)
+        self.tmp = self.preview_name + '.tmp.npy'
+        self.preview = N.lib.format.open_memmap(
+            self.tmp, mode='w+', dtype=self.dtype, shape=self.preview_shape)
+        self.limit = N.finfo(self.dtype).max
+        self.stride = max(1, int(N.sqrt(
+            self.shape[0] * self.shape[1] / float(SAMPLE_SIZE))))
+        self.row = 0
+        self.rest = None
+        self.total, self.total_squares, self.count = 0.0, 0.0, 0
+        self.extremes = []
+        self.samples = []
+
+    def add_chunk(self, chunk):
+        '''
+        Add the next rows of the data, a float32 chunk, which is not
+        changed.
+        '''
+        sample = chunk[(-self.row) % self.stride::self.stride,
+                       ::self.stride].ravel()
+        self.samples.append(sample[N.isfinite(sample)])
+        finite = chunk[N.isfinite(chunk)].astype(N.float64)
+        if finite.size:
+            self.total += finite.sum()
+            self.total_squares += N.dot(finite, finite)
+            self.count += finite.size
+            self.extremes.extend([finite.min(), finite.max()])
+        self.row += chunk.shape[0]
+        if self.rest is not None:
+            chunk = N.concatenate([self.rest, chunk])
+        rows = chunk.shape[0] // self.block * self.block
+        # Copied, as the caller goes on to change its chunk.
+        self.rest = chunk[rows:].copy() if rows < chunk.shape[0] else None
+        if rows:
+            start = (self.row - chunk.shape[0]) // self.block
+            chunk = block_average(chunk[:rows], self.block)
+            self.preview[start:start + chunk.shape[0]] = N.clip(
+                chunk, -self.limit, self.limit)
+
+    def close(self):
+        '''
+        Move the preview into place and write the statistics.
+
+        Returns:
+            stats : dict
+                The statistics written to the .json file.
+        '''
+        assert self.row == self.shape[0], \
+            'Got {0} of the {1} rows of {2}'.format(self.row, self.shape[0],
+                                                     self.filename)
+        self.preview.flush()
+        self.preview = None
+        os.rename(self.tmp, self.preview_name)
+
+        count = self.count
+        sample = N.concatenate(self.samples)
+        stats = {'fits_file' : os.path.basename(self.filename),
+                 'shape' : list(self.shape),
+                 'preview_shape' : list(self.preview_shape),
+                 'preview_dtype' : str(self.dtype),
+                 'block' : self.block,
+                 'finite_count' : count,
+                 'minimum' : float(min(self.extremes)) if count else None,
+                 'maximum' : float(max(self.extremes)) if count else None,
+                 'mean' : self.total / count if count else None,
+                 'std' : float(N.sqrt(max(self.total_squares / count -
+                                          (self.total / count) ** 2, 0.0)))
+                         if count else None,
+                 'sample_count' : sample.size,
+                 'percentiles' : {}}
+        if sample.size:
+            values = get_order_statistics(
+                sample, [min(int(sample.size * percentile / 100.),
+                             sample.size - 1) for percentile in PERCENTILES])
+            stats['percentiles'] = {str(percentile) : float(value) for
+                                    percentile, value in zip(PERCENTILES,
+                                                             values)}
+        tmp = self.stats_name + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(stats, f, indent=4, sort_keys=True)
+        os.rename(tmp, self.stats_name)
+        return stats
+
+# -----------------------------------------------------------------------------
+# For command line execution.
+# -----------------------------------------------------------------------------
+
+def parse_args():
+    '''
+    Parse the command line arguments.
+    '''
+    parser = argparse.ArgumentParser(
+        description = 'Render the PNGs again from the saved previews.')
+    parser.add_argument(
+        '-filelist',
+        required = True,
+        help = 'Search string for *_preview.npy files. Wildcards accepted.')
+    parser.add_argument(
+        '-output_path',
+        required = False,
+        default = None,
+        help = 'Folder of the new PNGs. Default is the preview folder.')
+    parser.add_argument(
+        '-minimum',
+        required = False,
+        type = float,
+        default = THRESHOLD_MINIMUM,
+        help = 'Threshold clip minimum. Default is {}.'.format(
+            THRESHOLD_MINIMUM))
+    parser.add_argument(
+        '-maximum',
+        required = False,
+        type = float,
+        default = THRESHOLD_MAXIMUM,
+        help = 'Threshold clip maximum. Default is {}.'.format(
+            THRESHOLD_MAXIMUM))
+    parser.add_argument(
+        '-nolog',
+        required = False,
+        action = 'store_true',
+        help = 'Skip the log scaled PNGs.')
+    parser.add_argument(
+        '-stretches',
+        required = False,
+        nargs = '*',
+        default = [],
+        help = 'Extra stretches, e.g. asinh zscale.')
+    args = parser.parse_args()
+    return args
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    args = parse_args()
+    preview_list = glob.glob(args.filelist)
+    assert preview_list != [], 'Found no files matching ' + args.filelist
+    rerender_previews(preview_list, args.output_path,
+                      log_switch = not args.nolog,
+                      minimum = args.minimum, maximum = args.maximum,
+                      stretch_list = args.stretches)
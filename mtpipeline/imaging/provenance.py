@@ -0,0 +1,272 @@
+"""Provenance manifests for the imaging pipeline outputs.
+
+Every input file gets a small JSON manifest next to its outputs that
+records, for each pipeline stage, the checksums of the stage inputs, a
+hash of the stage parameters, the pipeline version, and when the stage
+ran. With this information a stage only needs to be rerun when one of
+its inputs, its parameters, or the pipeline version changed, instead
+of whenever `-reproc` is set.
+
+For FITS files the checksum covers the data units of the image
+extensions only. The drizzle stage edits the headers of both of its
+inputs, the original c0m/flt file and its cosmic ray rejected copy,
+and updatewcs (or wcs_cache.apply_solution) appends the distortion and
+WCS table extensions of wcs_extensions.WCS_EXTNAMES to them, so a
+checksum of the whole file, or of every data unit, would change every
+time the drizzle stage runs and would mark the cosmic ray rejection
+stage as out of date. The size and modification time of each input are
+also recorded, and the checksum is only recomputed when one of them
+changed.
+"""
+
+import datetime
+import hashlib
+import json
+import os
+
+from astropy.io import fits
+from mtpipeline.get_settings import SETTINGS
+from mtpipeline.imaging.wcs_extensions import WCS_EXTNAMES
+
+# -----------------------------------------------------------------------------
+# Functions (alphabetical)
+# -----------------------------------------------------------------------------
+
+def get_checksum(filename):
+    """Return the md5 checksum of a file.
+
+    For FITS files only the data units of the extensions not in
+    wcs_extensions.WCS_EXTNAMES are hashed, see the module docstring.
+    For all other files the whole file is hashed.
+
+    Parameters:
+        filename : string
+            The path to the file.
+
+    Returns:
+        checksum : string
+            The hexadecimal md5 digest.
+
+    Outputs:
+        nothing
+    """
+    md5 = hashlib.md5()
+    if os.path.splitext(filename)[1] == '.fits':
+        with fits.open(filename, mode='readonly', memmap=True,
+                       do_not_scale_image_data=True) as hdulist:
+            for hdu in hdulist:
+                if hdu.name in WCS_EXTNAMES:
+                    continue
+                if hdu.data is not None:
+                    md5.update(hdu.data.tostring())
+    else:
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), ''):
+                md5.update(block)
+    return md5.hexdigest()
+
+# -----------------------------------------------------------------------------
+
+def get_file_record(filename, previous=None):
+    """Return a dictionary describing the current state of a file.
+
+    Parameters:
+        filename : string
+            The path to the file.
+        previous : dict
+            An earlier record for the same file. If the size and
+            modification time have not changed its checksum is reused.
+
+    Returns:
+        record : dict
+            Has keys 'path', 'size', 'mtime', and 'checksum'.
+
+    Outputs:
+        nothing
+    """
+    stat = os.stat(filename)
+    record = {'path' : os.path.abspath(filename),
+              'size' : stat.st_size,
+              'mtime' : stat.st_mtime}
+    if previous is not None and \
+            previous['size'] == record['size'] and \
+            previous['mtime'] == record['mtime']:
+        record['checksum'] = previous['checksum']
+    else:
+        record['checksum'] = get_checksum(filename)
+    return record
+
+# -----------------------------------------------------------------------------
+
+def hash_params(params):
+    """Return a stable md5 hash of a dictionary of stage parameters.
+
+    Parameters:
+        params : dict
+            Any JSON serializable dictionary. Values that are not
+            serializable are hashed by their string representation.
+
+    Returns:
+        params_hash : string
+            The hexadecimal md5 digest.
+
+    Outputs:
+        nothing
+    """
+    text = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.md5(text).hexdigest()
+
+# -----------------------------------------------------------------------------
+
+def is_current(manifest, stage, inputs, params_hash):
+    """Check if a stage is up to date according to a manifest.
+
+    Parameters:
+        manifest : dict
+            A manifest as returned by read_manifest.
+        stage : string
+            The stage name, e.g. 'cr_reject'.
+        inputs : list
+            The input files of the stage.
+        params_hash : string
+            The hash of the current stage parameters.
+
+    Returns:
+        current : bool
+            True if the stage was run with the same parameters,
+            pipeline version, and input data, else False.
+
+    Outputs:
+        nothing
+    """
+    record = manifest['stages'].get(stage)
+    if record is None:
+        return False
+    if record['params_hash'] != params_hash:
+        return False
+    if record['code_version'] != str(SETTINGS['version']):
+        return False
+    previous_inputs = {item['path'] : item for item in record['inputs']}
+    if sorted(previous_inputs) != \
+            sorted(os.path.abspath(filename) for filename in inputs):
+        return False
+    for filename in inputs:
+        if not os.path.exists(filename):
+            return False
+        previous = previous_inputs[os.path.abspath(filename)]
+        if get_file_record(filename, previous)['checksum'] != \
+                previous['checksum']:
+            return False
+    return True
+
+# -----------------------------------------------------------------------------
+
+def make_manifest_name(output_file_dict):
+    """Return the manifest filename for a set of pipeline outputs.
+
+    Parameters:
+        output_file_dict : dict
+            As returned by imaging_pipeline.make_output_file_dict.
+
+    Returns:
+        manifest_name : string
+            The weight file name with `_wht.fits` replaced by
+            `_provenance.json`.
+
+    Outputs:
+        nothing
+    """
+    weight_file = output_file_dict['drizzle_weight'][0]
+    assert weight_file.endswith('_wht.fits'), \
+        'Unexpected weight file name ' + weight_file
+    return weight_file[:-len('_wht.fits')] + '_provenance.json'
+
+# -----------------------------------------------------------------------------
+
+def read_manifest(manifest_name):
+    """Read a manifest, returning an empty manifest if there is none.
+
+    Parameters:
+        manifest_name : string
+            The path to the JSON manifest.
+
+    Returns:
+        manifest : dict
+            A dictionary with a 'stages' key holding one record per
+            stage.
+
+    Outputs:
+        nothing
+    """
+    if not os.path.exists(manifest_name):
+        return {'stages' : {}}
+    with open(manifest_name, 'r') as f:
+        return json.load(f)
+
+# -----------------------------------------------------------------------------
+
+def record_stage(manifest_name, stage, inputs, outputs, params_hash,
+        started):
+    """Write the provenance record of a completed stage.
+
+    The input checksums are taken after the stage has run so that any
+    changes the stage made to its own inputs are part of the record.
+
+    Parameters:
+        manifest_name : string
+            The path to the JSON manifest.
+        stage : string
+            The stage name, e.g. 'cr_reject'.
+        inputs : list
+            The input files of the stage.
+        outputs : list
+            The output files of the stage.
+        params_hash : string
+            The hash of the stage parameters.
+        started : datetime.datetime
+            When the stage started.
+
+    Returns:
+        nothing
+
+    Outputs:
+        The updated JSON manifest.
+    """
+    manifest = read_manifest(manifest_name)
+    previous = manifest['stages'].get(stage, {'inputs' : []})
+    previous_inputs = {item['path'] : item for item in previous['inputs']}
+    manifest['stages'][stage] = {
+        'inputs' : [get_file_record(filename,
+                        previous_inputs.get(os.path.abspath(filename)))
+                    for filename in inputs],
+        'outputs' : [os.path.abspath(filename) for filename in outputs],
+        'params_hash' : params_hash,
+        'code_version' : str(SETTINGS['version']),
+        'started' : started.isoformat(),
+        'completed' : datetime.datetime.now().isoformat()}
+    write_manifest(manifest_name, manifest)
+
+# -----------------------------------------------------------------------------
+
+def write_manifest(manifest_name, manifest):
+    """Write a manifest to disk.
+
+    The manifest is written to a temporary file that is renamed over
+    the old manifest, so a crash never leaves a partial manifest.
+
+    Parameters:
+        manifest_name : string
+            The path to the JSON manifest.
+        manifest : dict
+            The manifest to write.
+
+    Returns:
+        nothing
+
+    Outputs:
+        The JSON manifest.
+    """
+    temp_name = '{0}.{1}.tmp'.format(manifest_name, os.getpid())
+    with open(temp_name, 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.rename(temp_name, manifest_name)
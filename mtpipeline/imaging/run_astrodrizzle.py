@@ -1,8 +1,17 @@
 #! /usr/env/bin python
 '''
 A script to run Astrodrizzle.
+
+Every AstroDrizzle call runs in its own scratch directory, with links
+to its input files, so runs for files in the same folder can't rename
+or delete each other's outputs. The scratch directories are made in
+the folder of the outputs, or under the `drizzle_scratch` setting
+(e.g. a local disk or tmpfs). The wanted outputs are moved into place
+with an atomic rename once they are complete, and the scratch
+directory is removed with everything else AstroDrizzle wrote.
 '''
 import argparse
+import errno
 from drizzlepac import astrodrizzle
 from astropy.io import fits
 import glob
@@ -10,11 +19,59 @@ import inspect
 import os
 import string
 import shutil
+import tempfile
+
+from mtpipeline.bulk_copy import bulk_copy
+from mtpipeline.database.header_catalog import get_header
+from mtpipeline.database.header_catalog import record_header
+from mtpipeline.fits_reader import cards_from_header
+from mtpipeline.get_settings import SETTINGS
+
+# The keywords copied from the input into the AstroDrizzle outputs when
+# AstroDrizzle dropped them. DATE-OBS is always copied.
+REPAIR_KEYWORDS = ['DATE-OBS', 'TIME-OBS', 'PROPOSID', 'LINENUM', 'TARGNAME',
+                   'RA_TARG', 'DEC_TARG', 'FILTNAM1']
 
 # ------------------------------------------------------------------------------
 # Low-level Functions (alphabetical)
 # ------------------------------------------------------------------------------
 
+def finalize_output(output, filename, dateobs):
+    """ Repair the header of an AstroDrizzle output in one open and flush.
+
+    AstroDrizzle removes DATE-OBS, which is needed for the database and
+    ephemeris later, and can drop other keywords of its input. This puts
+    DATE-OBS back and copies the missing REPAIR_KEYWORDS from the input.
+
+    Parameters:
+        output: string
+            The AstroDrizzle output.
+        filename: string
+            The _flt or _c0m input of the AstroDrizzle run.
+        dateobs: string
+            The value of the dateobs keyword from the original _flt or
+            _c0m file.
+
+    Returns:
+        header: HeaderCards
+            The cards of the repaired primary header.
+
+    Outputs:
+        The AstroDrizzle output file, with the repaired header.
+    """
+
+    source = get_header(filename, keywords=REPAIR_KEYWORDS)
+    with fits.open(output, mode='update') as hdulist:
+        header = hdulist[0].header
+        header['DATE-OBS'] = dateobs
+        for keyword in REPAIR_KEYWORDS:
+            if keyword not in header and keyword in source:
+                header[keyword] = source[keyword]
+        cards = cards_from_header(header)
+    return cards
+
+# ------------------------------------------------------------------------------
+
 def get_archive_file_list(target):
     '''
     Get a list of the absolute paths to the fits files located in
@@ -34,6 +91,49 @@ def get_archive_file_list(target):
 
 # ------------------------------------------------------------------------------
 
+def get_config_file(detector):
+    '''
+    Return the path to the AstroDrizzle configuration file for a
+    detector.
+    '''
+    cfg_path = os.path.realpath(__file__)
+    if '.pyc' in cfg_path:
+        cfg_path = cfg_path.replace('/mtpipeline/imaging/run_astrodrizzle.pyc',
+                                '/astrodrizzle_cfg/')
+    else:
+        cfg_path = cfg_path.replace('/mtpipeline/imaging/run_astrodrizzle.py',
+                                '/astrodrizzle_cfg/')
+
+    config_sets = {'WFPC2' : 'wfpc2_wideslice.cfg',
+                   'WFC' : 'acs_wide.cfg',
+                   'HRC' : 'acs_hrc_wide.cfg',
+                   'SBC' : 'acs_wide.cfg',
+                   'UVIS':'wfc3_wide.cfg',
+                   'IR': 'wfc3_ir_wide.cfg'
+                  }
+
+    config_file = os.path.join(cfg_path, config_sets[detector])
+    return config_file
+
+# ------------------------------------------------------------------------------
+
+def get_drizzle_outputs(scratch, output):
+    '''
+    Return the (scratch file, final file) pairs of the single_sci and
+    single_wht outputs of the AstroDrizzle run in the scratch directory.
+    Only one exposure is drizzled in a scratch directory, so exactly one
+    of each is expected.
+    '''
+    sci_list = glob.glob(os.path.join(scratch, '*single_sci.fits'))
+    wht_list = glob.glob(os.path.join(scratch, '*single_wht.fits'))
+    assert len(sci_list) == 1 and len(wht_list) == 1, \
+        'Expected one single_sci and single_wht file in {0}, got {1}'.format(
+            scratch, sci_list + wht_list)
+    wht_output = output.replace('_sci','_wht').replace('_img','_wht')
+    return [(sci_list[0], output), (wht_list[0], wht_output)]
+
+# ------------------------------------------------------------------------------
+
 def get_file_list(target):
     '''
     Get the local list of files.
@@ -46,112 +146,107 @@ def get_file_list(target):
     
 # ------------------------------------------------------------------------------
 
-def insert_dateobs(output, dateobs):
-    """ Put the DATE-OBS keyword back into the AstroDrizzle outputs.
-    AstroDrizzle removes this keyword, and it is needed for the database and
-    ephemeris later. 
-
-    Parameters: 
-        output: string
-                The renamed AstroDrizzle output the DATE-OBS keyword needs to be
-                put back into.
-        dateobs: string
-                 The value of the dateobs keyword from the original _flt or _c0m
-                 file.
-
-    Returns: nothing
+def link_inputs(filename, scratch):
+    '''
+    Link an input file, and the c1m.fits data quality file of a
+    c0m.fits file, into a scratch directory. The edits AstroDrizzle
+    makes to its inputs go through the links to the original files,
+    unless a file has to be rewritten, which only replaces the link.
+    Returns the name of the linked input.
+    '''
+    filename = os.path.abspath(filename)
+    input_list = [filename]
+    if filename[-8:] == 'c0m.fits':
+        dq_file = filename.replace('_c0m.fits', '_c1m.fits')
+        if os.path.exists(dq_file):
+            input_list.append(dq_file)
+    for src in input_list:
+        os.symlink(src, os.path.join(scratch, os.path.basename(src)))
+    return os.path.basename(filename)
 
-    Outputs:
-        The AstroDrizzle output file, edited to include DATE-OBS.
-    """
+# ------------------------------------------------------------------------------
 
-    # Since we are changing only a single keyword, using the convenience
-    # function is permissible.
-    fits.setval(filename = output,
-                keyword = 'date-obs',
-                value = dateobs)
+def make_scratch_dir(output):
+    '''
+    Make a private scratch directory for one AstroDrizzle run, under
+    the `drizzle_scratch` setting or else next to the output.
+    '''
+    scratch_root = SETTINGS.get('drizzle_scratch') or \
+        os.path.dirname(os.path.abspath(output))
+    if not os.path.isdir(scratch_root):
+        os.makedirs(scratch_root)
+    prefix = '.drizzle_' + os.path.basename(output).split('.')[0] + '_'
+    return tempfile.mkdtemp(prefix=prefix, dir=scratch_root)
 
 # ------------------------------------------------------------------------------
     
 def move_files(target, file_list, recopy_switch):
     '''
-    Move the files.
+    Copy the archive files to the drizzled area of the target. Files
+    whose copy is current are skipped, see mtpipeline.bulk_copy.
     '''
     target = target.lower()
-       
     dst_root = os.path.join('/astro/3/mutchler/mt/drizzled', target)
-    if os.access(dst_root, os.F_OK) == False:
-        os.mkdir(dst_root)
-        
-    for filename in file_list:
-        rootname = os.path.basename(filename)
-        dst = os.path.join(dst_root, rootname)
-        if os.access(dst, os.F_OK) != True or recopy_switch == True:
-            print 'Copying: ' + filename + ' -> ' + dst
-            shutil.copyfile(filename, dst)
+    bulk_copy(file_list, dst_root, recopy_switch=recopy_switch)
 
 # ------------------------------------------------------------------------------
 
-def rename_files(rootfile, output):
+def move_into_place(src, dst):
     '''
-    Rename all desirable files that match the root of the filename input 
-    paramater, excluding the input filename itself. Remove all other
-    AstroDrizzle outputs.
-    '''
-    print 'Renaming and removing files:'
-    
-    rootfile = os.path.abspath(rootfile)
-
-    # Remove unwanted AstroDrizzle outputs
-    search = rootfile[:-8] + '*mask*'
-    bad_list = glob.glob(search)
-    search = rootfile[:-8] + '*c0m_d2im*'
-    bad_list = bad_list + glob.glob(search)
-    for filename in bad_list:
-        print "Removing " ,filename
-        os.remove(filename)
-
-    # Find the wanted files
-    search = rootfile[:-8] + '*single_sci.fits'
-    sci_list = glob.glob(search)
-    search = rootfile[:-8] + '*single_wht.fits'
-    wht_list = glob.glob(search)
-    # Loop over the wanted files and rename.
-    for filename in sci_list:
-        print "Renaming ",filename, " to ",output
-        os.rename(filename,output)
-    for filename in wht_list:
-        output = output.replace('_sci','_wht')
-        output = output.replace('_img','_wht')
-        print "Renaming ",filename, " to ",output
-        os.rename(filename,output)
-
-# ------------------------------------------------------------------------------
-
-def run_astrodrizzle(filename, output, detector, dateobs):
-    '''
-    Executes astrodrizzle.AstroDrizzle.
+    Move a finished file to its final name so that it appears there
+    complete or not at all. Across file systems the file is first
+    copied next to dst and then renamed.
     '''
-    cfg_path = os.path.realpath(__file__)
-    if '.pyc' in cfg_path:
-        cfg_path = cfg_path.replace('/mtpipeline/imaging/run_astrodrizzle.pyc',
-                                '/astrodrizzle_cfg/')
-    else:
-        cfg_path = cfg_path.replace('/mtpipeline/imaging/run_astrodrizzle.py',
-                                '/astrodrizzle_cfg/')
+    print "Renaming ",src, " to ",dst
+    try:
+        os.rename(src, dst)
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+        tmp = tempfile.NamedTemporaryFile(
+            prefix='.' + os.path.basename(dst) + '_',
+            dir=os.path.dirname(os.path.abspath(dst)), delete=False)
+        tmp.close()
+        try:
+            shutil.copy2(src, tmp.name)
+            os.rename(tmp.name, dst)
+        except:
+            os.remove(tmp.name)
+            raise
 
-    config_sets = {'WFPC2' : 'wfpc2_wideslice.cfg',
-                   'WFC' : 'acs_wide.cfg',
-                   'HRC' : 'acs_hrc_wide.cfg',
-                   'SBC' : 'acs_wide.cfg',
-                   'UVIS':'wfc3_wide.cfg',
-                   'IR': 'wfc3_ir_wide.cfg'
-                  }
+# ------------------------------------------------------------------------------
 
-    config_file = os.path.join(cfg_path, config_sets[detector])
-    astrodrizzle.AstroDrizzle(input = filename, configobj = config_file)
-    rename_files(filename, output)
-    insert_dateobs(output, dateobs)
+def run_astrodrizzle(filename, output, detector, dateobs, keep_weight=True):
+    '''
+    Executes astrodrizzle.AstroDrizzle in a private scratch directory,
+    repairs the header of the single_sci output, and moves it and, with
+    keep_weight, the single_wht output into place. The repaired header
+    is added to the header catalog, so the later stages and the ephem
+    scripts only skip reading the output when the `header_catalog`
+    setting is configured.
+    '''
+    config_file = get_config_file(detector)
+    scratch = make_scratch_dir(output)
+    cwd = os.getcwd()
+    try:
+        linked_input = link_inputs(filename, scratch)
+        # AstroDrizzle writes some of its files, e.g. the static mask and
+        # the log, to the working directory.
+        os.chdir(scratch)
+        try:
+            astrodrizzle.AstroDrizzle(input = linked_input,
+                                      configobj = config_file)
+        finally:
+            os.chdir(cwd)
+        drizzle_outputs = get_drizzle_outputs(scratch, output)
+        if not keep_weight:
+            drizzle_outputs = drizzle_outputs[:1]
+        header = finalize_output(drizzle_outputs[0][0], filename, dateobs)
+        for src, dst in drizzle_outputs:
+            move_into_place(src, dst)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    record_header(output, header)
             
 # ------------------------------------------------------------------------------
 # The main controller. 
@@ -5,18 +5,100 @@
 
 import os
 import shutil
-import inspect
 import glob
-import yaml
 
-import lacosmicx
+import numpy as N
 from astropy.io import fits
-
+from multiprocessing.pool import ThreadPool
+from mtpipeline.get_settings import SETTINGS
+from mtpipeline.imaging import cosmicx_registry
+from mtpipeline.imaging import lacosmic_numpy
+
+try:
+    import lacosmicx
+except ImportError:
+    # The _lacosmicx extension is not built, only the numpy backend works.
+    lacosmicx = None
+
+# The cosmic ray rejection engines, selected with the `backend` key of an
+# extension in the cosmicx_cfg files or the `cosmicx_backend` setting.
+BACKENDS = {'lacosmicx' : lacosmicx,
+            'numpy' : lacosmic_numpy}
+
+# How far, in pixels, a pixel can influence the result through one
+# L.A.Cosmic iteration: the 7x7 median of the Laplacian signal to noise
+# on top of its 7x7 noise model median, two 3x3 grow steps, and the 5x5
+# cleaning window.
+ITERATION_REACH = 10
+
+# The reach of the saturated star mask: a 5 pixel median, two 5x5
+# dilations, and one 3x3 grow step.
+SATSTAR_REACH = 7
+
+# The (process id, chip_threads, pool) of the chip thread pool of this
+# process, see get_chip_pool.
+_CHIP_POOL = (None, None, None)
 
 # -----------------------------------------------------------------------------
 # Functions (alphabetical)
 # -----------------------------------------------------------------------------
 
+def clean_extension(job):
+    """ Run lacosmicx on the data of a single FITS extension or tile.
+
+    The _lacosmicx extension releases the GIL while it runs, so this
+    can be called from several threads at once. Each thread reuses its
+    own lacosmicx engine.
+
+    Parameters:
+        job: tuple
+            The extension key, the data array, the cosmicx parameters
+            for the extension, and the tile to clean as returned by
+            get_tiles, or None to clean the whole array.
+
+    Returns:
+        key_tile_cleanarray: tuple
+            The extension key, the tile, and the cosmic ray rejected
+            array. For a tile the array covers the tile and its halo.
+
+    Outputs: nothing
+    """
+
+    key, array, params, tile = job
+
+    backend = BACKENDS[params.get('backend', 'lacosmicx')]
+    assert backend is not None, \
+        'The _lacosmicx extension is not built, use the numpy backend.'
+
+    inmask = params['inmask']
+    if tile is None:
+        # The whole array can be used in place.
+        copy = False
+    else:
+        array = array[tile[0]]
+        if inmask is not None:
+            inmask = inmask[tile[0]]
+        copy = True
+
+    cleanarray = backend.run(array,
+               inmask=inmask,
+               outmaskfile=params['outmaskfile'],
+               pssl=params['pssl'],
+               gain=params['gain'],
+               readnoise=params['readnoise'],
+               sigclip=params['sigclip'],
+               sigfrac=params['sigfrac'],
+               objlim=params['objlim'],
+               satlevel=params['satlevel'],
+               robust=params['robust'],
+               verbose=params['verbose'],
+               niter=params['niter'],
+               copy=copy)
+
+    return key, tile, cleanarray
+
+# -----------------------------------------------------------------------------
+
 def get_file_list(search_string):
     """ Generates a list of files matching the given glob string
 
@@ -36,68 +118,129 @@ def get_file_list(search_string):
 
 # -----------------------------------------------------------------------------
 
+def get_chip_pool(chip_threads):
+    """ Return the chip thread pool of this process.
+
+    The pool lives as long as the process, so its threads, and the
+    lacosmicx engine each thread keeps with its working arrays, are
+    reused by every file. It is made again with another chip_threads,
+    and in a forked child, which doesn't inherit the threads.
+    """
+    global _CHIP_POOL
+    pid, threads, pool = _CHIP_POOL
+    if pid != os.getpid() or threads != chip_threads:
+        if pid == os.getpid():
+            pool.close()
+        pool = ThreadPool(processes=chip_threads)
+        _CHIP_POOL = (os.getpid(), chip_threads, pool)
+    return pool
+
+# -----------------------------------------------------------------------------
+
 def get_cosmicx_params(header_data):
-    """ Accesses the cosmicx configure file and returns the parameters.
-    
+    """ Returns the cosmicx parameters for an image.
+
+    The parameters come from the cosmicx registry, which loads the
+    cosmicx_cfg files once per process.
+
     Parameters:
-        instrument: string
-            The intrument for the image. Can be 'WFPC2', 'WFC3', 'ACS'
         header_data: dictionary
-                Dictionary containing information from FITS header
+                Dictionary containing information from FITS header,
+                with keys 'detector', 'readnoise', and 'gain'.
 
     Returns:
         cosmicx_params: dict
-            A list of dictionaries, with one dictionary for each FITS 
-            extension. Each dictionary has the cosmicx parameters appropriate
-            for that extension. If the extension is not a science extension,
-            the list has None, instead of a dictionary, for that extension.
+            A dictionary of dictionaries, with one dictionary for each
+            FITS science extension. Each dictionary has the cosmicx
+            parameters appropriate for that extension. The header
+            readnoise and gain, if any, override the configured values.
+            The dictionaries are copies that can be changed freely.
 
     """
 
+    return cosmicx_registry.get_params(header_data['detector'],
+                                       readnoise=header_data['readnoise'],
+                                       gain=header_data['gain'])
 
-    detector_config = { 'WFPC2' : "WFPC2_params.yaml",
-                        'HRC' : "HRC_params.yaml",
-                        'SBC' : "SBC_params.yaml",
-                        'WFC' : "WFC_params.yaml",
-                        'UVIS' : "UVIS_params.yaml",
-                        'IR' : "IR_params.yaml" }
+# -----------------------------------------------------------------------------
 
-    detector = header_data["detector"]
-    readnoise = header_data["readnoise"]
-    gain = header_data["gain"]
+def get_tile_halo(params):
+    """ Return the halo width needed to tile an image.
 
-    # Load the configuration file for the proper detector:
-    config_file = detector_config[detector]
+    Cleaning a tile with this much of the surrounding image around it
+    gives the same result in the tile as cleaning the whole image,
+    except through the background level, which lacosmicx takes as the
+    median of the image it is given. That level is only used for cosmic
+    rays larger than 5x5 pixels.
 
-    # os.path.dirname is called three times to move up three directories
-    # from this file, to reach to where the cosmicx_cfg directory is located.
-    param_path = os.path.dirname(os.path.dirname(os.path.dirname(
-                 os.path.abspath(inspect.getfile(inspect.currentframe())))))
-    param_path = os.path.join(param_path,'cosmicx_cfg')
-    param_path = os.path.join(param_path, config_file)
+    Parameters:
+        params: dictionary
+            The cosmicx settings of the extension.
 
-    cosmicx_params = yaml.load(open(param_path))
+    Returns:
+        halo: int
+            The halo width in pixels.
 
-    # If we have readnoise and gain from the FITS header, override the 
-    # manually specified values from the cfg file:
-    if readnoise:
-        for extension_key in cosmicx_params:
-            cosmicx_params[extension_key]["readnoise"] = readnoise
-    if gain:
-        for extension_key in cosmicx_params:
-            cosmicx_params[extension_key]["gain"] = gain
+    Outputs: nothing
+    """
 
-    return cosmicx_params 
+    return ITERATION_REACH * params['niter'] + SATSTAR_REACH
 
 # -----------------------------------------------------------------------------
 
+def get_tiles(shape, tile_size, halo):
+    """ Split an image into tiles with overlapping halos.
 
-def run_cosmicx(filename, output, cosmicx_params, detector):
+    Parameters:
+        shape: tuple
+            The shape of the image.
+        tile_size: int
+            The width and height of the tiles, without the halo. Tiles
+            at the top and right edges may be smaller.
+        halo: int
+            The width of the halo around each tile. The halo is cut at
+            the image edges.
+
+    Returns:
+        tiles: list
+            One (outer, inner, inner_local) tuple of slice pairs per
+            tile. outer selects the tile and its halo from the image,
+            inner the tile itself, and inner_local the tile from the
+            outer region.
+
+    Outputs: nothing
+    """
+
+    ny, nx = shape
+    tiles = []
+    for y0 in range(0, ny, tile_size):
+        y1 = min(y0 + tile_size, ny)
+        outer_y0, outer_y1 = max(y0 - halo, 0), min(y1 + halo, ny)
+        for x0 in range(0, nx, tile_size):
+            x1 = min(x0 + tile_size, nx)
+            outer_x0, outer_x1 = max(x0 - halo, 0), min(x1 + halo, nx)
+            tiles.append(((slice(outer_y0, outer_y1), slice(outer_x0, outer_x1)),
+                          (slice(y0, y1), slice(x0, x1)),
+                          (slice(y0 - outer_y0, y1 - outer_y0),
+                           slice(x0 - outer_x0, x1 - outer_x0))))
+    return tiles
+
+# -----------------------------------------------------------------------------
+
+def run_cosmicx(filename, output, cosmicx_params, detector,
+                chip_threads=None, tile_size=None):
     """ Driver to run lacosmicx on multi-extension FITS files.
 
     An equivalent to the run_cosmics function in run_cosmiscs.py,
     borrowing much of its code. Performs cosmic-ray rejection on each
-    chip of a FITS file.
+    chip of a FITS file. The chips are cleaned at the same time on the
+    thread pool of get_chip_pool, which is kept between files.
+
+    Chips larger than tile_size are cleaned in tiles with a halo wide
+    enough that the tiles can be stitched back together, see
+    get_tile_halo. The tiles are cleaned on the same thread pool, and
+    the lacosmicx working memory is bounded by the tile size instead of
+    the chip size.
 
     Parameters:
         filename: string
@@ -111,6 +254,13 @@ def run_cosmicx(filename, output, cosmicx_params, detector):
         detector: string
             the detector used to take the FITS image. If SBC or IR,
             cr rejection is not run.
+        chip_threads: int
+            the number of chips or tiles cleaned at the same time.
+            Defaults to the `cosmicx_chip_threads` setting, or 1 if it
+            is not set or empty.
+        tile_size: int
+            the tile width and height. Defaults to the
+            `cosmicx_tile_size` setting. 0 or None cleans whole chips.
 
     Returns: nothing
 
@@ -138,8 +288,16 @@ def run_cosmicx(filename, output, cosmicx_params, detector):
     if query == True:
         os.remove(output)
 
+    if chip_threads is None:
+        chip_threads = SETTINGS.get('cosmicx_chip_threads') or 1
+    if tile_size is None:
+        tile_size = SETTINGS.get('cosmicx_tile_size')
+
     with fits.open(filename, mode='readonly') as HDUlist:
-        
+
+        # Read all the data before starting any threads, astropy reads
+        # the extensions lazily from a shared file handle.
+        jobs = []
         for key in cosmicx_params:
             
             params = cosmicx_params[key]
@@ -164,21 +322,24 @@ def run_cosmicx(filename, output, cosmicx_params, detector):
             # are already bad pixels
             array[array < -10.0] = 0.0
 
-            cleanarray = lacosmicx.run(array,
-                       inmask=params['inmask'],
-                       outmaskfile=params['outmaskfile'],
-                       pssl=params['pssl'],
-                       gain=params['gain'],
-                       readnoise=params['readnoise'],
-                       sigclip=params['sigclip'],
-                       sigfrac=params['sigfrac'],
-                       objlim=params['objlim'],
-                       satlevel=params['satlevel'],
-                       robust=params['robust'],
-                       verbose=params['verbose'],
-                       niter=params['niter'] )
-
-            HDU.data = cleanarray
+            # A mask file can't be written per tile.
+            if tile_size and max(array.shape) > tile_size and \
+                    params['outmaskfile'] == '':
+                for tile in get_tiles(array.shape, tile_size,
+                                      get_tile_halo(params)):
+                    jobs.append((key, array, params, tile))
+                HDU.data = N.empty(array.shape, dtype=N.float32)
+            else:
+                jobs.append((key, array, params, None))
+
+        if chip_threads > 1 and len(jobs) > 1:
+            results = get_chip_pool(chip_threads).imap_unordered(
+                clean_extension, jobs)
+            for key, tile, cleanarray in results:
+                stitch(HDUlist[key], tile, cleanarray)
+        else:
+            for job in jobs:
+                stitch(HDUlist[job[0]], *clean_extension(job)[1:])
 
         HDUlist.writeto(output)
 
@@ -210,3 +371,27 @@ def make_c1m_link(filename, output):
         if query == True:
             os.remove(dst)
         os.symlink(src, dst)
+
+# -----------------------------------------------------------------------------
+
+def stitch(HDU, tile, cleanarray):
+    """ Put a cleaned chip or tile into an HDU.
+
+    Parameters:
+        HDU: astropy HDU
+            The HDU of the chip.
+        tile: tuple
+            The tile as returned by get_tiles, or None for a whole chip.
+        cleanarray: numpy array
+            The cleaned chip, or the cleaned tile and its halo.
+
+    Returns: nothing
+
+    Outputs: nothing
+    """
+
+    if tile is None:
+        HDU.data = cleanarray
+    else:
+        outer, inner, inner_local = tile
+        HDU.data[inner] = cleanarray[inner_local]
@@ -6,7 +6,6 @@ Scales the images and produces the output images.
 
 # Standard modules
 import argparse
-import copy
 import glob
 import logging
 import numpy as N
@@ -14,24 +13,44 @@ import os
 import pyfits
 import time
 
+from multiprocessing.pool import ThreadPool
 from PIL import Image
 
 
 # Custom modules
-from display_tools import before_after
+from mtpipeline.imaging.clipping import clip_in_place
+from mtpipeline.imaging.clipping import get_order_statistics
+from mtpipeline.imaging.clipping import get_percentile_limits
+from mtpipeline.imaging import png_stats
+from mtpipeline.imaging import tile_pyramid
+from mtpipeline.imaging.stretches import CHUNK_ROWS
+from mtpipeline.imaging.stretches import STRETCHES
+from mtpipeline.imaging.stretches import apply_stretches
+from mtpipeline.imaging.stretches import get_sample
+from mtpipeline.get_settings import SETTINGS
 
 logger = logging.getLogger('mtpipeline.run_trim')
 
+# The threshold_clip limits used for all the PNG outputs.
+THRESHOLD_MINIMUM = 0.0001
+THRESHOLD_MAXIMUM = 2e5
+
+# The default longest side of the thumbnails, see the `thumbnail_size`
+# setting, and the file extension of each `thumbnail_format`.
+THUMBNAIL_SIZE = 128
+THUMBNAIL_EXTENSIONS = {'jpeg' : '.jpg', 'png' : '.png'}
+
 
 # -----------------------------------------------------------------------------
 # Low-Level Functions: Image Manipulation, etc.
 # -----------------------------------------------------------------------------
 
-def clip(input_array, clip_val, top_or_bottom, output=False):
+def clip(input_array, clip_val, top_or_bottom, output=False, out=None):
     '''
     Clip an input numpy array and set the clipped pixels to the
     clipping value. Bottom clip scales pixels below the clip_val.
-    Top does the same for pixels above.
+    Top does the same for pixels above. The result goes into a new
+    array, or into out, which can be input_array to clip in place.
     '''
     # Input validation
     error = 'input_array for clip must be a numpy array instance.'
@@ -41,15 +60,24 @@ def clip(input_array, clip_val, top_or_bottom, output=False):
     error = 'top_or_bottom for clip must be "top" or "bottom".'
     assert top_or_bottom in ['top', 'bottom'], error
 
+    if output != False and out is input_array:
+        before_array = input_array.copy()
+    else:
+        before_array = input_array
+    if out is None:
+        output_array = input_array.copy()
+    else:
+        output_array = out
+        if out is not input_array:
+            output_array[...] = input_array
     if top_or_bottom == 'bottom':
-        index = N.where(input_array < clip_val)
+        clip_in_place(output_array, minimum=clip_val)
     elif top_or_bottom == 'top':
-        index = N.where(input_array > clip_val)
-    output_array = copy.deepcopy(input_array)
-    output_array[index] = clip_val
+        clip_in_place(output_array, maximum=clip_val)
     if output != False:
+        from display_tools import before_after
         before_after(
-            before_array = input_array,
+            before_array = before_array,
             after_array = output_array,
             before_array_name = 'Input Data',
             after_array_name = 'Clip ' + top_or_bottom + ' at ' + str(clip_val),
@@ -58,13 +86,24 @@ def clip(input_array, clip_val, top_or_bottom, output=False):
 
 # -----------------------------------------------------------------------------
 
-def get_fits_data(filename, ext=0):
+def get_fits_data(filename, ext=0, dtype=None, flip=True, memmap=False):
     '''
-    Return the data from the extention as a numpy array.
+    Return the data from the extention as a numpy array, converted to
+    dtype if given. With flip the array is flipped "up-down" as a view.
+    With memmap the data is a read only memory map of the file, so only
+    the pages in use are in memory, unless a dtype conversion or
+    BSCALE/BZERO scaling forces a read.
     '''
     assert os.path.splitext(filename)[1] == '.fits', 'Inputs must be FITS file.'
-    data = pyfits.getdata(filename)
-    data = N.flipud(data)
+    if memmap:
+        with pyfits.open(filename, memmap=True, mode='denywrite') as hdulist:
+            data = hdulist[ext].data
+    else:
+        data = pyfits.getdata(filename, ext)
+    if dtype is not None and data.dtype != dtype:
+        data = data.astype(dtype)
+    if flip:
+        data = N.flipud(data)
     return data
 
 # -----------------------------------------------------------------------------
@@ -79,13 +118,10 @@ def get_value_by_pixel_count(input_array, pixel_number ,top_or_bottom):
     assert isinstance(pixel_number, int)
     error = 'top_or_bottom for get_value_by_pixel_count must be "top" or "bottom".'
     assert top_or_bottom in ['top', 'bottom'], error
-    sorted_array = copy.deepcopy(input_array)
-    sorted_array = sorted_array.ravel()
-    sorted_array.sort()
     if top_or_bottom == 'top':
-        output = sorted_array[pixel_number]
+        output = get_order_statistics(input_array, [pixel_number])[0]
     elif top_or_bottom == 'bottom':
-        output = sorted_array[pixel_number - 1]
+        output = get_order_statistics(input_array, [pixel_number - 1])[0]
     output = float(output)
     return output
 
@@ -102,6 +138,96 @@ def make_png_name(path, filename, ext):
 
 # -----------------------------------------------------------------------------
 
+def make_thumbnail_name(png_name):
+    '''
+    Return the path of the thumbnail of a PNG: the PNG name with the
+    extension of the `thumbnail_format` setting (default jpeg), in the
+    thumbnails folder next to the PNG.
+    '''
+    extension = THUMBNAIL_EXTENSIONS[SETTINGS.get('thumbnail_format') or 'jpeg']
+    root = os.path.splitext(os.path.basename(png_name))[0]
+    return os.path.join(os.path.dirname(png_name), 'thumbnails',
+                        root + extension)
+
+# -----------------------------------------------------------------------------
+
+def stretch_to_uint8(data, log_switch=True, flip=True,
+        minimum=THRESHOLD_MINIMUM, maximum=THRESHOLD_MAXIMUM, data_range=None,
+        clip_counts=None, preview=None):
+    '''
+    Return the linear and log scaled 8 bit images of data, like
+    PNGCreator threshold_clip, log, and compress followed by save_png.
+    The data is read CHUNK_ROWS rows at a time and converted to
+    float32, clipped, and scaled into the 8 bit images, so data can be
+    a memory map and the only float temporaries are chunks. The
+    clipping and the log don't change the order of the pixels, so the
+    scaling limits are the clipped (and logged) minimum and maximum of
+    data.
+
+    Parameters:
+        data : N.ndarray
+            The image, not changed.
+        log_switch : bool
+            Also make the log scaled image.
+        flip : bool
+            Flip the images "up-down", by filling them bottom up.
+        minimum, maximum : float
+            The threshold clip limits.
+        data_range : tuple
+            The minimum and maximum of the data, if known, e.g. for a
+            reduced precision copy of the data.
+        clip_counts : dict
+            If given, the 'nan_count', 'below_minimum' and
+            'above_maximum' pixels of the data are counted into it
+            before they are clipped, see png_stats.
+        preview : preview_store.PreviewWriter
+            If given, every float32 chunk is added to it before it is
+            clipped.
+
+    Returns:
+        images : list
+            The linear and, with log_switch, the log uint8 images.
+
+    Outputs:
+        nothing
+    '''
+    assert isinstance(data, N.ndarray), 'data must be numpy array'
+    if data_range is None:
+        data_range = [data.min(), data.max()]
+    limits = N.array(data_range, dtype=N.float32)
+    clip_in_place(limits, minimum, maximum)
+    limit_list = [limits]
+    if log_switch:
+        limit_list.append(N.log(limits))
+    images = [N.empty(data.shape, dtype=N.uint8) for limits in limit_list]
+    if flip:
+        views = [image[::-1] for image in images]
+    else:
+        views = images
+    if clip_counts is not None:
+        for key in ['nan_count', 'below_minimum', 'above_maximum']:
+            clip_counts[key] = 0
+    for start in range(0, data.shape[0], CHUNK_ROWS):
+        chunk = N.array(data[start:start + CHUNK_ROWS], dtype=N.float32)
+        if clip_counts is not None:
+            with N.errstate(invalid='ignore'):
+                clip_counts['nan_count'] += N.count_nonzero(N.isnan(chunk))
+                clip_counts['below_minimum'] += N.count_nonzero(chunk < minimum)
+                clip_counts['above_maximum'] += N.count_nonzero(chunk > maximum)
+        if preview is not None:
+            preview.add_chunk(chunk)
+        clip_in_place(chunk, minimum, maximum)
+        for index, (view, limits) in enumerate(zip(views, limit_list)):
+            if index == 1:
+                N.log(chunk, out=chunk)
+            scaled = chunk - limits[0]
+            scaled /= limits[1] - limits[0]
+            scaled *= 255.
+            view[start:start + CHUNK_ROWS] = scaled
+    return images
+
+# -----------------------------------------------------------------------------
+
 def subarray(array, xmin, xmax, ymin, ymax):
     '''
     Returns a subarray.
@@ -123,20 +249,63 @@ def subarray(array, xmin, xmax, ymin, ymax):
 
 # -----------------------------------------------------------------------------
 
+def wait_for_pngs(pending):
+    '''
+    Wait for the PNG writes returned by render_pngs when it was given
+    a pool, raising the first error of a write.
+    '''
+    for result in pending:
+        result.get()
+
+# -----------------------------------------------------------------------------
+
+def write_thumbnail(data, thumbnail_name):
+    '''
+    Write a 2D uint8 array shrunk to fit in a square of the
+    `thumbnail_size` setting (default 128 pixels), keeping its aspect
+    ratio, as a JPEG or PNG depending on the thumbnail_name extension.
+    The thumbnail folder must exist. Like write_png this can run in
+    several threads at once.
+    '''
+    assert isinstance(data, N.ndarray), 'data must be numpy array'
+    assert data.dtype == N.uint8, 'Expected uint8 got ' + str(data.dtype)
+    size = SETTINGS.get('thumbnail_size') or THUMBNAIL_SIZE
+    image = Image.fromarray(N.ascontiguousarray(data), 'L')
+    image.thumbnail((size, size), Image.ANTIALIAS)
+    if os.path.splitext(thumbnail_name)[1] == '.jpg':
+        image.save(thumbnail_name, 'JPEG', quality = 90)
+    else:
+        image.save(thumbnail_name, 'PNG')
+
+# -----------------------------------------------------------------------------
+
+def write_png(data, png_name):
+    '''
+    Write a 2D uint8 array as a grey scale PNG. A C contiguous array is
+    handed to PIL without a copy. The zlib level and strategy are the
+    `png_compress_level` (0-9, default 6) and `png_compress_type`
+    (0 default, 1 filtered, 2 huffman only, 3 rle) settings. PIL
+    releases the GIL while compressing, so PNGs can be written by
+    several threads at once.
+    '''
+    assert isinstance(data, N.ndarray), 'data must be numpy array'
+    assert data.dtype == N.uint8, 'Expected uint8 got ' + str(data.dtype)
+    compress_level = SETTINGS.get('png_compress_level')
+    compress_type = SETTINGS.get('png_compress_type')
+    image = Image.fromarray(N.ascontiguousarray(data), 'L')
+    image.save(png_name, 'PNG',
+               compress_level = 6 if compress_level is None else compress_level,
+               compress_type = 0 if compress_type is None else compress_type)
+
+# -----------------------------------------------------------------------------
+
 def top_bottom_clip(array):
     '''
     Clip the top and bottom 1% of pixels.
     '''
     assert isinstance(array, N.ndarray), 'array must be numpy array'
-    sorted_array = copy.copy(array)
-    sorted_array = sorted_array.ravel()
-    sorted_array.sort()
-    top = sorted_array[int(len(sorted_array) * 0.99)]
-    bottom = sorted_array[int(len(sorted_array) * 0.01)]
-    top_index = N.where(array > top)
-    array[top_index] = top
-    bottom_index = N.where(array < bottom)
-    array[bottom_index] = bottom
+    bottom, top = get_percentile_limits(array, 0.01, 0.99)
+    clip_in_place(array, bottom, top)
     return array
 
 # -----------------------------------------------------------------------------
@@ -152,21 +321,33 @@ class PNGCreator(object):
     pointer, by using the deepcopy fucntion. In this way you can create
     a new instance of the PNGCreator class on the self.data attribute
     of another class to make changes that will not affect the other
-    class instance.
+    class instance. With copy=False the instance works on the array
+    it was given, e.g. to trim and save views of one 8 bit image.
     '''
-    def __init__(self, data):
+    def __init__(self, data, copy=True):
         '''
         Check the input type on instantiation.
         '''
-        self.data = copy.deepcopy(data)
         assert isinstance(data, N.ndarray), 'Expected N.ndarray got ' + str(type(data))
+        if copy:
+            data = N.array(data, copy=True)
+        self.data = data
+
+    def as_float(self):
+        '''
+        Convert self.data to float, so the in place operations keep
+        the fractions. Float arrays are left as they are.
+        '''
+        if self.data.dtype.kind != 'f':
+            self.data = self.data.astype(N.float64)
 
     def bottom_clip(self, output=False):
         '''
         Clip the bottom 10 pixels from the self.data attribute.
         '''
         bottom_value = get_value_by_pixel_count(self.data, 10, 'bottom')
-        self.data = clip(self.data, bottom_value, 'bottom', output = output)
+        self.data = clip(self.data, bottom_value, 'bottom', output = output,
+                         out = self.data)
 
     def compress(self):
         '''
@@ -176,24 +357,28 @@ class PNGCreator(object):
         trimming to ensure that the trimmed images all have the same
         stretch.
         '''
-        self.data = self.data - self.data.min()
-        self.data = (self.data / self.data.max()) * 255.
+        self.as_float()
+        self.data -= self.data.min()
+        self.data /= self.data.max()
+        self.data *= 255.
 
     def log(self, output=False):
         '''
         Take the log of self.data.
         '''
-        array_log = N.log(self.data)
+        if output != False:
+            before_array = self.data.copy()
+        self.as_float()
+        N.log(self.data, out=self.data)
 
         if output != False:
-            before_after(before_array = self.data,
-                after_array = array_log,
+            from display_tools import before_after
+            before_after(before_array = before_array,
+                after_array = self.data,
                 before_array_name = 'Input Data',
                 after_array_name = 'Log',
                 output = output)
 
-        self.data = array_log
-
     def positive(self, output=False):
         '''
         Shift all the values in self.data so there are no negative or 0 pixels.
@@ -207,6 +392,7 @@ class PNGCreator(object):
             output_array = self.data
 
         if output != False:
+            from display_tools import before_after
             before_after(before_array = self.data,
                 after_array = output_array,
                 before_array_name = 'Input Data',
@@ -216,36 +402,63 @@ class PNGCreator(object):
 
         self.data = output_array
 
-    def save_png(self, png_name):
+    def save_png(self, png_name, pool=None):
         '''
         Use the Python image library (PIL) to write self.data as a png file.
-        self.data is flipped in the "up-down" direction and converted to 8bit
-        encoding before writing.
+        self.data is converted to 8bit encoding before writing, see
+        write_png. With a thread pool the write is queued there and the
+        AsyncResult is returned; self.data must not change until it is
+        done.
+        '''
+        if self.data.dtype != N.uint8:
+            self.data = N.uint8(self.data)
+        if pool is None:
+            write_png(self.data, png_name)
+        else:
+            return pool.apply_async(write_png, (self.data, png_name))
+
+    def save_thumbnail(self, png_name, pool=None):
+        '''
+        Write the thumbnail of the png file png_name from self.data,
+        see make_thumbnail_name and write_thumbnail. With a thread pool
+        the write is queued there and the AsyncResult is returned.
         '''
-        self.data = N.uint8(self.data)
-        image = Image.new('L', (self.data.shape[1], self.data.shape[0]))
-        image.putdata(self.data.ravel())
-        image.save(png_name)
+        if self.data.dtype != N.uint8:
+            self.data = N.uint8(self.data)
+        thumbnail_name = make_thumbnail_name(png_name)
+        if not os.path.isdir(os.path.dirname(thumbnail_name)):
+            os.makedirs(os.path.dirname(thumbnail_name))
+        if pool is None:
+            write_thumbnail(self.data, thumbnail_name)
+        else:
+            return pool.apply_async(write_thumbnail,
+                                    (self.data, thumbnail_name))
+
+    def stretch(self, name):
+        '''
+        Replace self.data with its 8 bit image in one of the stretches
+        of mtpipeline.imaging.stretches, e.g. 'asinh' or 'zscale'.
+        '''
+        self.data = apply_stretches(self.data, [name], flip=False)[0]
 
     def threshold_clip(self, minimum, maximum, output=False):
         '''
         Set all values below minum and above maximum to the
         minimum and maximum, respectively 
         '''
-        output_array = copy.deepcopy(self.data)
-        output_array[output_array > maximum] = maximum
-        output_array[output_array < minimum] = minimum
+        if output != False:
+            before_array = self.data.copy()
+        clip_in_place(self.data, minimum, maximum)
 
         if output != False:
-            before_after(before_array = self.data,
-                after_array = output_array,
+            from display_tools import before_after
+            before_after(before_array = before_array,
+                after_array = self.data,
                 before_array_name = 'Input Data',
                 after_array_name = 'Threshold Clipped',
                 output = output,
                 pause = False)
 
-        self.data = output_array
-
     def trim(self, xmin, xmax, ymin, ymax):
         '''
         Trim the self.data attribute using the subarray function.
@@ -256,34 +469,197 @@ class PNGCreator(object):
 # Control Functions
 # -----------------------------------------------------------------------------
 
-def make_subimage_pngs(input_pngc_instance, output_path, filename, suffix):
+def make_subimage_pngs(input_pngc_instance, output_path, filename, suffix,
+        pool=None, thumbnail_switch=False):
     '''
     Wrapper function to make trimmed png outputs for the astrodrizzle
-    'wide' outputs.
+    'wide' outputs, and with thumbnail_switch their thumbnails. The
+    trimmed images are views of the input instance data, which should
+    already be scaled, e.g. 8 bit. With a thread pool the writes are
+    queued there and their AsyncResults returned.
     '''
     assert isinstance(output_path, str), 'Expected str got ' + str(type(output_path))
     assert isinstance(filename, str), 'Expected str got ' + str(type(filename))
     assert isinstance(suffix, str), 'Expected str got ' + str(type(suffix))
     assert isinstance(input_pngc_instance, PNGCreator), \
         'Expected instnace of PNGCreator, got ' + str(type(input_pngc_instance))
+    pending = []
     counter = 0
     for ymin in range(0, 1351, 425):
         for xmin in range(0, 901, 425):
             counter += 1
-            pngc_trimmed = PNGCreator(input_pngc_instance.data)
+            pngc_trimmed = PNGCreator(input_pngc_instance.data, copy=False)
             pngc_trimmed.trim(xmin, xmin + 450, ymin, ymin + 450)
-            pngc_trimmed.save_png(make_png_name(output_path, filename, suffix + str(counter)))
+            png_name = make_png_name(output_path, filename,
+                                     suffix + str(counter))
+            pending.append(pngc_trimmed.save_png(png_name, pool = pool))
+            if thumbnail_switch:
+                pending.append(pngc_trimmed.save_thumbnail(png_name,
+                                                           pool = pool))
+    return [result for result in pending if result is not None]
+
+# -----------------------------------------------------------------------------
+
+def make_tile_pngs(image, output_path, filename, suffix, pool=None,
+        thumbnail_switch=False):
+    '''
+    Write the tile pyramid PNGs of an 8 bit image and their manifest,
+    see mtpipeline.imaging.tile_pyramid, and with thumbnail_switch the
+    thumbnails of the tiles. The tiles are the images with sub_images
+    records, see build_sub_images_table, so their thumbnails are the
+    ones a thumbnail_location is set for. The tile size is the
+    `tile_size` setting (default 256). With a thread pool the writes
+    are queued there and their AsyncResults returned; the manifest is
+    written once all the tiles are queued.
+    '''
+    tile_size = SETTINGS.get('tile_size') or tile_pyramid.TILE_SIZE
+    png_name = make_png_name(output_path, filename, suffix)
+    pending = []
+    records = []
+    for record, tile in tile_pyramid.iter_tiles(image, tile_size):
+        tile_name = tile_pyramid.make_tile_name(png_name, record)
+        if records == [] and not os.path.isdir(os.path.dirname(tile_name)):
+            os.makedirs(os.path.dirname(tile_name))
+        record['name'] = os.path.basename(tile_name)
+        records.append(record)
+        pngc_tile = PNGCreator(tile, copy=False)
+        pending.append(pngc_tile.save_png(tile_name, pool = pool))
+        if thumbnail_switch:
+            pending.append(pngc_tile.save_thumbnail(tile_name, pool = pool))
+    tile_pyramid.write_manifest(tile_pyramid.make_manifest_name(png_name),
+                                png_name, filename, image.shape, tile_size,
+                                records)
+    return [result for result in pending if result is not None]
+
+# -----------------------------------------------------------------------------
+
+def render_pngs(data, output_path, filename, log_switch=True,
+        subimage_switch=False, stats_name=None, pool=None,
+        tile_switch=False, thumbnail_switch=False,
+        minimum=THRESHOLD_MINIMUM, maximum=THRESHOLD_MAXIMUM,
+        data_range=None, stretch_list=None, preview=None):
+    '''
+    Write the linear and log scaled PNGs of one image, and the PNGs of
+    the extra stretches in stretch_list. The 8 bit
+    images are made in one chunked pass over the data with
+    stretch_to_uint8, flipped "up-down" as they are filled, so the data
+    can be an unflipped memory map of the FITS file. The subimage PNGs
+    are views of the 8 bit images, and the tile pyramid is made from
+    them too, as are the thumbnails. With a thread pool the PNGs and
+    thumbnails are compressed there. With stats_name the histogram and
+    quantiles of every 8 bit image are appended to the statistics
+    files, see png_stats, while the pool compresses the PNGs.
+
+    Parameters:
+        data : N.ndarray
+            The image as stored in the FITS file, not changed.
+        output_path : string
+            The folder of the PNGs.
+        filename : string
+            The FITS file the PNG names are made from.
+        log_switch : bool
+            Also write the log scaled PNGs.
+        subimage_switch : bool
+            Also write the trimmed PNGs of make_subimage_pngs.
+        stats_name : string
+            The statistics files, see png_stats.get_stats_name, or None
+            to skip the statistics.
+        pool : multiprocessing.pool.ThreadPool
+            The pool writing the PNGs, or None to write them here.
+        tile_switch : bool
+            Also write the tile pyramids of make_tile_pngs.
+        thumbnail_switch : bool
+            Also write the thumbnails of the PNGs, subimage PNGs and
+            tiles, see PNGCreator.save_thumbnail.
+        minimum, maximum : float
+            The threshold clip limits.
+        data_range : tuple
+            The minimum and maximum of the data, see stretch_to_uint8.
+        stretch_list : list
+            The names of extra stretches, see
+            mtpipeline.imaging.stretches. Their PNGs are named with the
+            suffix of the stretch.
+        preview : preview_store.PreviewWriter
+            The preview written from the chunks of stretch_to_uint8 and
+            closed, or None.
+
+    Returns:
+        pending : list
+            The AsyncResults of the PNG writes queued in the pool, see
+            wait_for_pngs.
+
+    Outputs:
+        The PNG files, tile manifests, and statistics records.
+    '''
+    pending = []
+    suffix_list = ['linscale', 'logscale']
+    logger.info('Creating linear PNGs')
+    if not log_switch:
+        logger.info('Skipping log pngs.')
+    if data_range is None:
+        data_range = [data.min(), data.max()]
+    clip_counts = {} if stats_name else None
+    images = stretch_to_uint8(data, log_switch = log_switch,
+                              minimum = minimum, maximum = maximum,
+                              data_range = data_range,
+                              clip_counts = clip_counts,
+                              preview = preview)
+    if preview is not None:
+        preview.close()
+    # The data values of black and white in each image, and the pixels
+    # clipped by them, which are only counted for the threshold clip.
+    limits = N.clip(data_range, minimum, maximum).tolist()
+    limit_list = [limits, limits][:len(images)]
+    clip_list = [clip_counts] * len(images)
+    sample = get_sample(data) if stretch_list or stats_name else None
+    if stretch_list:
+        logger.info('Creating {0} PNGs'.format(', '.join(stretch_list)))
+        suffix_list = suffix_list[:len(images)] + \
+            [STRETCHES[name]['suffix'] for name in stretch_list]
+        limit_list.extend(STRETCHES[name]['limits'](sample)
+                          for name in stretch_list)
+        clip_list.extend([None] * len(stretch_list))
+        images.extend(apply_stretches(data, stretch_list, sample = sample))
+    records = []
+    for suffix, image, limits, counts in zip(suffix_list, images,
+                                             limit_list, clip_list):
+        pngc = PNGCreator(image, copy=False)
+        png_name = make_png_name(output_path, filename, suffix)
+        pending.append(pngc.save_png(png_name, pool = pool))
+        if thumbnail_switch:
+            pending.append(pngc.save_thumbnail(png_name, pool = pool))
+        if subimage_switch:
+            pending.extend(make_subimage_pngs(
+                pngc, output_path, filename, suffix, pool = pool,
+                thumbnail_switch = thumbnail_switch))
+        if tile_switch:
+            pending.extend(make_tile_pngs(
+                image, output_path, filename, suffix, pool = pool,
+                thumbnail_switch = thumbnail_switch))
+        if stats_name:
+            records.append(png_stats.get_image_stats(
+                image, filename, png_name, suffix, limits,
+                clip_counts = counts, sample = sample))
+    if stats_name:
+        png_stats.append_stats(stats_name, records)
+    return [result for result in pending if result is not None]
 
 # -----------------------------------------------------------------------------
 
 def run_trim(filename, output_path, log_switch=True,
-        stat_switch=False):
+        stat_switch=False, subimage_switch=False, pool=None,
+        tile_switch=False, thumbnail_switch=False, stretch_list=None,
+        preview_switch=False):
     '''
     The main controller for the png creation. Checks for and creates an
-    output folder. Opens the data header extention. Uses a pngcreator
-    instance to create trimmed and scaled pngs.
+    output folder. Memory maps the data of the primary extension and
+    renders the scaled, and optionally trimmed, pngs from it with
+    render_pngs. With preview_switch the preview of preview_store is
+    written from the same chunks of the data. The pngs are written by `png_threads` threads
+    (default 4) before returning. A caller rendering several files can
+    pass its own thread pool instead, and then has to wait for the
+    returned AsyncResults with wait_for_pngs.
     '''
-    #import pdb; pdb.set_trace()
     logger.info('filename: {0}'.format(filename))
     astrodrizzle_mode = filename.split('_')[-3]
     logger.info('astrodrizzle mode: {0}'.format(astrodrizzle_mode))
@@ -295,45 +671,44 @@ def run_trim(filename, output_path, log_switch=True,
     if test == False:
         os.mkdir(output_path)
 
-    # If we want to output before-after histograms for the image
-    # manipulations we make, stat_switch will be True.
+    # With stat_switch the histograms and quantiles of the PNGs are
+    # appended to the statistics files.
     if stat_switch:
-        positive_stat = make_png_name(output_path, filename, 'positive_stat')
-        log_stat = make_png_name(output_path, filename, 'log_stat')
-        threshold_clip_stat = make_png_name(output_path, filename, 'threshold_clip_stat')
-
-    # Otherwise, setting it to false prevents writing the histograms.
+        stats_name = png_stats.get_stats_name(output_path)
     else:
-        positive_stat = False
-        log_stat = False
-        threshold_clip_stat = False
+        stats_name = None
 
     # Get the data.
-    data = get_fits_data(filename)
-
-    # Create Linear full image
-    logger.info('Creating linear PNGs')
-    pngc_linear = PNGCreator(data)
-    pngc_linear.threshold_clip(minimum = 0.0001, maximum = 2e5, 
-                               output = threshold_clip_stat)
-
-    if log_switch:
-        pngc_log = PNGCreator(pngc_linear.data)
-
-    pngc_linear.compress()
-    pngc_linear.save_png(make_png_name(output_path, filename, 'linscale'))
-
-    # Create Log full Image
-    if log_switch:
-        logger.info('Creating log PNGs')
-
-        #pngc_log.positive(output = positive_stat)
-        pngc_log.log(output = log_stat)
-        pngc_log.compress()
-        pngc_log.save_png(make_png_name(output_path, filename, 'logscale'))
-
+    data = get_fits_data(filename, flip=False, memmap=True)
+    if preview_switch:
+        # Imported here, as preview_store renders its PNGs with run_trim.
+        from mtpipeline.imaging.preview_store import PreviewWriter
+        preview = PreviewWriter(filename, output_path, data.shape)
     else:
-        logger.info('Skipping log pngs.')
+        preview = None
+    if pool is not None:
+        return render_pngs(data, output_path, filename,
+                           log_switch = log_switch,
+                           subimage_switch = subimage_switch,
+                           stats_name = stats_name, pool = pool,
+                           tile_switch = tile_switch,
+                           thumbnail_switch = thumbnail_switch,
+                           stretch_list = stretch_list,
+                           preview = preview)
+    pool = ThreadPool(processes = SETTINGS.get('png_threads') or 4)
+    try:
+        wait_for_pngs(render_pngs(data, output_path, filename,
+                                  log_switch = log_switch,
+                                  subimage_switch = subimage_switch,
+                                  stats_name = stats_name, pool = pool,
+                                  tile_switch = tile_switch,
+                                  thumbnail_switch = thumbnail_switch,
+                                  stretch_list = stretch_list,
+                                  preview = preview))
+    finally:
+        pool.close()
+        pool.join()
+    return []
 
 # -----------------------------------------------------------------------------
 # For command line execution.
@@ -0,0 +1,271 @@
+""" Cosmic ray rejection on stacks of exposures from the same visit.
+
+Exposures taken in one visit with the same detector and filter see the
+same scene, so a cosmic ray shows up as a pixel that is much brighter
+than the same pixel in the other exposures. For such a stack this
+module:
+
+    1. Finds the integer pixel offset of every exposure relative to the
+       first one from the peak of their FFT cross-correlation.
+    2. Builds a cube of the aligned count rates and takes its median,
+       ignoring pixels not covered by an exposure.
+    3. Flags the pixels of each exposure that are more than sigclip
+       sigma above the median scaled to its exposure time, and their
+       neighbours above sigclip * sigfrac sigma, using the readnoise and
+       gain of its cosmicx parameters for the noise model.
+    4. Repeats the median without the flagged pixels, and replaces the
+       flagged pixels with the scaled median.
+
+All of the steps are vectorized over the pixels. Stacks with fewer than
+MIN_FRAMES exposures fall back to single image rejection with
+run_cosmicx.
+"""
+
+import os
+
+import numpy as N
+
+from astropy.io import fits
+from scipy import ndimage
+
+from mtpipeline.database.header_catalog import get_header
+from mtpipeline.imaging.run_cosmicx import make_c1m_link
+from mtpipeline.imaging.run_cosmicx import run_cosmicx
+
+# The smallest stack the median can reject cosmic rays in.
+MIN_FRAMES = 3
+
+# The number of median and flagging passes.
+PASSES = 2
+
+# The largest offset between exposures searched for, in pixels.
+MAX_SHIFT = 64
+
+# How far the correlation peak must stand above the noise of the
+# correlation, in standard deviations, to be used as an offset. Less
+# significant peaks, e.g. of exposures of empty sky, give no offset.
+ALIGN_SNR = 10.0
+
+# -----------------------------------------------------------------------------
+# Functions (alphabetical)
+# -----------------------------------------------------------------------------
+
+def get_offsets(stack):
+    """ Return the integer offset of every image relative to the first.
+
+    Parameters:
+        stack: list
+            2D numpy arrays of the same shape.
+
+    Returns:
+        offsets: list
+            (dy, dx) tuples. Shifting image i by offsets[i] with
+            shift_image aligns it with the first image. Offsets are at
+            most MAX_SHIFT pixels, and (0, 0) when the correlation peak
+            is not ALIGN_SNR standard deviations above the mean.
+
+    Outputs: nothing
+    """
+
+    def prepare(image):
+        # Remove the sky and clip the brightest pixels, so cosmic rays
+        # and saturated stars don't dominate the correlation.
+        image = N.nan_to_num(image.astype(N.float64))
+        image = image - N.median(image)
+        return N.clip(image, 0.0, N.percentile(image, 99.5))
+
+    ny, nx = stack[0].shape
+    reference = N.fft.rfft2(prepare(stack[0]))
+    # Roll the zero offset to the centre and search a window around it.
+    ry, rx = min(MAX_SHIFT, ny // 2), min(MAX_SHIFT, nx // 2)
+    offsets = []
+    for image in stack:
+        correlation = N.fft.irfft2(reference * N.conj(N.fft.rfft2(
+            prepare(image))), s=(ny, nx))
+        window = N.roll(N.roll(correlation, ry, axis=0), rx, axis=1)[
+            :2 * ry + 1, :2 * rx + 1]
+        dy, dx = N.unravel_index(N.argmax(window), window.shape)
+        std = correlation.std()
+        if std == 0 or \
+                (window[dy, dx] - correlation.mean()) / std < ALIGN_SNR:
+            offsets.append((0, 0))
+        else:
+            offsets.append((int(dy - ry), int(dx - rx)))
+    return offsets
+
+# -----------------------------------------------------------------------------
+
+def get_stack_key(filename, header_data):
+    """ Return the key of the stack an exposure belongs to.
+
+    Parameters:
+        filename: string
+            The path to the raw exposure.
+        header_data: dict
+            As returned by imaging_pipeline.get_metadata.
+
+    Returns:
+        key: tuple
+            The proposal, visit, detector, and filter of the exposure.
+
+    Outputs: nothing
+    """
+
+    header = get_header(filename, keywords=['PROPOSID', 'LINENUM'])
+    visit = str(header.get('LINENUM', '')).split('.')[0]
+    return (header.get('PROPOSID'), visit, header_data['detector'],
+            header_data['filtername'])
+
+# -----------------------------------------------------------------------------
+
+def reject_stack(stack, exptimes, params_list):
+    """ Clean a stack of images of the same chip.
+
+    Parameters:
+        stack: list
+            2D numpy arrays in counts, one per exposure.
+        exptimes: list
+            The exposure times.
+        params_list: list
+            The cosmicx parameters of the chip for every exposure.
+            readnoise, gain, sigclip, and sigfrac are used.
+
+    Returns:
+        clean_stack: list
+            The cleaned float32 images.
+        masks: list
+            The cosmic ray masks.
+
+    Outputs: nothing
+    """
+
+    offsets = get_offsets(stack)
+    images = [N.array(image, dtype=N.float32) for image in stack]
+    masks = [N.zeros(image.shape, dtype=bool) for image in images]
+    grow_kernel = N.ones((3, 3), dtype=bool)
+
+    for iteration in range(PASSES):
+        # The median count rate, without the flagged pixels.
+        cube = N.empty((len(images),) + images[0].shape, dtype=N.float32)
+        for i, (image, mask, exptime, offset) in enumerate(
+                zip(images, masks, exptimes, offsets)):
+            rate = N.where(mask, N.nan, image / exptime)
+            cube[i] = shift_image(rate, offset)
+        with N.errstate(invalid='ignore'):
+            median = N.nanmedian(cube, axis=0)
+        del cube
+
+        for image, mask, exptime, offset, params in zip(
+                images, masks, exptimes, offsets, params_list):
+            # Put the median back in the frame of this exposure.
+            model = shift_image(median, (-offset[0], -offset[1])) * exptime
+            gain = params['gain'] or 1.0
+            sigma = N.sqrt(N.maximum(N.nan_to_num(model), 0.0) * gain +
+                           params['readnoise'] ** 2) / gain
+            with N.errstate(invalid='ignore'):
+                residual = N.where(N.isnan(model), 0.0,
+                                   (image - model) / sigma)
+            found = residual > params['sigclip']
+            found |= ndimage.binary_dilation(found, grow_kernel) & \
+                (residual > params['sigclip'] * params['sigfrac'])
+            mask |= found
+
+    clean_stack = []
+    for image, mask, exptime, offset in zip(images, masks, exptimes,
+                                            offsets):
+        model = shift_image(median, (-offset[0], -offset[1])) * exptime
+        replace = mask & ~N.isnan(model)
+        image[replace] = model[replace]
+        clean_stack.append(image)
+    return clean_stack, masks
+
+# -----------------------------------------------------------------------------
+
+def run_stack_cosmicx(filename_list, output_list, cosmicx_params_list,
+                      detector):
+    """ Driver to run stack cosmic ray rejection on a set of exposures.
+
+    Parameters:
+        filename_list: list
+            The raw exposures of one stack, see get_stack_key.
+        output_list: list
+            The cosmic ray rejected output filename of each exposure.
+        cosmicx_params_list: list
+            The cosmicx parameters of each exposure.
+        detector: string
+            The detector of the exposures. If SBC or IR, cr rejection
+            is not run.
+
+    Returns: nothing
+
+    Outputs:
+        A cosmic ray rejected FITS file for every exposure, and the
+        c1m links run_cosmicx makes.
+    """
+
+    if len(filename_list) < MIN_FRAMES or detector in ['SBC', 'IR']:
+        for filename, output, cosmicx_params in zip(
+                filename_list, output_list, cosmicx_params_list):
+            run_cosmicx(filename, output, cosmicx_params, detector)
+        return
+
+    exptimes = [get_header(filename, keywords=['EXPTIME'])['EXPTIME']
+                for filename in filename_list]
+    assert min(exptimes) > 0, 'Expected positive exposure times.'
+    hdulists = [fits.open(filename, mode='readonly')
+                for filename in filename_list]
+    try:
+        for key in sorted(cosmicx_params_list[0]):
+            # Skip extensions that are missing or empty, like run_cosmicx.
+            try:
+                stack = [hdulist[key].data for hdulist in hdulists]
+            except IndexError:
+                continue
+            if any(image is None for image in stack):
+                continue
+            for image in stack:
+                image[image < -10.0] = 0.0
+            clean_stack, masks = reject_stack(
+                stack, exptimes,
+                [cosmicx_params[key] for cosmicx_params in cosmicx_params_list])
+            for hdulist, clean in zip(hdulists, clean_stack):
+                hdulist[key].data = clean
+
+        for filename, output, hdulist in zip(filename_list, output_list,
+                                             hdulists):
+            if os.access(output, os.F_OK):
+                os.remove(output)
+            hdulist.writeto(output)
+            make_c1m_link(os.path.abspath(filename), os.path.abspath(output))
+    finally:
+        for hdulist in hdulists:
+            hdulist.close()
+
+# -----------------------------------------------------------------------------
+
+def shift_image(image, offset, fill=N.nan):
+    """ Shift an image by whole pixels without wrapping.
+
+    Parameters:
+        image: numpy array
+            The 2D image.
+        offset: tuple
+            The (dy, dx) shift. Pixel (y, x) moves to (y + dy, x + dx).
+        fill: float
+            The value of the pixels not covered by the shifted image.
+
+    Returns:
+        shifted: numpy array
+            A float32 array of the same shape.
+
+    Outputs: nothing
+    """
+
+    dy, dx = offset
+    ny, nx = image.shape
+    shifted = N.full(image.shape, fill, dtype=N.float32)
+    if abs(dy) >= ny or abs(dx) >= nx:
+        return shifted
+    shifted[max(dy, 0):ny + min(dy, 0), max(dx, 0):nx + min(dx, 0)] = \
+        image[max(-dy, 0):ny - max(dy, 0), max(-dx, 0):nx - max(dx, 0)]
+    return shifted
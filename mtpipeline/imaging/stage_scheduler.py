@@ -0,0 +1,501 @@
+"""Stage-aware scheduler for the imaging pipeline.
+
+The `imaging_pipeline` function runs the cosmic ray rejection,
+AstroDrizzle, and PNG steps for one file one after the other. When
+whole files are handed to a single pool of workers a slow AstroDrizzle
+run holds up a core that could be doing cosmic ray rejection or PNG
+creation for another file.
+
+The StageScheduler class in this module instead treats every step of
+every file as a separate task. Each stage has its own worker pool with
+its own concurrency limit and a file is handed to the next stage as
+soon as its previous stage completes, so files stream through the
+pipeline.
+
+With the `cosmicx_mode: stack` setting the cosmic ray rejection stage
+runs once for each stack of exposures from the same visit, see
+stack_cosmics, and the exposures of a stack go on to the next stage
+separately once it completes.
+
+The drizzle stage of a file is split into a task that updates the WCS
+of its inputs and one task for each of its products, the original and
+the CR rejected image, which run at the same time. The priority of the
+product tasks relative to the drizzle tasks of other files is set by
+the `drizzle_product_priority` setting.
+
+Workers report their process id when they start a task. A worker that
+dies without reporting back, e.g. from a segfault in a C extension or
+the OOM killer, fails the file of its task instead of hanging the run.
+"""
+
+import errno
+import heapq
+import logging
+import multiprocessing as mp
+import os
+import Queue
+import sys
+
+from multiprocessing.queues import SimpleQueue
+
+from mtpipeline.get_settings import SETTINGS
+from mtpipeline.imaging.imaging_pipeline import cr_reject_group_stage
+from mtpipeline.imaging.imaging_pipeline import cr_reject_stage
+from mtpipeline.imaging.imaging_pipeline import drizzle_prep_stage
+from mtpipeline.imaging.imaging_pipeline import drizzle_product_stage
+from mtpipeline.imaging.imaging_pipeline import drizzle_record
+from mtpipeline.imaging.imaging_pipeline import get_metadata
+from mtpipeline.imaging.imaging_pipeline import make_output_file_dict
+from mtpipeline.imaging.imaging_pipeline import png_stage
+from mtpipeline.imaging.stack_cosmics import get_stack_key
+
+# The cosmic ray rejection modes, one file or one stack per task.
+CR_MODES = ['single', 'stack']
+
+# The pipeline stages in the order they have to run.
+STAGES = ['cr_reject', 'drizzle', 'png']
+
+# The seconds between the checks for dead workers while no task
+# completes.
+POLL_SECONDS = 10
+
+# The queue a worker process reports the tasks it starts to, see
+# init_worker.
+_STARTED = None
+
+# -----------------------------------------------------------------------------
+# Functions (alphabetical)
+# -----------------------------------------------------------------------------
+
+def get_stage_cores(stages=STAGES):
+    """Return the number of worker processes to use for each stage.
+
+    The values are read from the `stage_cores` setting. The stages
+    missing from the setting share the `num_cores` setting: each gets
+    num_cores divided by the number of stages, at least 1, since the
+    pools of all the stages run at the same time.
+
+    Parameters:
+        stages : list
+            The names of the stages to return values for.
+
+    Returns:
+        stage_cores : dict
+            A dictionary of stage name to number of processes.
+
+    Outputs:
+        nothing
+    """
+    stage_settings = SETTINGS.get('stage_cores') or {}
+    shared_cores = max(1, int(SETTINGS['num_cores']) // len(stages))
+    stage_cores = {}
+    for stage in stages:
+        stage_cores[stage] = int(stage_settings.get(stage, shared_cores))
+        assert stage_cores[stage] > 0, \
+            'stage_cores for {} must be at least 1.'.format(stage)
+    return stage_cores
+
+# -----------------------------------------------------------------------------
+
+def init_worker(started):
+    """Pool initializer. Sets the queue the worker reports to."""
+    global _STARTED
+    _STARTED = started
+
+# -----------------------------------------------------------------------------
+
+def is_process_alive(pid):
+    """Return False once the process pid has exited and been reaped."""
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno != errno.ESRCH
+    return True
+
+# -----------------------------------------------------------------------------
+
+def run_stage_task(task):
+    """Worker entry point. Runs a single stage for a single file.
+
+    The header data and output file dictionary are generated by the
+    first stage that runs for a file and travel with the task to the
+    later stages so the header is only read once. Exceptions are
+    logged and reported back in the task rather than raised so one bad
+    file does not stop the other files.
+
+    A task with a 'group' runs cr_reject for a whole stack of files,
+    whose header data and output file dictionaries are in the group.
+    A drizzle task without a 'product' runs drizzle_prep_stage and
+    sets 'drizzle_run' to its result, one with a 'product' runs
+    drizzle_product_stage for that product.
+
+    Parameters:
+        task : dict
+            A task dictionary as built by StageScheduler.
+
+    Returns:
+        task : dict
+            The same dictionary with the 'status' key set to 'done'
+            or 'failed'.
+
+    Outputs:
+        The outputs of the stage that was run.
+    """
+    filename = task['filename']
+    stage = task['stage']
+    if _STARTED is not None:
+        _STARTED.put((task['task_id'], os.getpid()))
+    try:
+        if task['group'] is not None:
+            cr_reject_group_stage(task['group'],
+                                  task['reproc_switch'],
+                                  task['incremental_switch'])
+            task['status'] = 'done'
+            return task
+        if task['output_file_dict'] is None:
+            logging.info("Current File: " + filename)
+            task['header_data'] = get_metadata(filename)
+            task['output_file_dict'] = make_output_file_dict(
+                filename, task['header_data'])
+        if stage == 'cr_reject':
+            cr_reject_stage(filename,
+                            task['header_data'],
+                            task['output_file_dict'],
+                            task['reproc_switch'],
+                            task['incremental_switch'])
+        elif stage == 'drizzle' and task['product'] is None:
+            task['drizzle_run'] = drizzle_prep_stage(
+                task['header_data'],
+                task['output_file_dict'],
+                task['reproc_switch'],
+                task['incremental_switch'])
+        elif stage == 'drizzle':
+            drizzle_product_stage(task['header_data'],
+                                  task['output_file_dict'],
+                                  task['product'])
+        elif stage == 'png':
+            png_stage(task['output_file_dict'],
+                      task['output_path'],
+                      task['reproc_switch'],
+                      task['incremental_switch'])
+        task['status'] = 'done'
+    except Exception as err:
+        logging.critical("{0} {1} {2} {3}".format(filename, type(err),
+            err.message, sys.exc_traceback.tb_lineno))
+        task['status'] = 'failed'
+    return task
+
+# -----------------------------------------------------------------------------
+# Main Class
+# -----------------------------------------------------------------------------
+
+class StageScheduler(object):
+    """Run the pipeline stages of many files on per-stage worker pools.
+
+    Tasks that are ready to run are kept in a heap for each stage and
+    only handed to that stage's pool while it has an idle worker.
+    Completed tasks are reported back to the main process through a
+    queue, and the main process submits the file's next stage.
+    The heaps are ordered by task priority, lowest first, and then by
+    submission order.
+    """
+    def __init__(self, stages=STAGES, stage_cores=None, output_path=None,
+            reproc_switch=False, incremental_switch=False, cr_mode=None,
+            product_priority=None):
+        """Check the inputs and set the options used for every task.
+
+        Parameters:
+            stages : list
+                The stages to run, a subset of STAGES.
+            stage_cores : dict
+                Number of worker processes for each stage. Defaults to
+                the values returned by get_stage_cores.
+            output_path : string
+                The output path for the PNG stage.
+            reproc_switch : bool
+                Reprocess files even if the outputs exist.
+            incremental_switch : bool
+                Reprocess the stages whose inputs or parameters
+                changed, see imaging_pipeline.needs_processing.
+            cr_mode : string
+                'single' to reject cosmic rays one file at a time or
+                'stack' to reject them in stacks of exposures. Defaults
+                to the `cosmicx_mode` setting.
+            product_priority : int
+                The priority of the drizzle product tasks. Other tasks
+                have priority 0, so a negative value finishes the files
+                already being drizzled before starting others and a
+                positive value starts every file first. Defaults to the
+                `drizzle_product_priority` setting, or 0.
+        """
+        for stage in stages:
+            assert stage in STAGES, 'Unknown stage ' + str(stage)
+        self.stages = [stage for stage in STAGES if stage in stages]
+        if stage_cores is None:
+            stage_cores = get_stage_cores(self.stages)
+        self.stage_cores = stage_cores
+        self.output_path = output_path
+        self.reproc_switch = reproc_switch
+        self.incremental_switch = incremental_switch
+        if cr_mode is None:
+            cr_mode = SETTINGS.get('cosmicx_mode') or 'single'
+        assert cr_mode in CR_MODES, 'Unknown cr_mode ' + str(cr_mode)
+        self.cr_mode = cr_mode
+        if product_priority is None:
+            product_priority = SETTINGS.get('drizzle_product_priority') or 0
+        self.product_priority = int(product_priority)
+        self.counter = 0
+
+    def make_task(self, filename, stage, header_data=None,
+            output_file_dict=None):
+        """Build the task dictionary passed to run_stage_task."""
+        return {'filename' : filename,
+                'stage' : stage,
+                'header_data' : header_data,
+                'output_file_dict' : output_file_dict,
+                'output_path' : self.output_path,
+                'reproc_switch' : self.reproc_switch,
+                'incremental_switch' : self.incremental_switch,
+                'group' : None,
+                'product' : None,
+                'drizzle_run' : None,
+                'priority' : 0,
+                'task_id' : None,
+                'status' : None}
+
+    def make_group_tasks(self, filename_list):
+        """Build one cr_reject task for each stack of exposures.
+
+        The header data and output file dictionary of every file are
+        made here, since they are needed to find its stack.
+
+        Parameters:
+            filename_list : list
+                The input c0m.fits or flt.fits files.
+
+        Returns:
+            tasks : list
+                The group tasks, in the order of their first file.
+            failed : list
+                The files whose header couldn't be read.
+
+        Outputs:
+            nothing
+        """
+        groups = {}
+        keys = []
+        failed = []
+        for filename in filename_list:
+            try:
+                header_data = get_metadata(filename)
+                member = {'filename' : filename,
+                          'header_data' : header_data,
+                          'output_file_dict' : make_output_file_dict(
+                              filename, header_data)}
+                key = get_stack_key(filename, header_data)
+            except Exception as err:
+                logging.critical("{0} {1} {2}".format(filename, type(err),
+                                                      err.message))
+                failed.append(filename)
+                continue
+            if key not in groups:
+                groups[key] = []
+                keys.append(key)
+            groups[key].append(member)
+
+        tasks = []
+        for key in keys:
+            group = groups[key]
+            logging.info("Stack {0}: {1} files".format(key, len(group)))
+            task = self.make_task(group[0]['filename'], 'cr_reject')
+            task['group'] = group
+            tasks.append(task)
+        return tasks, failed
+
+    def push(self, task):
+        """Add a task to the heap of ready tasks for its stage."""
+        self.counter += 1
+        task['task_id'] = self.counter
+        heapq.heappush(self.ready[task['stage']],
+                       (task['priority'], self.counter, task))
+
+    def dispatch(self):
+        """Hand ready tasks to every stage pool that has an idle worker."""
+        for stage in self.stages:
+            while self.ready[stage] and \
+                    self.in_flight[stage] < self.stage_cores[stage]:
+                priority, counter, task = heapq.heappop(self.ready[stage])
+                self.in_flight[stage] += 1
+                self.running[task['task_id']] = task
+                self.pools[stage].apply_async(run_stage_task, (task,),
+                                              callback=self.results.put)
+
+    def find_lost_tasks(self):
+        """Return the running tasks whose worker died, marked failed.
+
+        The pool reaps a dead worker and starts another, but the task
+        it was running never reports back. Called on every pass of the
+        run loop, so the start reports never fill the pipe the workers
+        write them to.
+        """
+        while not self.started.empty():
+            task_id, pid = self.started.get()
+            if task_id in self.running:
+                self.worker_pids[task_id] = pid
+        lost = []
+        for task_id, pid in self.worker_pids.items():
+            if not is_process_alive(pid):
+                task = self.running[task_id]
+                logging.critical("{0} {1} worker {2} died".format(
+                    task['filename'], task['stage'], pid))
+                task['status'] = 'failed'
+                lost.append(task)
+                self.lost_stages.add(task['stage'])
+        return lost
+
+    def finish(self, task):
+        """Return the file tasks whose stage is over after a task.
+
+        A stack task finishes the stage of every file in its group. A
+        drizzle task that found work to do submits the product tasks
+        of its file, and the stage of the file is over, and recorded
+        in its provenance manifest, once they all completed.
+
+        Parameters:
+            task : dict
+                A completed task.
+
+        Returns:
+            finished : list
+                Task dictionaries with the 'filename', 'header_data',
+                'output_file_dict', and 'status' of each file.
+
+        Outputs:
+            The provenance manifest of a drizzled file.
+        """
+        if task['group'] is not None:
+            return [dict(task, group=None, **member)
+                    for member in task['group']]
+        if task['stage'] != 'drizzle' or \
+                (task['status'] == 'failed' and task['product'] is None):
+            return [task]
+
+        filename = task['filename']
+        if task['product'] is None:
+            if task['drizzle_run'] is None:
+                return [task]
+            products = range(len(task['output_file_dict']['drizzle_output']))
+            self.drizzling[filename] = {'remaining' : len(products),
+                                        'status' : 'done'}
+            for product in products:
+                product_task = self.make_task(filename, 'drizzle',
+                                              task['header_data'],
+                                              task['output_file_dict'])
+                product_task['product'] = product
+                product_task['drizzle_run'] = task['drizzle_run']
+                product_task['priority'] = self.product_priority
+                self.push(product_task)
+            return []
+
+        state = self.drizzling[filename]
+        state['remaining'] -= 1
+        if task['status'] == 'failed':
+            state['status'] = 'failed'
+        if state['remaining'] > 0:
+            return []
+        del self.drizzling[filename]
+        task['status'] = state['status']
+        if task['status'] == 'done':
+            try:
+                drizzle_record(task['output_file_dict'], task['drizzle_run'])
+            except Exception as err:
+                logging.critical("{0} {1} {2}".format(filename, type(err),
+                                                      err.message))
+                task['status'] = 'failed'
+        return [task]
+
+    def next_stage(self, stage):
+        """Return the stage after `stage`, or None for the last stage."""
+        index = self.stages.index(stage)
+        if index + 1 < len(self.stages):
+            return self.stages[index + 1]
+        return None
+
+    def run(self, filename_list):
+        """Stream every file in filename_list through the stages.
+
+        Parameters:
+            filename_list : list
+                The input c0m.fits or flt.fits files.
+
+        Returns:
+            failed : list
+                The files where a stage failed. Later stages are not
+                run for these files.
+
+        Outputs:
+            The outputs of all the stages.
+        """
+        for stage in self.stages:
+            logging.info("Number of Processes for {}: {}".format(
+                stage, self.stage_cores[stage]))
+        self.started = SimpleQueue()
+        self.pools = {stage : mp.Pool(processes=self.stage_cores[stage],
+                                      initializer=init_worker,
+                                      initargs=(self.started,))
+                      for stage in self.stages}
+        self.running = {}
+        self.worker_pids = {}
+        self.lost_stages = set()
+        self.ready = {stage : [] for stage in self.stages}
+        self.in_flight = {stage : 0 for stage in self.stages}
+        self.results = Queue.Queue()
+        self.drizzling = {}
+        failed = []
+
+        if self.stages[0] == 'cr_reject' and self.cr_mode == 'stack':
+            tasks, failed = self.make_group_tasks(filename_list)
+        else:
+            tasks = [self.make_task(filename, self.stages[0])
+                     for filename in filename_list]
+        for task in tasks:
+            self.push(task)
+        outstanding = len(filename_list) - len(failed)
+        self.dispatch()
+
+        while outstanding > 0:
+            try:
+                completed = [self.results.get(timeout=POLL_SECONDS)]
+            except Queue.Empty:
+                completed = []
+            completed.extend(self.find_lost_tasks())
+            for task in completed:
+                # A lost task may still report back.
+                if self.running.pop(task['task_id'], None) is None:
+                    continue
+                self.worker_pids.pop(task['task_id'], None)
+                stage = task['stage']
+                self.in_flight[stage] -= 1
+                next_stage = self.next_stage(stage)
+                for member in self.finish(task):
+                    if member['status'] == 'failed':
+                        failed.append(member['filename'])
+                        outstanding -= 1
+                    elif next_stage is None:
+                        logging.info("Completed: " + member['filename'])
+                        outstanding -= 1
+                    else:
+                        self.push(self.make_task(member['filename'],
+                                                 next_stage,
+                                                 member['header_data'],
+                                                 member['output_file_dict']))
+            self.dispatch()
+
+        # A pool waits for the results of lost tasks when closed.
+        for stage in self.stages:
+            if stage in self.lost_stages:
+                self.pools[stage].terminate()
+            else:
+                self.pools[stage].close()
+            self.pools[stage].join()
+        return failed
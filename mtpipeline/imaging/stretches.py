@@ -0,0 +1,202 @@
+#! /usr/bin/env python
+
+'''
+A registry of the extra stretches of the PNG stage.
+
+Besides the linear and log PNGs of run_trim, the png stage can write
+PNGs with any of the stretches registered here, e.g. sqrt, asinh, or
+zscale. A stretch is two functions:
+
+    limits(sample) -> (low, high)
+        The data values mapped to black and white, estimated from a
+        sorted sample of the finite pixels.
+    curve(x) -> y
+        The mapping of the values scaled to [0, 1] between the limits
+        to [0, 1] brightness.
+
+The limits come from a strided sample of about SAMPLE_SIZE pixels
+instead of the whole image. The curve is evaluated once, for a lookup
+table of LUT_SIZE levels between the limits, so applying a stretch
+costs one scaling and one table lookup per pixel however expensive
+the curve is. NaNs and values below the limits are black, values
+above them white.
+
+More stretches can be added with register_stretch.
+'''
+
+import numpy as N
+
+# The number of rows of an image stretched at a time, here and in
+# run_trim.stretch_to_uint8.
+CHUNK_ROWS = 256
+
+# The number of pixels sampled for the limits.
+SAMPLE_SIZE = 100000
+
+# The number of input levels of the lookup tables.
+LUT_SIZE = 4096
+
+# The percentiles the percentile limits are set to.
+PERCENTILE_LIMITS = (0.5, 99.5)
+
+# The softening of the asinh stretch, in units of the limit range.
+ASINH_SOFTENING = 0.1
+
+# The zscale contrast, rejection threshold in sigma, and the number of
+# sample pixels fitted.
+ZSCALE_CONTRAST = 0.25
+ZSCALE_REJECT = 2.5
+ZSCALE_SAMPLE = 1000
+
+# -----------------------------------------------------------------------------
+# Functions (alphabetical)
+# -----------------------------------------------------------------------------
+
+def apply_stretches(data, name_list, flip=True, sample=None):
+    '''
+    Return the 8 bit images of data with the registered stretches.
+
+    Parameters:
+        data : N.ndarray
+            The image, not changed. It is read CHUNK_ROWS rows at a
+            time, so it can be a memory map.
+        name_list : list
+            The names of the stretches, see STRETCHES.
+        flip : bool
+            Flip the images "up-down", by filling them bottom up.
+        sample : N.ndarray
+            The sorted sample the limits are estimated from. Defaults
+            to get_sample(data).
+
+    Returns:
+        images : list
+            The uint8 images, in the order of name_list.
+
+    Outputs:
+        nothing
+    '''
+    assert isinstance(data, N.ndarray), 'data must be numpy array'
+    for name in name_list:
+        assert name in STRETCHES, 'Unknown stretch {0}, expected one of ' \
+            '{1}'.format(name, sorted(STRETCHES))
+    if sample is None:
+        sample = get_sample(data)
+    tables = []
+    for name in name_list:
+        low, high = STRETCHES[name]['limits'](sample)
+        scale = (LUT_SIZE - 1) / float(high - low) if high > low else 0.0
+        tables.append((N.float32(low), N.float32(scale),
+                       make_lut(STRETCHES[name]['curve'])))
+    images = [N.empty(data.shape, dtype=N.uint8) for name in name_list]
+    views = [image[::-1] for image in images] if flip else images
+    for start in range(0, data.shape[0], CHUNK_ROWS):
+        chunk = N.array(data[start:start + CHUNK_ROWS], dtype=N.float32)
+        index = N.empty(chunk.shape, dtype=N.float32)
+        for view, (low, scale, lut) in zip(views, tables):
+            N.subtract(chunk, low, out=index)
+            index *= scale
+            # fmax and fmin turn NaNs into the lower bound.
+            N.fmax(index, 0, out=index)
+            N.fmin(index, LUT_SIZE - 1, out=index)
+            view[start:start + CHUNK_ROWS] = lut[index.astype(N.intp)]
+    return images
+
+# -----------------------------------------------------------------------------
+
+def asinh_curve(x):
+    '''
+    The asinh curve, linear near 0 and logarithmic above
+    ASINH_SOFTENING.
+    '''
+    return N.arcsinh(x / ASINH_SOFTENING) / N.arcsinh(1.0 / ASINH_SOFTENING)
+
+# -----------------------------------------------------------------------------
+
+def get_percentile_interval(sample):
+    '''
+    Return the PERCENTILE_LIMITS percentiles of a sorted sample.
+    '''
+    if sample.size == 0:
+        return 0.0, 1.0
+    return [float(sample[int((sample.size - 1) * percentile / 100.)])
+            for percentile in PERCENTILE_LIMITS]
+
+# -----------------------------------------------------------------------------
+
+def get_sample(data, size=SAMPLE_SIZE):
+    '''
+    Return the sorted finite float32 values of a regular grid of about
+    size pixels of a 2D image.
+    '''
+    stride = max(1, int(N.sqrt(data.size / float(size))))
+    sample = N.array(data[::stride, ::stride], dtype=N.float32).ravel()
+    sample = sample[N.isfinite(sample)]
+    sample.sort()
+    return sample
+
+# -----------------------------------------------------------------------------
+
+def get_zscale_limits(sample):
+    '''
+    Return the IRAF zscale limits of a sorted sample: a line is fitted
+    to ZSCALE_SAMPLE of the sorted values, rejecting outliers, and the
+    limits are where its slope divided by ZSCALE_CONTRAST reaches the
+    ends of the sample, around the median.
+    '''
+    if sample.size == 0:
+        return 0.0, 1.0
+    sample = sample[::max(1, sample.size // ZSCALE_SAMPLE)].astype(N.float64)
+    size = sample.size
+    center = size // 2
+    median = sample[center]
+    x = N.arange(size, dtype=N.float64)
+    keep = N.ones(size, dtype=bool)
+    slope = 0.0
+    for iteration in range(5):
+        if keep.sum() < max(5, size // 2):
+            break
+        slope, intercept = N.polyfit(x[keep], sample[keep], 1)
+        residuals = sample - (slope * x + intercept)
+        sigma = residuals[keep].std()
+        new_keep = N.abs(residuals) < ZSCALE_REJECT * sigma if sigma > 0 \
+            else keep
+        if (new_keep == keep).all():
+            break
+        keep = new_keep
+    slope /= ZSCALE_CONTRAST
+    low = max(sample[0], median - center * slope)
+    high = min(sample[-1], median + (size - 1 - center) * slope)
+    return float(low), float(high)
+
+# -----------------------------------------------------------------------------
+
+def make_lut(curve):
+    '''
+    Return the uint8 lookup table of a curve, LUT_SIZE levels evenly
+    spaced over [0, 1], truncated like PNGCreator.compress.
+    '''
+    table = curve(N.linspace(0.0, 1.0, LUT_SIZE))
+    return N.uint8(N.clip(table, 0.0, 1.0) * 255.)
+
+# -----------------------------------------------------------------------------
+
+def register_stretch(name, limits, curve, suffix=None):
+    '''
+    Add a stretch to the registry, see the module docstring. The PNGs
+    of the stretch are named with suffix, by default name + 'scale'.
+    '''
+    STRETCHES[name] = {'limits' : limits, 'curve' : curve,
+                       'suffix' : suffix or name + 'scale'}
+
+# -----------------------------------------------------------------------------
+# The registry
+# -----------------------------------------------------------------------------
+
+# The stretches by name, filled with register_stretch.
+STRETCHES = {}
+
+register_stretch('percentile', get_percentile_interval, lambda x: x,
+                 suffix='pctscale')
+register_stretch('sqrt', get_percentile_interval, N.sqrt)
+register_stretch('asinh', get_percentile_interval, asinh_curve)
+register_stretch('zscale', get_zscale_limits, lambda x: x, suffix='zscale')
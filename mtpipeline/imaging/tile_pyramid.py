@@ -0,0 +1,169 @@
+#! /usr/bin/env python
+
+'''
+Multi-resolution tiles of the 8 bit PNG images.
+
+A tile pyramid lets a viewer load only the tiles it displays. Level 0
+is the full resolution image, and every following level is the one
+before it block averaged 2x2, until the whole image fits in one tile.
+Every level is cut into tiles of tile_size x tile_size pixels, smaller
+at the right and bottom edges. Each level is made from the one before
+it while its tiles are handed out, so the levels after the first add
+at most a third of the 8 bit image in memory.
+
+The tiles of an image are described by a JSON manifest, which the
+ephem scripts read to fill the sub_images table. The tile positions
+are pixels of their level; multiply by 2 ** scale_level for the full
+resolution image.
+'''
+
+import json
+import os
+
+import numpy as N
+
+# The default tile width and height, see the `tile_size` setting.
+TILE_SIZE = 256
+
+# -----------------------------------------------------------------------------
+# Functions (alphabetical)
+# -----------------------------------------------------------------------------
+
+def downsample(image):
+    '''
+    Return the 2x2 block average of a uint8 image, rounded to the
+    nearest integer. An odd last row or column is averaged with a copy
+    of itself.
+    '''
+    assert isinstance(image, N.ndarray), 'image must be numpy array'
+    assert image.ndim == 2, 'Expected a 2D image, got {}D.'.format(image.ndim)
+    if image.shape[0] % 2 or image.shape[1] % 2:
+        image = N.pad(image, ((0, image.shape[0] % 2),
+                              (0, image.shape[1] % 2)), 'edge')
+    total = image[0::2, 0::2].astype(N.uint16)
+    total += image[1::2, 0::2]
+    total += image[0::2, 1::2]
+    total += image[1::2, 1::2]
+    total += 2
+    total //= 4
+    return total.astype(N.uint8)
+
+# -----------------------------------------------------------------------------
+
+def get_level_count(shape, tile_size=TILE_SIZE):
+    '''
+    Return the number of levels of the pyramid of an image shape, the
+    last one fitting in a single tile.
+    '''
+    height, width = shape
+    levels = 1
+    while height > tile_size or width > tile_size:
+        height, width = (height + 1) // 2, (width + 1) // 2
+        levels += 1
+    return levels
+
+# -----------------------------------------------------------------------------
+
+def iter_tiles(image, tile_size=TILE_SIZE):
+    '''
+    Yield the tiles of every level of the pyramid of an image.
+
+    Parameters:
+        image : N.ndarray
+            The 2D uint8 image.
+        tile_size : int
+            The tile width and height.
+
+    Returns:
+        tiles : generator
+            Yields (record, tile) pairs. The tile is a view of its level
+            image and the record a dictionary with the 'scale_level',
+            'row' and 'column' of the tile in the level grid, and its
+            'x', 'y', 'width' and 'height' in level pixels.
+
+    Outputs:
+        nothing
+    '''
+    assert tile_size > 0, 'tile_size must be positive.'
+    levels = get_level_count(image.shape, tile_size)
+    for level in range(levels):
+        if level > 0:
+            image = downsample(image)
+        height, width = image.shape
+        for row, y in enumerate(range(0, height, tile_size)):
+            for column, x in enumerate(range(0, width, tile_size)):
+                tile = image[y:y + tile_size, x:x + tile_size]
+                record = {'scale_level' : level, 'row' : row,
+                          'column' : column, 'x' : x, 'y' : y,
+                          'width' : tile.shape[1], 'height' : tile.shape[0]}
+                yield record, tile
+
+# -----------------------------------------------------------------------------
+
+def make_manifest_name(png_name):
+    '''
+    Return the path of the tile manifest of a PNG.
+    '''
+    return os.path.splitext(png_name)[0] + '_tiles.json'
+
+# -----------------------------------------------------------------------------
+
+def make_tile_name(png_name, record):
+    '''
+    Return the path of a tile PNG, in the `<png name>_tiles` folder
+    next to the PNG of the whole image.
+    '''
+    root = os.path.splitext(png_name)[0]
+    return os.path.join(root + '_tiles', '{0}_{1}_{2}_{3}.png'.format(
+        os.path.basename(root), record['scale_level'], record['row'],
+        record['column']))
+
+# -----------------------------------------------------------------------------
+
+def read_manifest(manifest_name):
+    '''
+    Return the tile manifest written by write_manifest.
+    '''
+    with open(manifest_name, 'r') as f:
+        return json.load(f)
+
+# -----------------------------------------------------------------------------
+
+def write_manifest(manifest_name, png_name, fits_file, shape, tile_size,
+        records):
+    '''
+    Write the tile manifest of an image under a temporary name and
+    rename it.
+
+    Parameters:
+        manifest_name : string
+            The path of the manifest.
+        png_name : string
+            The PNG of the whole image.
+        fits_file : string
+            The FITS file the PNG was made from.
+        shape : tuple
+            The (height, width) of the full resolution image.
+        tile_size : int
+            The tile width and height.
+        records : list
+            The records of iter_tiles, with the tile file 'name' added.
+
+    Returns:
+        nothing
+
+    Outputs:
+        The manifest file.
+    '''
+    manifest = {'png_name' : os.path.basename(png_name),
+                'fits_file' : os.path.basename(fits_file),
+                'height' : shape[0], 'width' : shape[1],
+                'tile_size' : tile_size,
+                'levels' : get_level_count(shape, tile_size),
+                'tile_location' : os.path.dirname(
+                    os.path.abspath(make_tile_name(png_name, records[0]))),
+                'tiles' : records}
+    tmp = manifest_name + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.rename(tmp, manifest_name)
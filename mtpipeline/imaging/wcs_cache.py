@@ -0,0 +1,177 @@
+"""A per-process cache of updatewcs solutions, keyed by rootname.
+
+The drizzle stage updates the WCS of both the original c0m/flt file of
+an exposure and its cosmic ray rejected copy. The two share the same
+pointing and distortion solution, so running updatewcs on the copy
+repeats the whole reference file lookup for nothing.
+
+update_wcs runs updatewcs once, on the first file of an exposure it
+sees, and caches what it changed: the non-structural header cards of
+the primary and science extensions, the cards it removed, and the
+distortion and WCS table extensions (WCSDVARR, D2IMARR, WCSCORR, ...).
+Later files of the same exposure get the cached solution copied in.
+A file whose extensions don't line up with the cached exposure falls
+back to updatewcs.
+"""
+
+import collections
+import logging
+import os
+
+from astropy.io import fits
+from stwcs import updatewcs
+
+from mtpipeline.database.header_catalog import get_header
+from mtpipeline.imaging.wcs_extensions import WCS_EXTNAMES
+
+# The keywords describing the layout of an HDU, never copied.
+STRUCTURAL_KEYWORDS = ['SIMPLE', 'XTENSION', 'BITPIX', 'NAXIS', 'NAXIS1',
+                       'NAXIS2', 'NAXIS3', 'EXTEND', 'PCOUNT', 'GCOUNT',
+                       'BSCALE', 'BZERO', 'CHECKSUM', 'DATASUM', 'EXTNAME',
+                       'EXTVER', '', 'COMMENT', 'HISTORY']
+
+# The number of exposures kept in the cache of a process.
+CACHE_SIZE = 16
+
+# rootname -> the cached solution, see get_solution.
+_CACHE = collections.OrderedDict()
+
+# -----------------------------------------------------------------------------
+# Functions (alphabetical)
+# -----------------------------------------------------------------------------
+
+def apply_solution(filename, solution):
+    """Copy a cached solution into a file.
+
+    Parameters:
+        filename : string
+            A FITS file of the exposure the solution was computed for.
+        solution : dict
+            As returned by get_solution.
+
+    Returns:
+        applied : bool
+            False, with the file unchanged, when its extensions don't
+            match the ones the solution was computed from.
+
+    Outputs:
+        The updated FITS file.
+    """
+    with fits.open(filename, mode='update') as hdulist:
+        extensions = [hdu for hdu in hdulist
+                      if hdu.name not in WCS_EXTNAMES]
+        if [hdu.name for hdu in extensions] != solution['extnames']:
+            return False
+        for hdu, cards, removed in zip(extensions, solution['cards'],
+                                       solution['removed']):
+            for keyword in removed:
+                if keyword in hdu.header:
+                    del hdu.header[keyword]
+            for keyword, value, comment in cards:
+                hdu.header[keyword] = (value, comment)
+        for index in reversed(range(len(hdulist))):
+            if hdulist[index].name in WCS_EXTNAMES:
+                del hdulist[index]
+        for hdu in solution['wcs_hdus']:
+            hdulist.append(hdu.copy())
+    return True
+
+# -----------------------------------------------------------------------------
+
+def get_cards(header):
+    """Return the non-structural (keyword, value, comment) cards."""
+    return [(card.keyword, card.value, card.comment)
+            for card in header.cards
+            if card.keyword not in STRUCTURAL_KEYWORDS]
+
+# -----------------------------------------------------------------------------
+
+def get_rootname(filename):
+    """Return the ROOTNAME of an exposure, or the start of its filename.
+
+    The pipeline outputs keep the primary header of their input, so the
+    original and the cosmic ray rejected file have the same ROOTNAME.
+    """
+    rootname = get_header(filename, keywords=['ROOTNAME']).get('ROOTNAME')
+    if not rootname:
+        rootname = os.path.basename(filename).split('_')[0]
+    return str(rootname).strip().lower()
+
+# -----------------------------------------------------------------------------
+
+def get_solution(before, filename):
+    """Run updatewcs on a file and return what it changed.
+
+    Parameters:
+        before : list
+            The headers of the non-WCS extensions of filename before
+            the update.
+        filename : string
+            The FITS file to update.
+
+    Returns:
+        solution : dict
+            Has keys 'source' (filename), 'extnames', 'cards' (the
+            get_cards of every non-WCS extension after the update),
+            'removed' (the keywords updatewcs deleted from each), and
+            'wcs_hdus' (copies of the WCS_EXTNAMES extensions).
+
+    Outputs:
+        The updated FITS file.
+    """
+    updatewcs.updatewcs(filename)
+    with fits.open(filename) as hdulist:
+        extensions = [hdu for hdu in hdulist
+                      if hdu.name not in WCS_EXTNAMES]
+        cards = [get_cards(hdu.header) for hdu in extensions]
+        removed = []
+        for header, after in zip(before, cards):
+            kept = set(card[0] for card in after)
+            removed.append([keyword for keyword, value, comment
+                            in get_cards(header) if keyword not in kept])
+        wcs_hdus = [hdu.copy() for hdu in hdulist
+                    if hdu.name in WCS_EXTNAMES]
+        extnames = [hdu.name for hdu in extensions]
+    return {'source' : os.path.abspath(filename),
+            'extnames' : extnames,
+            'cards' : cards,
+            'removed' : removed,
+            'wcs_hdus' : wcs_hdus}
+
+# -----------------------------------------------------------------------------
+
+def update_wcs(filename):
+    """Update the WCS of a file, reusing the solution of its exposure.
+
+    The first file of an exposure, and any file seen again, runs
+    updatewcs and refreshes the cache. Other files of the exposure get
+    the cached solution.
+
+    Parameters:
+        filename : string
+            A c0m/flt file or a pipeline output made from one.
+
+    Returns:
+        nothing
+
+    Outputs:
+        The updated FITS file.
+    """
+    rootname = get_rootname(filename)
+    solution = _CACHE.get(rootname)
+    if solution is not None and \
+            solution['source'] != os.path.abspath(filename):
+        if apply_solution(filename, solution):
+            logging.info("Copied the WCS of {0} to {1}".format(
+                solution['source'], filename))
+            return
+        logging.info("Extensions of {} don't match, running updatewcs".format(
+            filename))
+
+    with fits.open(filename) as hdulist:
+        before = [hdu.header.copy() for hdu in hdulist
+                  if hdu.name not in WCS_EXTNAMES]
+    _CACHE.pop(rootname, None)
+    _CACHE[rootname] = get_solution(before, filename)
+    while len(_CACHE) > CACHE_SIZE:
+        _CACHE.popitem(last=False)
@@ -0,0 +1,8 @@
+"""The names of the FITS extensions updatewcs adds to its inputs.
+
+Kept apart from wcs_cache, which needs stwcs, so the modules that only
+have to recognize these extensions, e.g. provenance, don't.
+"""
+
+# The extensions updatewcs adds, copied whole by wcs_cache.
+WCS_EXTNAMES = ['WCSDVARR', 'D2IMARR', 'WCSCORR', 'SIPWCS', 'HDRLET']
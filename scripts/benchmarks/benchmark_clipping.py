@@ -0,0 +1,107 @@
+#! /usr/bin/env python
+
+"""Compare sorting with the selection methods of the clipping module.
+
+A synthetic 4k x 4k ACS/WFC drizzled output (sky, sources, cosmic ray
+residuals, and a zero filled border) or the drizzled outputs given on
+the command line are clipped at the 1% and 99% pixels. The script
+prints the time to find the limits by a full sort of a copy, as
+run_trim used to, by N.partition, and by histogram selection, and
+checks all three give the same limits, then times the clip itself.
+
+Use:
+    >>> python benchmark_clipping.py
+    >>> python benchmark_clipping.py -filelist '/path/to/*_sci.fits'
+"""
+
+import argparse
+import glob
+import time
+
+import numpy as N
+import pyfits
+
+from mtpipeline.imaging.clipping import clip_in_place
+from mtpipeline.imaging.clipping import get_percentile_limits
+
+# -----------------------------------------------------------------------------
+# Functions (alphabetical)
+# -----------------------------------------------------------------------------
+
+def make_image(shape=(4096, 4096), seed=0):
+    """Return a synthetic drizzled output with a zero filled border."""
+    random = N.random.RandomState(seed)
+    image = random.normal(0.05, 0.01, shape).astype(N.float32)
+    ny, nx = shape
+    y = random.randint(0, ny, ny * nx // 1000)
+    x = random.randint(0, nx, ny * nx // 1000)
+    image[y, x] += random.lognormal(0.0, 2.0, y.size).astype(N.float32)
+    image[:ny // 20] = 0.0
+    image[:, :nx // 20] = 0.0
+    return image
+
+# -----------------------------------------------------------------------------
+
+def sort_limits(array):
+    """Return the 1% and 99% limits the way run_trim used to."""
+    sorted_array = array.copy().ravel()
+    sorted_array.sort()
+    return [sorted_array[int(len(sorted_array) * 0.01)],
+            sorted_array[int(len(sorted_array) * 0.99)]]
+
+# -----------------------------------------------------------------------------
+
+def benchmark_clipping_main(image_list):
+    """Time the limits and clip of every image and print the results."""
+    print '{0:30} {1:>8} {2:>10} {3:>10} {4:>8}'.format(
+        'image', 'sort', 'partition', 'histogram', 'clip')
+    for name, image in image_list:
+        timings = {}
+        limits = {}
+        for method in ['sort', 'partition', 'histogram']:
+            start = time.time()
+            if method == 'sort':
+                limits[method] = sort_limits(image)
+            else:
+                limits[method] = get_percentile_limits(image, 0.01, 0.99,
+                                                       method)
+            timings[method] = time.time() - start
+        assert limits['partition'] == limits['sort'] and \
+            limits['histogram'] == limits['sort'], \
+            'Limits differ: {}'.format(limits)
+        start = time.time()
+        clip_in_place(image, *limits['sort'])
+        timings['clip'] = time.time() - start
+        print '{0:30} {1:>7.3f}s {2:>9.3f}s {3:>9.3f}s {4:>7.3f}s'.format(
+            name, timings['sort'], timings['partition'],
+            timings['histogram'], timings['clip'])
+
+# -----------------------------------------------------------------------------
+# For command line execution.
+# -----------------------------------------------------------------------------
+
+def parse_args():
+    '''
+    Parse the command line arguments.
+    '''
+    parser = argparse.ArgumentParser(
+        description = 'Benchmark the clipping methods of run_trim.')
+    parser.add_argument(
+        '-filelist',
+        required = False,
+        default = None,
+        help = 'Search string for drizzled FITS files. Default is a '
+               'synthetic 4k x 4k image.')
+    args = parser.parse_args()
+    return args
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.filelist is None:
+        image_list = [('synthetic 4096x4096', make_image())]
+    else:
+        image_list = [(filename, pyfits.getdata(filename).astype(N.float32))
+                      for filename in sorted(glob.glob(args.filelist))]
+    benchmark_clipping_main(image_list)
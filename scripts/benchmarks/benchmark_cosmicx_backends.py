@@ -0,0 +1,109 @@
+#! /usr/bin/env python
+
+"""Compare the lacosmicx and numpy cosmic ray rejection backends.
+
+For every detector that gets cosmic ray rejection, a synthetic chip of
+the detector size is made with sky noise, stars, and cosmic rays, and
+cleaned with the parameters of its first cosmicx_cfg extension by both
+backends. The script prints the wall clock time of each backend, the
+number of cleaned pixels, the number of pixels cleaned by only one of
+them, and the largest difference of the cleaned images.
+
+Use:
+    >>> python benchmark_cosmicx_backends.py -scale 0.25
+"""
+
+import argparse
+import time
+
+import numpy as N
+
+from mtpipeline.imaging.run_cosmicx import BACKENDS
+from mtpipeline.imaging.run_cosmicx import get_cosmicx_params
+
+# The chip shape (rows, columns) of each detector.
+DETECTOR_SHAPES = {'WFPC2' : (800, 800),
+                   'HRC' : (1024, 1024),
+                   'WFC' : (2048, 4096),
+                   'UVIS' : (2051, 4096)}
+
+# -----------------------------------------------------------------------------
+# Functions (alphabetical)
+# -----------------------------------------------------------------------------
+
+def make_image(shape, satlevel, seed=0):
+    """Return a synthetic chip with sky, stars, and cosmic rays."""
+    random = N.random.RandomState(seed)
+    image = random.normal(100.0, 5.0, shape).astype(N.float32)
+    ny, nx = shape
+    npix = ny * nx
+    # Cosmic rays, some of them two pixels long.
+    y = random.randint(0, ny, npix // 2000)
+    x = random.randint(0, nx - 1, npix // 2000)
+    image[y, x] += random.uniform(500.0, 5000.0, y.size).astype(N.float32)
+    image[y[::3], x[::3] + 1] += 800.0
+    # Stars, a few of them saturated.
+    for i in range(npix // 20000):
+        cy, cx = random.randint(5, ny - 5), random.randint(5, nx - 5)
+        peak = random.uniform(0.05, 2.0) * satlevel
+        image[cy - 5:cy + 6, cx - 5:cx + 6] += (peak * N.exp(
+            -((N.arange(-5, 6)[:, None] ** 2 + N.arange(-5, 6)[None, :] ** 2)
+              / (2 * 1.5 ** 2)))).astype(N.float32)
+    return image
+
+# -----------------------------------------------------------------------------
+
+def benchmark_cosmicx_backends_main(scale):
+    """Run both backends on every detector and print the comparison."""
+    print '{0:6} {1:>11} {2:>10} {3:>10} {4:>9} {5:>9} {6:>8} {7:>10}'.format(
+        'det', 'shape', 'lacosmicx', 'numpy', 'cleaned', 'cleaned', 'differ',
+        'max diff')
+    for detector in sorted(DETECTOR_SHAPES):
+        shape = tuple(int(size * scale) for size in DETECTOR_SHAPES[detector])
+        cosmicx_params = get_cosmicx_params({'detector' : detector,
+                                             'readnoise' : None,
+                                             'gain' : None})
+        params = dict(cosmicx_params[sorted(cosmicx_params)[0]])
+        params['verbose'] = False
+        for key in ['backend', 'inmask', 'outmaskfile']:
+            params.pop(key, None)
+        image = make_image(shape, params['satlevel'])
+        results = {}
+        timings = {}
+        for name in ['lacosmicx', 'numpy']:
+            start = time.time()
+            results[name] = BACKENDS[name].run(image, **params)
+            timings[name] = time.time() - start
+        masks = {name : results[name] != image for name in results}
+        print '{0:6} {1:>11} {2:>9.2f}s {3:>9.2f}s {4:>9} {5:>9} {6:>8} {7:>10.2g}'.format(
+            detector, '{0}x{1}'.format(*shape), timings['lacosmicx'],
+            timings['numpy'], masks['lacosmicx'].sum(), masks['numpy'].sum(),
+            (masks['lacosmicx'] ^ masks['numpy']).sum(),
+            N.abs(results['lacosmicx'] - results['numpy']).max())
+
+# -----------------------------------------------------------------------------
+# For command line execution.
+# -----------------------------------------------------------------------------
+
+def parse_args():
+    '''
+    Parse the command line arguments.
+    '''
+    parser = argparse.ArgumentParser(
+        description = 'Benchmark the cosmic ray rejection backends.')
+    parser.add_argument(
+        '-scale',
+        required = False,
+        type = float,
+        default = 1.0,
+        help = 'Scale the detector sizes by this factor. Default is 1.')
+    args = parser.parse_args()
+    return args
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    args = parse_args()
+    assert BACKENDS['lacosmicx'] is not None, \
+        'The _lacosmicx extension is not built.'
+    benchmark_cosmicx_backends_main(args.scale)
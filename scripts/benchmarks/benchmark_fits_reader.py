@@ -0,0 +1,95 @@
+#! /usr/bin/env python
+
+"""Compare the header-only FITS reader against astropy.
+
+Reads the keywords used by get_metadata from every file in the file
+list with `astropy.io.fits.getheader`, with `fits_reader.read_cards`,
+and with `fits_reader.read_cards_batch`, checks that the values agree,
+and prints the wall clock time of each.
+
+Use:
+    >>> python benchmark_fits_reader.py -filelist '/path/to/files/*_c0m.fits'
+"""
+
+import argparse
+import glob
+import time
+
+from astropy.io import fits
+from mtpipeline.fits_reader import read_cards
+from mtpipeline.fits_reader import read_cards_batch
+from mtpipeline.imaging.imaging_pipeline import HEADER_KEYWORDS
+
+# -----------------------------------------------------------------------------
+# Functions (alphabetical)
+# -----------------------------------------------------------------------------
+
+def read_astropy(file_list, keywords):
+    """Read the keywords of every file with astropy."""
+    headers = {}
+    for filename in file_list:
+        header = fits.getheader(filename)
+        headers[filename] = {keyword : header[keyword]
+                             for keyword in keywords if keyword in header}
+    return headers
+
+# -----------------------------------------------------------------------------
+
+def benchmark_fits_reader_main(file_list, threads):
+    """Time each reader and check the results agree."""
+    timings = []
+    start = time.time()
+    expected = read_astropy(file_list, HEADER_KEYWORDS)
+    timings.append(('astropy getheader', time.time() - start))
+
+    start = time.time()
+    serial = {filename : read_cards(filename, HEADER_KEYWORDS)
+              for filename in file_list}
+    timings.append(('read_cards', time.time() - start))
+
+    start = time.time()
+    batch = read_cards_batch(file_list, HEADER_KEYWORDS, threads=threads)
+    timings.append(('read_cards_batch ({} threads)'.format(threads),
+                    time.time() - start))
+
+    for filename in file_list:
+        assert dict(serial[filename]) == expected[filename], \
+            'read_cards disagrees with astropy for ' + filename
+        assert dict(batch[filename]) == expected[filename], \
+            'read_cards_batch disagrees with astropy for ' + filename
+
+    print 'Read {} keywords from {} files.'.format(len(HEADER_KEYWORDS),
+                                                 len(file_list))
+    for name, seconds in timings:
+        print '{0:35} {1:8.3f} s'.format(name, seconds)
+
+# -----------------------------------------------------------------------------
+# For command line execution.
+# -----------------------------------------------------------------------------
+
+def parse_args():
+    '''
+    Parse the command line arguments.
+    '''
+    parser = argparse.ArgumentParser(
+        description = 'Benchmark the FITS header readers.')
+    parser.add_argument(
+        '-filelist',
+        required = True,
+        help = 'Search string for FITS files. Wildcards accepted.')
+    parser.add_argument(
+        '-threads',
+        required = False,
+        type = int,
+        default = 8,
+        help = 'Threads used by read_cards_batch. Default is 8.')
+    args = parser.parse_args()
+    return args
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    args = parse_args()
+    file_list = glob.glob(args.filelist)
+    assert file_list != [], 'No files matched ' + args.filelist
+    benchmark_fits_reader_main(file_list, args.threads)
@@ -9,12 +9,12 @@
     Alex Viana, April 2014
 """
 
-from mtpipeline.imaging.imaging_pipeline import imaging_pipeline
+from mtpipeline.imaging.stage_scheduler import StageScheduler
+from mtpipeline.database.header_catalog import get_catalog
 from mtpipeline import email_decorator
 from mtpipeline.setup_logging import setup_logging
 from mtpipeline.get_settings import SETTINGS
 
-import multiprocessing as mp
 import glob
 import argparse
 import logging
@@ -74,43 +74,29 @@ def parse_args():
         default = False,
         dest = 'reproc',
         help = 'Reprocess all files, even if outputs already exist.')
+    parser.add_argument(
+        '-incremental',
+        required = False,
+        action = 'store_true',
+        default = False,
+        dest = 'incremental',
+        help = 'Reprocess only the steps whose inputs, parameters, or \
+            pipeline version changed since they last ran.')
+    parser.add_argument(
+        '-cr_mode',
+        required = False,
+        choices = ['single', 'stack'],
+        default = None,
+        dest = 'cr_mode',
+        help = 'Reject cosmic rays one file at a time (single) or in \
+            stacks of exposures from the same visit (stack). Default is \
+            the cosmicx_mode setting.')
 
     args = parser.parse_args()
 
     return args
 
 
-def run_imaging_pipeline(filename):
-    """
-        The script for executing the imaging_pipeline function.
-        
-        This function is the wrapper for the `imaging_pipeline` function
-        in `mtpipeline`. It adds logging information and parses the
-        command line arguments returned by `parse_args`. Completion emails
-        are added by the `email_decorator` function.
-        
-        Parameters:
-        nothing
-        
-        Returns:
-        nothing
-        
-        Outputs:
-        The outputs of this are the same as the wrapped
-        `imaging_pipeline`.
-    """
-    logging.info("Current File: " + filename)
-    try:
-        imaging_pipeline(filename,
-                         output_path =  args_list.output_path,
-                         cr_reject_switch = args_list.cr_reject,
-                         astrodrizzle_switch = args_list.astrodrizzle,
-                         png_switch = args_list.png,
-                         reproc_switch = args_list.reproc)
-        logging.info("Completed: " + filename)
-    except Exception as err:
-        logging.critical("{0} {1} {2}".format(type(err), err.message, sys.exc_traceback.tb_lineno))
-
 @email_decorator.email_decorator
 def run():
     """
@@ -125,10 +111,22 @@ def run():
                      and ('_flt.fits' in filename or '_c0m.fits' in filename)]
     assert rootfile_list != [], 'empty rootfile_list in mtpipeline.py.'
     logging.info("Processing: {} files".format(len(rootfile_list)))
-    num_cores = SETTINGS['num_cores']
-    logging.info("Number of Processes: {}".format(num_cores))
-    pool = mp.Pool(processes=num_cores)
-    pool.map(run_imaging_pipeline, rootfile_list)
+    catalog = get_catalog()
+    if catalog is not None:
+        logging.info("Header catalog: read {} headers".format(
+            catalog.scan(rootfile_list)))
+    stages = [stage for stage, switch in [('cr_reject', args_list.cr_reject),
+                                          ('drizzle', args_list.astrodrizzle),
+                                          ('png', args_list.png)]
+              if switch]
+    assert stages != [], 'All the pipeline steps are toggled off.'
+    scheduler = StageScheduler(stages = stages,
+                               output_path = args_list.output_path,
+                               reproc_switch = args_list.reproc,
+                               incremental_switch = args_list.incremental,
+                               cr_mode = args_list.cr_mode)
+    failed = scheduler.run(rootfile_list)
+    logging.info("Failed: {} files".format(len(failed)))
     logging.info("Script completed")
 
 if __name__ == '__main__':
@@ -244,12 +244,34 @@ int main(int argc, char* argv[]) {
 lacosmicx::lacosmicx(float* data, bool* mask, int nx, int ny, float pssl,
 		float gain, float readnoise, float sigclip, float sigfrac,
 		float objlim, float satlevel, bool robust, bool verbose) {
+	allocate(nx, ny);
+	reset(data, mask, pssl, gain, readnoise, sigclip, sigfrac, objlim,
+			satlevel, robust, verbose);
+}
 
-	int i;
+lacosmicx::lacosmicx(int nx, int ny) {
+	allocate(nx, ny);
+}
+
+void lacosmicx::allocate(int nx, int ny) {
 	this->nx = nx;
 	this->ny = ny;
-	int this_nxny = nx * ny;
-	this->nxny = this_nxny;
+	this->nxny = nx * ny;
+	cleanarr = new float[nxny];
+	crmask = new bool[nxny];
+}
+
+void lacosmicx::reset(float* data, bool* mask, float pssl, float gain,
+		float readnoise, float sigclip, float sigfrac, float objlim,
+		float satlevel, bool robust, bool verbose) {
+	/*
+	 Point the object at a new image of the same size. The working arrays
+	 allocated by the constructor are reused, so one object can clean many
+	 images without allocating cleanarr and crmask each time.
+	 */
+
+	int i;
+	int this_nxny = nxny;
 
 #pragma omp parallel for firstprivate(this_nxny,data,gain,pssl) private(i)
 	for (i = 0; i < this_nxny; i++) {
@@ -293,7 +315,6 @@ lacosmicx::lacosmicx(float* data, bool* mask, int nx, int ny, float pssl,
 	backgroundlevel = median(gooddata, ngoodpix);
 	delete[] gooddata;
 
-	cleanarr = new float[nxny];
 	float* this_cleanarr;
 	this_cleanarr = cleanarr;
 #pragma omp parallel for firstprivate(this_cleanarr,this_nxny,data) private(i)
@@ -301,7 +322,6 @@ lacosmicx::lacosmicx(float* data, bool* mask, int nx, int ny, float pssl,
 		this_cleanarr[i] = data[i]; // In lacosmiciteration() we work on this guy
 	}
 
-	crmask = new bool[nxny];
 	bool *this_crmask;
 	this_crmask = crmask;
 #pragma omp parallel for firstprivate(this_nxny,this_crmask) private(i)
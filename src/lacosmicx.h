@@ -59,11 +59,19 @@ public:
 			float gain = 1.0, float readnoise = 6.5, float sigclip = 4.5,
 			float sigfrac = 0.3, float objlim = 5.0, float satlevel = 50000.0,
 			bool robust = false, bool verbose = true);
+	//Only allocates the working arrays, call reset before run
+	lacosmicx(int nx, int ny);
 	~lacosmicx();
+	void reset(float* data, bool* mask, float pssl = 0.0, float gain = 1.0,
+			float readnoise = 6.5, float sigclip = 4.5, float sigfrac = 0.3,
+			float objlim = 5.0, float satlevel = 50000.0, bool robust = false,
+			bool verbose = true);
 	void run(int maxiter = 4);
 	void findsatstars();
 	int lacosmiciteration();
 	void clean();
+private:
+	void allocate(int nx, int ny);
 };
 
 #endif /* LACOSMICX_H_ */
@@ -14,15 +14,132 @@ using namespace std;
 PyMethodDef _lacosmicxMethods[] = { { "pyrun", pyrun, METH_VARARGS }, { NULL,
 		NULL } /* Sentinel - marks the end of this structure */
 };
+
+/* ==== The Engine type =============================== */
+PyMethodDef EngineMethods[] = { { "run", (PyCFunction) Engine_run,
+		METH_VARARGS }, { NULL, NULL } /* Sentinel */
+};
+
+PyTypeObject EngineType = { PyObject_HEAD_INIT(NULL) 0, /* ob_size */
+"_lacosmicx.Engine", /* tp_name */
+sizeof(EngineObject), /* tp_basicsize */
+0, /* tp_itemsize */
+(destructor) Engine_dealloc, /* tp_dealloc */
+};
+
 PyMODINIT_FUNC init_lacosmicx() {
-	(void) Py_InitModule("_lacosmicx", _lacosmicxMethods);
+	PyObject* m;
+	EngineType.tp_flags = Py_TPFLAGS_DEFAULT;
+	EngineType.tp_doc = "Reusable lacosmicx engine, see Engine_run.";
+	EngineType.tp_methods = EngineMethods;
+	EngineType.tp_new = Engine_new;
+	if (PyType_Ready(&EngineType) < 0)
+		return;
+	m = Py_InitModule("_lacosmicx", _lacosmicxMethods);
 	import_array(); // Must be present for NumPy.  Called first after above line.
+	Py_INCREF(&EngineType);
+	PyModule_AddObject(m, "Engine", (PyObject *) &EngineType);
+}
+
+PyObject* Engine_new(PyTypeObject* type, PyObject* args, PyObject* kwds) {
+	EngineObject* self;
+	self = (EngineObject *) type->tp_alloc(type, 0);
+	if (self != NULL) {
+		self->l = NULL;
+		self->busy = false;
+	}
+	return (PyObject *) self;
+}
+
+void Engine_dealloc(EngineObject* self) {
+	delete self->l;
+	self->ob_type->tp_free((PyObject *) self);
+}
+
+bool check_image(PyArrayObject* array, int type, int ny, int nx,
+		const char* name) {
+	//The arrays are used in place, so they must have exactly this layout
+	if (PyArray_NDIM(array) != 2 || PyArray_DIM(array, 0) != ny
+			|| PyArray_DIM(array, 1) != nx || PyArray_TYPE(array) != type
+			|| !PyArray_ISCARRAY(array)) {
+		PyErr_Format(PyExc_ValueError,
+				"%s must be an aligned, writeable, C-contiguous array of "
+				"shape (%d, %d) and type %s", name, ny, nx,
+				type == NPY_FLOAT ? "float32" : "bool");
+		return false;
+	}
+	return true;
+}
+
+PyObject* Engine_run(EngineObject* self, PyObject* args) {
+
+	//This is how the call looks in python
+	//engine.run(data,mask,out,outmaskfile,sigclip,objlim,sigfrac,satlevel,gain,pssl,readnoise,robust,verbose,niter)
+	//The data are scaled in place and scaled back at the end, and the mask
+	//is replaced by the mask of saturated stars and bad pixels.
+	PyArrayObject *indat, *inmask, *outdat;
+	char* outmaskfile;
+	int nx, ny;
+	float sigclip, objlim, satlevel, gain, pssl, readnoise, sigfrac;
+	bool verbose;
+	bool robust;
+	int niter;
+	if (!PyArg_ParseTuple(args, "O!O!O!sfffffffbbi", &PyArray_Type, &indat,
+			&PyArray_Type, &inmask, &PyArray_Type, &outdat, &outmaskfile,
+			&sigclip, &objlim, &sigfrac, &satlevel, &gain, &pssl, &readnoise,
+			&robust, &verbose, &niter))
+		return NULL;
+
+	if (PyArray_NDIM(indat) != 2) {
+		PyErr_SetString(PyExc_ValueError, "data must be a 2D array");
+		return NULL;
+	}
+	ny = PyArray_DIM(indat, 0);
+	nx = PyArray_DIM(indat, 1);
+	if (!check_image(indat, NPY_FLOAT, ny, nx, "data")
+			|| !check_image(inmask, NPY_BOOL, ny, nx, "mask")
+			|| !check_image(outdat, NPY_FLOAT, ny, nx, "out"))
+		return NULL;
+
+	//The working arrays are shared, so only one thread can use an engine
+	if (self->busy) {
+		PyErr_SetString(PyExc_RuntimeError,
+				"Engine is already running in another thread");
+		return NULL;
+	}
+	self->busy = true;
+
+	float* data = (float*) PyArray_DATA(indat);
+	bool* mask = (bool*) PyArray_DATA(inmask);
+	float* out = (float*) PyArray_DATA(outdat);
+	lacosmicx* l = self->l;
+
+	Py_BEGIN_ALLOW_THREADS
+	//Only reallocate the working arrays when the image size changes
+	if (l == NULL || l->nx != nx || l->ny != ny) {
+		delete l;
+		l = new lacosmicx(nx, ny);
+	}
+	l->reset(data, mask, pssl, gain, readnoise, sigclip, sigfrac, objlim,
+			satlevel, robust, verbose);
+	l->run(niter);
+	memcpy(out, l->cleanarr, sizeof(float) * nx * ny);
+	Py_END_ALLOW_THREADS
+
+	self->l = l;
+	self->busy = false;
+
+	if (strcmp(outmaskfile, "") != 0) {
+		booltofits((char *) outmaskfile, l->crmask, nx, ny);
+	}
+
+	Py_INCREF(outdat);
+	return PyArray_Return(outdat);
 }
 
 PyObject* pyrun(PyObject* self, PyObject* args) {
 
 	//This is how the call looks in python
-	Py_Initialize();
 	//_Lacosmicx.pyrun(inmat,inmask,outmaskfile,nx,ny,sigclip,objlim,sigfrac,satlevel,gain,pssl,readnoise,robust,verbose,niter)
 	PyArrayObject *indat, *inmask;
 	char* outmaskfile;
@@ -47,10 +164,14 @@ PyObject* pyrun(PyObject* self, PyObject* args) {
 	mask = pyvector_to_Carrayptrsbool(inmask);
 
 	lacosmicx* l;
+	// The algorithm only touches C arrays, so release the GIL to let
+	// other threads clean other chips at the same time.
+	Py_BEGIN_ALLOW_THREADS
 	l = new lacosmicx(data, mask, nx, ny, pssl, gain, readnoise, sigclip,
 			sigfrac, objlim, satlevel, robust, verbose);
 
 	l->run(niter);
+	Py_END_ALLOW_THREADS
 	//cout << l;
 	if (strcmp(outmaskfile, "") != 0) {
 		booltofits((char *) outmaskfile, l->crmask, nx, ny);
@@ -62,10 +183,12 @@ PyObject* pyrun(PyObject* self, PyObject* args) {
 	float* cout;
 	cout = pyvector_to_Carrayptrs(outdat);
 	int nxny = nx * ny;
+	Py_BEGIN_ALLOW_THREADS
 	for (i = 0; i < nxny; i++) {
 		cout[i] = l->cleanarr[i];
 	}
 	delete l;
+	Py_END_ALLOW_THREADS
 
 	return PyArray_Return(outdat);
 }
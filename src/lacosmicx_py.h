@@ -11,8 +11,19 @@
 #include "arrayobject.h"
 #include "lacosmicx.h"
 
+typedef struct {
+	PyObject_HEAD
+	lacosmicx* l;
+	bool busy;
+} EngineObject;
+
 PyMODINIT_FUNC init_lacosmicx();
 static PyObject* pyrun(PyObject* self, PyObject* args);
+PyObject* Engine_new(PyTypeObject* type, PyObject* args, PyObject* kwds);
+void Engine_dealloc(EngineObject* self);
+PyObject* Engine_run(EngineObject* self, PyObject* args);
+bool check_image(PyArrayObject* array, int type, int ny, int nx,
+		const char* name);
 float* pyvector_to_Carrayptrs(PyArrayObject* arrayin);
 bool* pyvector_to_Carrayptrsbool(PyArrayObject* arrayin);
 
@@ -2,9 +2,21 @@
 Nose tests for the run_trim.py module.
 '''
 
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from multiprocessing.pool import ThreadPool
+from PIL import Image
+
 from mtpipeline.imaging.run_trim import get_value_by_pixel_count
 from mtpipeline.imaging.run_trim import clip
 from mtpipeline.imaging.run_trim import PNGCreator 
+from mtpipeline.imaging.run_trim import render_pngs
+from mtpipeline.imaging.run_trim import stretch_to_uint8
+from mtpipeline.imaging.run_trim import wait_for_pngs
 
 import numpy as N 
 
@@ -56,6 +68,21 @@ class test_clip(object):
         error = 'test_clip.bottom_test got ' + str(top_test_result) + ' expected 10'
         assert top_test_result == 10, error
 
+class test_imports(object):
+    '''
+    Test run_trim leaves matplotlib to the before_after plots.
+    '''
+    def matplotlib_test(self):
+        '''
+        Test importing run_trim and png_stats doesn't import matplotlib.
+        '''
+        loaded = subprocess.check_output([sys.executable, '-c',
+            'import sys\n'
+            'import mtpipeline.imaging.run_trim\n'
+            'import mtpipeline.imaging.png_stats\n'
+            'print("matplotlib" in sys.modules)'])
+        assert loaded.split()[-1] == 'False', 'Imported matplotlib.'
+
 class test_positive(object):
     '''
     Test for the positive function in run_trim. Because it's hard 
@@ -72,3 +99,81 @@ class test_positive(object):
         expected = N.array([0,1]) + 0.0001
         difference = round(abs(N.sum(result - expected)))
         assert difference == 0, 'positive is not working.'
+
+class test_stretch_to_uint8(object):
+    '''
+    Test for the stretch_to_uint8 function in run_trim.
+    '''
+    def compress_test(self):
+        '''
+        Test the chunked stretches match the PNGCreator steps.
+        '''
+        input_array = N.random.RandomState(0).lognormal(
+            0, 2, (600, 70)).astype('>f4') - 0.5
+        pngc = PNGCreator(N.flipud(input_array).astype(N.float32))
+        pngc.threshold_clip(0.0001, 2e5)
+        pngc_log = PNGCreator(pngc.data)
+        pngc_log.log()
+        pngc_log.compress()
+        pngc.compress()
+        linear, log = stretch_to_uint8(input_array)
+        assert (linear == N.uint8(pngc.data)).all(), \
+            'The linear stretch differs from compress.'
+        assert (log == N.uint8(pngc_log.data)).all(), \
+            'The log stretch differs from compress.'
+
+    def copy_test(self):
+        '''
+        Test PNGCreator works on its input with copy=False.
+        '''
+        input_array = N.array([[1.0, 2.0], [3.0, 4.0]])
+        pngc = PNGCreator(input_array, copy=False)
+        pngc.threshold_clip(2.0, 3.0)
+        assert (input_array == N.array([[2.0, 2.0], [3.0, 3.0]])).all(), \
+            'Expected the threshold clip in place.'
+
+class test_render_pngs(object):
+    '''
+    Test for the render_pngs function in run_trim.
+    '''
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.path)
+
+    def pool_test(self):
+        '''
+        Test the PNGs written by a thread pool match the 8 bit images.
+        '''
+        data = N.random.RandomState(0).lognormal(
+            0, 2, (900, 1400)).astype(N.float32)
+        linear = stretch_to_uint8(data, log_switch=False)[0]
+        pool = ThreadPool(processes=2)
+        try:
+            wait_for_pngs(render_pngs(data, self.path, 'u2mi0102t.fits',
+                                      subimage_switch=True, pool=pool))
+        finally:
+            pool.close()
+            pool.join()
+        assert len(os.listdir(self.path)) == 26, \
+            'Expected 26 PNGs, got {}'.format(len(os.listdir(self.path)))
+        png = N.asarray(Image.open(os.path.join(self.path,
+                                                'u2mi0102t-linscale.png')))
+        assert (png == linear).all(), 'The linear PNG differs.'
+
+    def thumbnail_test(self):
+        '''
+        Test a thumbnail is written for every full and subimage PNG.
+        '''
+        data = N.random.RandomState(0).lognormal(
+            0, 2, (900, 1400)).astype(N.float32)
+        render_pngs(data, self.path, 'u2mi0102t.fits', subimage_switch=True,
+                    thumbnail_switch=True)
+        thumbnails = os.listdir(os.path.join(self.path, 'thumbnails'))
+        assert len(thumbnails) == 26, \
+            'Expected 26 thumbnails, got {}'.format(len(thumbnails))
+        thumbnail = Image.open(os.path.join(self.path, 'thumbnails',
+                                            'u2mi0102t-linscale.jpg'))
+        assert thumbnail.size == (128, 82), \
+            'Wrong thumbnail size {}'.format(thumbnail.size)
@@ -0,0 +1,87 @@
+'''
+Nose tests for the build_sub_images_table.py module, on an in-memory
+sqlite3 database.
+'''
+
+import glob
+import os
+import shutil
+import tempfile
+
+from astropy.io import fits
+
+from mtpipeline.database import database_interface
+from mtpipeline.database import database_tools
+from mtpipeline.database.database_interface import MasterImages
+from mtpipeline.database.database_interface import SubImages
+from mtpipeline.database.database_interface import loadConnection
+from mtpipeline.ephem import build_sub_images_table
+from mtpipeline.get_settings import SETTINGS
+from mtpipeline.imaging.imaging_pipeline import png_stage
+
+import numpy as N
+
+header = {
+    'proposid':6741,
+    'targname':'MARS-CML345',
+    'NAXIS1':200,
+    'NAXIS2':300,
+    'RA_TARG':183.540921043,
+    'DEC_TARG':-1.29559572252,
+    'FILTNAM1':'F255W',
+    'LINENUM':'19.821'}
+
+class test_png_stage_thumbnails(object):
+    '''
+    Test the thumbnails of the png stage fill the thumbnail_location of
+    the sub_images records of their tiles.
+    '''
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+        self.fits_file = os.path.join(self.path,
+                                      'u2mi0102t_c0m_wide_single_sci.fits')
+        fits.PrimaryHDU(N.random.RandomState(0).lognormal(
+            0, 2, (300, 200)).astype(N.float32)).writeto(self.fits_file)
+        self.settings = dict(SETTINGS)
+        SETTINGS.update({'png_tiles' : True, 'tile_size' : 128,
+                         'png_thumbnails' : True, 'png_threads' : 2})
+        self.session, Base, engine = loadConnection('sqlite:///:memory:')
+        database_interface.Base.metadata.create_all(bind=engine)
+        build_sub_images_table.session = self.session
+        database_tools.session = self.session
+
+    def teardown(self):
+        SETTINGS.clear()
+        SETTINGS.update(self.settings)
+        build_sub_images_table.session = database_interface.session
+        database_tools.session = database_interface.session
+        self.session.close()
+        shutil.rmtree(self.path)
+
+    def thumbnail_location_test(self):
+        '''
+        Test every tile record of the linear PNG gets the folder of its
+        thumbnail.
+        '''
+        root = os.path.join(self.path, 'u2mi0102t_c0m_wide_single_sci')
+        png_stage({'drizzle_output' : [self.fits_file],
+                   'drizzle_weight' : [root + '_wht.fits'],
+                   'png_output' : [root + '-linscale.png']}, self.path)
+        png_name = root + '-linscale.png'
+        self.session.add(MasterImages(header, self.fits_file, png_name))
+        self.session.commit()
+        build_sub_images_table.build_tile_records_main(
+            root + '-linscale_tiles.json', False)
+        thumbnail_list = glob.glob(root + '-linscale_tiles/thumbnails/*.jpg')
+        count = build_sub_images_table.update_thumbnail_locations_main(
+            thumbnail_list)
+        records = self.session.query(SubImages).all()
+        assert len(records) == 3 * 2 + 2 + 1, \
+            'Expected 9 tile records, got {}'.format(len(records))
+        assert count == len(records), \
+            'Updated {0} of {1} records.'.format(count, len(records))
+        for record in records:
+            assert os.path.isfile(os.path.join(
+                record.thumbnail_location,
+                os.path.splitext(record.name)[0] + '.jpg')), \
+                'No thumbnail for ' + record.name
@@ -0,0 +1,82 @@
+'''
+Nose tests for the bulk_copy.py module.
+'''
+
+from mtpipeline.bulk_copy import bulk_copy
+from mtpipeline.bulk_copy import MANIFEST_NAME
+
+import json
+import os
+import shutil
+import tempfile
+
+class test_bulk_copy(object):
+    '''
+    Test which files are copied again.
+    '''
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+        self.src_root = os.path.join(self.path, 'archive')
+        self.dst_root = os.path.join(self.path, 'drizzled')
+        os.mkdir(self.src_root)
+        self.file_list = []
+        for name in ['a_c0m.fits', 'b_c0m.fits', 'c_c0m.fits']:
+            filename = os.path.join(self.src_root, name)
+            with open(filename, 'w') as f:
+                f.write(name * 1000)
+            self.file_list.append(filename)
+
+    def teardown(self):
+        shutil.rmtree(self.path)
+
+    def actions(self, **kwargs):
+        records = bulk_copy(self.file_list, self.dst_root, threads=2,
+                            **kwargs)
+        return [record['action'] for record in records]
+
+    def copy_test(self):
+        '''
+        Test the files are copied once and the manifest is written.
+        '''
+        assert self.actions() == ['copied'] * 3, 'Expected 3 copies.'
+        assert self.actions() == ['skipped'] * 3, 'Expected 3 skips.'
+        with open(os.path.join(self.dst_root, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+        assert sorted(manifest) == ['a_c0m.fits', 'b_c0m.fits',
+                                    'c_c0m.fits'], 'Wrong manifest.'
+        assert sorted(os.listdir(self.dst_root)) == \
+            ['a_c0m.fits', 'b_c0m.fits', 'c_c0m.fits', MANIFEST_NAME], \
+            'Unexpected files {}'.format(os.listdir(self.dst_root))
+
+    def stale_test(self):
+        '''
+        Test truncated copies and changed sources are copied again.
+        '''
+        self.actions()
+        os.remove(os.path.join(self.dst_root, MANIFEST_NAME))
+        with open(os.path.join(self.dst_root, 'a_c0m.fits'), 'w') as f:
+            f.write('a_c0m')
+        with open(self.file_list[1], 'a') as f:
+            f.write('new')
+        # Same size and content, but a different modification time.
+        os.utime(os.path.join(self.dst_root, 'c_c0m.fits'), (0, 0))
+        assert self.actions() == ['copied', 'copied', 'skipped'], \
+            'Expected the truncated and changed files copied.'
+
+    def recopy_test(self):
+        '''
+        Test recopy_switch copies every file.
+        '''
+        self.actions()
+        assert self.actions(recopy_switch=True) == ['copied'] * 3, \
+            'Expected 3 copies.'
+
+    def hardlink_test(self):
+        '''
+        Test files on the same file system are linked.
+        '''
+        assert self.actions(hardlink_switch=True) == ['linked'] * 3, \
+            'Expected 3 links.'
+        assert os.stat(self.file_list[0]).st_ino == \
+            os.stat(os.path.join(self.dst_root, 'a_c0m.fits')).st_ino, \
+            'Expected a hard link.'
@@ -0,0 +1,72 @@
+'''
+Nose tests for the clipping.py module.
+'''
+
+from mtpipeline.imaging import clipping
+from mtpipeline.imaging.run_trim import top_bottom_clip
+
+import numpy as N
+
+class test_get_order_statistics(object):
+    '''
+    Test the selection methods give the values of a full sort.
+    '''
+    def setup(self):
+        random = N.random.RandomState(0)
+        self.array = random.lognormal(3.0, 1.0, (200, 150)).astype(N.float32)
+        self.array[:10, :10] = 0.0
+        self.sorted_array = N.sort(self.array.ravel())
+        self.kth_list = [0, 1, 99, 100, 300, 15000, 29700, -1]
+
+    def partition_test(self):
+        '''
+        Test the partition method against a sort.
+        '''
+        values = clipping.get_order_statistics(self.array, self.kth_list,
+                                               'partition')
+        assert values == [self.sorted_array[kth] for kth in self.kth_list], \
+            'Wrong values {}'.format(values)
+
+    def histogram_test(self):
+        '''
+        Test the histogram method against a sort, with a few bins.
+        '''
+        bins = clipping.HISTOGRAM_BINS
+        clipping.HISTOGRAM_BINS = 7
+        try:
+            values = clipping.get_order_statistics(self.array, self.kth_list,
+                                                   'histogram')
+        finally:
+            clipping.HISTOGRAM_BINS = bins
+        assert values == [self.sorted_array[kth] for kth in self.kth_list], \
+            'Wrong values {}'.format(values)
+
+    def nan_test(self):
+        '''
+        Test NaNs sort last and the histogram method falls back.
+        '''
+        self.array[0, :5] = N.nan
+        values = clipping.get_order_statistics(self.array, [0, -6, -1],
+                                               'histogram')
+        assert values[:2] == [0.0, N.nanmax(self.array)], \
+            'Wrong values {}'.format(values)
+        assert N.isnan(values[2]), 'Expected NaN last.'
+
+    def unchanged_test(self):
+        '''
+        Test the input is not changed.
+        '''
+        before = self.array.copy()
+        clipping.get_order_statistics(self.array, self.kth_list)
+        assert (self.array == before).all(), 'The input was changed.'
+
+class test_top_bottom_clip(object):
+    '''
+    Test top_bottom_clip clips in place at the 1% and 99% pixels.
+    '''
+    def limits_test(self):
+        array = N.arange(1000, dtype=N.float32)[::-1].reshape((10, 100))
+        result = top_bottom_clip(array)
+        assert result is array, 'Expected the clip in place.'
+        assert array.min() == 10.0 and array.max() == 990.0, \
+            'Wrong limits {0} {1}'.format(array.min(), array.max())
@@ -0,0 +1,49 @@
+'''
+Nose tests for the cosmicx_registry.py module.
+'''
+
+from mtpipeline.imaging.cosmicx_registry import get_params
+from mtpipeline.imaging.cosmicx_registry import get_params_hash
+from mtpipeline.imaging.cosmicx_registry import validate
+
+from nose.tools import raises
+
+def test_get_params_copy():
+    '''
+    Test changing the returned parameters doesn't change the registry.
+    '''
+    cosmicx_params = get_params('WFPC2')
+    expected = cosmicx_params[1]['sigclip']
+    cosmicx_params[1]['sigclip'] = -1.0
+    assert get_params('WFPC2')[1]['sigclip'] == expected, \
+        'The registry was modified.'
+
+def test_get_params_overrides():
+    '''
+    Test the header read noise and gain override every extension.
+    '''
+    cosmicx_params = get_params('WFPC2', readnoise=7.5, gain=2.0)
+    for params in cosmicx_params.values():
+        assert params['readnoise'] == 7.5, 'readnoise not overridden.'
+        assert params['gain'] == 2.0, 'gain not overridden.'
+    assert get_params('WFPC2')[1]['readnoise'] != 7.5, \
+        'The override leaked into the registry.'
+
+def test_get_params_hash():
+    '''
+    Test the hash changes with the header overrides.
+    '''
+    assert get_params_hash(get_params('UVIS')) == \
+        get_params_hash(get_params('UVIS')), 'Expected a stable hash.'
+    assert get_params_hash(get_params('UVIS')) != \
+        get_params_hash(get_params('UVIS', readnoise=3.0)), \
+        'Expected a different hash.'
+
+@raises(AssertionError)
+def test_validate_missing():
+    '''
+    Test a config without niter is rejected.
+    '''
+    params = get_params('HRC')
+    del params[1]['niter']
+    validate(params, 'HRC_params.yaml')
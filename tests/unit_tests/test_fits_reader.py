@@ -0,0 +1,108 @@
+'''
+Nose tests for the fits_reader.py module.
+'''
+
+from mtpipeline.fits_reader import cards_from_header
+from mtpipeline.fits_reader import parse_card
+from mtpipeline.fits_reader import read_cards
+from mtpipeline.fits_reader import read_cards_batch
+
+from astropy.io import fits
+
+import numpy as N
+import os
+import shutil
+import tempfile
+
+class test_read_cards(object):
+    '''
+    Compare read_cards with astropy on a multi-extension file.
+    '''
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+        self.fits_file = os.path.join(self.path, 'u2eu0101f_c0m.fits')
+        header = fits.Header()
+        header['TARGNAME'] = 'MARS-CML345'
+        header['LINENUM'] = '19.821'
+        header['EXPTIME'] = 2.5
+        header['PROPOSID'] = 5832
+        header['MOONWIN'] = False
+        header['NOTE'] = "it's  "
+        header['HISTORY'] = 'Not a value card.'
+        hdulist = fits.HDUList([fits.PrimaryHDU(header=header)])
+        for chip in range(1, 5):
+            sci = fits.ImageHDU(N.zeros((17, 13), dtype=N.float32))
+            sci.header['CRPIX1'] = 100.5 * chip
+            hdulist.append(sci)
+        hdulist.writeto(self.fits_file)
+
+    def teardown(self):
+        shutil.rmtree(self.path)
+
+    def primary_test(self):
+        '''
+        Test every primary header value matches astropy.
+        '''
+        expected = fits.getheader(self.fits_file)
+        header = read_cards(self.fits_file)
+        for keyword in ['TARGNAME', 'LINENUM', 'EXPTIME', 'PROPOSID',
+                        'MOONWIN', 'NOTE', 'NAXIS']:
+            assert header[keyword] == expected[keyword], \
+                'Wrong value for ' + keyword
+            assert type(header[keyword]) == type(expected[keyword]), \
+                'Wrong type for ' + keyword
+        assert 'HISTORY' not in header, 'Expected no HISTORY card.'
+
+    def keywords_test(self):
+        '''
+        Test only the requested keywords are returned.
+        '''
+        header = read_cards(self.fits_file, ['targname', 'exptime', 'missing'])
+        assert sorted(header) == ['EXPTIME', 'TARGNAME'], \
+            'Unexpected keywords ' + str(sorted(header))
+
+    def extension_test(self):
+        '''
+        Test the data units are skipped to reach each extension.
+        '''
+        for ext in range(1, 5):
+            header = read_cards(self.fits_file, ['CRPIX1'], ext)
+            assert header['CRPIX1'] == fits.getval(self.fits_file, 'CRPIX1',
+                                                   ext), \
+                'Wrong CRPIX1 in extension {}'.format(ext)
+
+    def header_test(self):
+        '''
+        Test the cards of an astropy Header match the cards read.
+        '''
+        for ext in range(2):
+            expected = read_cards(self.fits_file, ext=ext)
+            header = cards_from_header(fits.getheader(self.fits_file, ext))
+            assert header == expected, 'Wrong cards in HDU {}'.format(ext)
+            for keyword in header:
+                assert type(header[keyword]) == type(expected[keyword]), \
+                    'Wrong type for ' + keyword
+
+    def batch_test(self):
+        '''
+        Test the batch reader returns one header per file.
+        '''
+        headers = read_cards_batch([self.fits_file] * 3, ['TARGNAME'],
+                                   threads=2)
+        assert headers[self.fits_file]['TARGNAME'] == 'MARS-CML345', \
+            'Wrong TARGNAME from read_cards_batch'
+
+def test_parse_card():
+    '''
+    Test the value formats that are parsed.
+    '''
+    cases = [("TARGNAME= 'MARS    '           / target", ('TARGNAME', 'MARS')),
+             ("NOTE    = 'it''s'", ('NOTE', "it's")),
+             ("EXPTIME =                  1.5D2", ('EXPTIME', 150.0)),
+             ("SIMPLE  =                    T", ('SIMPLE', True)),
+             ("NAXIS   =                    2 / axes", ('NAXIS', 2)),
+             ("UNDEF   =                      / no value", None),
+             ("COMMENT   just a comment", None)]
+    for card, expected in cases:
+        result = parse_card(card.ljust(80))
+        assert result == expected, 'Got {0} for {1}'.format(result, card)
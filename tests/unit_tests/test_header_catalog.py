@@ -0,0 +1,85 @@
+'''
+Nose tests for the header_catalog.py module.
+'''
+
+from mtpipeline.database.header_catalog import HeaderCatalog
+from mtpipeline.database.header_catalog import HeaderCards
+from mtpipeline.database.header_catalog import record_header
+from mtpipeline.get_settings import SETTINGS
+
+from astropy.io import fits
+
+import numpy as N
+import os
+import shutil
+import tempfile
+
+class test_header_catalog(object):
+    '''
+    Test the catalog on a small FITS file in a temporary directory.
+    '''
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+        self.fits_file = os.path.join(self.path, 'u2eu0101f_c0m.fits')
+        header = fits.Header()
+        header['TARGNAME'] = 'MARS-CML345'
+        header['LINENUM'] = '19.821'
+        header['EXPTIME'] = 2.5
+        fits.PrimaryHDU(N.zeros((4, 4), dtype=N.float32), header=header).\
+            writeto(self.fits_file)
+        self.catalog = HeaderCatalog(os.path.join(self.path, 'catalog.db'))
+
+    def teardown(self):
+        self.catalog.connection.close()
+        shutil.rmtree(self.path)
+
+    def scan_test(self):
+        '''
+        Test that a second scan finds nothing new to read.
+        '''
+        assert self.catalog.scan([self.fits_file], processes=1) == 1, \
+            'Expected the first scan to read 1 header.'
+        assert self.catalog.scan([self.fits_file], processes=1) == 0, \
+            'Expected the second scan to read 0 headers.'
+
+    def value_test(self):
+        '''
+        Test the values and types of the catalogued cards.
+        '''
+        self.catalog.scan([self.fits_file], processes=1)
+        header = self.catalog.get_header(self.fits_file)
+        assert header['targname'] == 'MARS-CML345', 'Wrong TARGNAME'
+        assert isinstance(header['targname'], str), 'Expected str TARGNAME'
+        assert header['exptime'] == 2.5, 'Wrong EXPTIME'
+
+    def stale_test(self):
+        '''
+        Test that an edited file is read again.
+        '''
+        self.catalog.get_header(self.fits_file)
+        fits.setval(self.fits_file, 'TARGNAME', value='JUPITER')
+        header = self.catalog.get_header(self.fits_file)
+        assert header['TARGNAME'] == 'JUPITER', 'Got a stale header.'
+
+    def record_test(self):
+        '''
+        Test a recorded header is returned without reading the file.
+        '''
+        header = HeaderCards({'TARGNAME' : 'RECORDED'})
+        setting = SETTINGS.get('header_catalog')
+        SETTINGS['header_catalog'] = self.catalog.path
+        try:
+            record_header(self.fits_file, header)
+        finally:
+            SETTINGS['header_catalog'] = setting
+        assert self.catalog.get_header(self.fits_file)['TARGNAME'] == \
+            'RECORDED', 'Expected the recorded header.'
+
+def test_header_cards():
+    '''
+    Test the keyword lookups are case-insensitive.
+    '''
+    header = HeaderCards({'date-obs' : '1995-01-01'})
+    assert header['DATE-OBS'] == '1995-01-01', 'Upper case lookup failed.'
+    assert 'Date-Obs' in header, 'Mixed case membership failed.'
+    assert header.get('targname') is None, 'Expected None for a missing key.'
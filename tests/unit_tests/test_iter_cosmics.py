@@ -0,0 +1,51 @@
+'''
+Nose tests for the iter_cosmics.py module.
+'''
+
+from mtpipeline.imaging.iter_cosmics import get_overlap
+from mtpipeline.imaging.iter_cosmics import make_settings
+from mtpipeline.imaging.iter_cosmics import sweep
+from mtpipeline.imaging.lacosmic_numpy import run
+
+import numpy as N
+
+BASE_PARAMS = {'inmask' : None, 'outmaskfile' : '', 'pssl' : 0.0,
+               'gain' : 1.0, 'readnoise' : 5.0, 'sigclip' : 5.0,
+               'sigfrac' : 0.3, 'objlim' : 4.0, 'satlevel' : 50000.0,
+               'robust' : False, 'verbose' : False, 'niter' : 4}
+
+def test_sweep_matches_run():
+    '''
+    Test the shared products give the same masks as separate runs.
+    '''
+    random = N.random.RandomState(0)
+    image = random.normal(100.0, 5.0, (80, 90)).astype(N.float32)
+    image[random.randint(0, 80, 30), random.randint(0, 90, 30)] += 2000.0
+    settings = make_settings(BASE_PARAMS, {'sigclip' : [4.0, 6.0],
+                                           'readnoise' : [3.0, 5.0]})
+    table = sweep(image, settings, processes=1)
+    for params, row in zip(settings, table):
+        clean = run(image, **params)
+        assert row['crpix'] == (clean != image).sum(), \
+            'Wrong crpix for {}'.format(params)
+    assert table[0]['jaccard'] == 1.0, 'The reference should match itself.'
+
+def test_make_settings():
+    '''
+    Test one setting is made per combination.
+    '''
+    settings = make_settings(BASE_PARAMS, {'sigclip' : [3.0, 4.0, 5.0],
+                                           'niter' : [2, 4]})
+    assert len(settings) == 6, 'Expected 6 settings.'
+    assert BASE_PARAMS['sigclip'] == 5.0, 'The base parameters changed.'
+
+def test_get_overlap():
+    '''
+    Test the overlap counts of two small masks.
+    '''
+    mask = N.array([True, True, False, False])
+    reference = N.array([True, False, True, False])
+    overlap = get_overlap(mask, reference)
+    assert overlap == {'common' : 1, 'only_setting' : 1,
+                       'only_reference' : 1, 'jaccard' : 1.0 / 3}, \
+        'Unexpected overlap ' + str(overlap)
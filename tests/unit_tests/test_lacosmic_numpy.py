@@ -0,0 +1,53 @@
+'''
+Nose tests for the lacosmic_numpy.py module.
+'''
+
+from mtpipeline.imaging.lacosmic_numpy import run
+from mtpipeline.imaging.lacosmic_numpy import sepmedfilt
+
+import numpy as N
+
+class test_run(object):
+    '''
+    Test the cosmic ray rejection on a synthetic image.
+    '''
+    def setup(self):
+        random = N.random.RandomState(0)
+        self.image = random.normal(100.0, 5.0, (120, 100)).astype(N.float32)
+        self.cosmics = [(20, 30), (60, 61), (90, 15)]
+        for y, x in self.cosmics:
+            self.image[y, x] += 3000.0
+        self.params = {'sigclip' : 5.0, 'sigfrac' : 0.3, 'objlim' : 4.0,
+                       'satlevel' : 50000.0, 'readnoise' : 5.0, 'niter' : 4}
+
+    def cosmics_test(self):
+        '''
+        Test the cosmic rays are cleaned and the sky is left alone.
+        '''
+        clean = run(self.image, **self.params)
+        for y, x in self.cosmics:
+            assert abs(clean[y, x] - 100.0) < 20.0, \
+                'Cosmic ray at {0} not cleaned.'.format((y, x))
+        changed = clean != self.image
+        assert changed.sum() < 50, 'Too many pixels changed.'
+
+    def copy_test(self):
+        '''
+        Test the input is not changed and out is filled.
+        '''
+        original = self.image.copy()
+        out = N.empty_like(self.image)
+        clean = run(self.image, out=out, **self.params)
+        assert clean is out, 'Expected the out array to be returned.'
+        assert (self.image == original).all(), 'The input was modified.'
+
+def test_sepmedfilt():
+    '''
+    Test the separable median against row then column medians.
+    '''
+    data = N.random.RandomState(1).normal(size=(12, 11)).astype(N.float32)
+    result = sepmedfilt(data, 3)
+    rowmed = N.median([data[:, :-2], data[:, 1:-1], data[:, 2:]], axis=0)
+    expected = N.median([rowmed[:-2], rowmed[1:-1], rowmed[2:]], axis=0)
+    assert N.allclose(result[1:-1, 1:-1], expected), 'Wrong interior.'
+    assert (result[0] == data[0]).all(), 'Expected the border copied.'
@@ -0,0 +1,72 @@
+'''
+Nose tests for the png_stats.py module.
+'''
+
+import csv
+import os
+import shutil
+import tempfile
+
+from mtpipeline.imaging import png_stats
+from mtpipeline.imaging.run_trim import render_pngs
+
+import numpy as N
+
+class test_get_image_stats(object):
+    '''
+    Test the statistics of an 8 bit image.
+    '''
+    def levels_test(self):
+        '''
+        Test the histogram and the quantile levels of a ramp.
+        '''
+        image = N.arange(256, dtype=N.uint8).repeat(4).reshape((32, 32))
+        record = png_stats.get_image_stats(image, 'a.fits', 'a-linscale.png',
+                                           'linscale', (0.0, 1.0))
+        assert record['histogram'] == [4] * 256, 'Wrong histogram.'
+        assert record['pixels'] == 1024, 'Wrong pixel count.'
+        assert record['quantile_levels']['50'] == 127, \
+            'Wrong median level {}'.format(record['quantile_levels']['50'])
+        assert record['mean_level'] == 127.5, 'Wrong mean level.'
+        assert record['data_quantiles'] == {}, 'Expected no data quantiles.'
+
+class test_render_pngs_stats(object):
+    '''
+    Test render_pngs appends the statistics of every PNG.
+    '''
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.path)
+
+    def append_test(self):
+        '''
+        Test the clip counts and the records of two renders, with one
+        .csv header.
+        '''
+        data = N.linspace(-1.0, 3e5, 64 * 48).reshape((64, 48))
+        data[0, 1] = N.nan
+        stats_name = os.path.join(self.path, 'png_stats')
+        for count in range(2):
+            render_pngs(data, self.path, 'u2mi0102t_wide_single_sci.fits',
+                        stats_name = stats_name, data_range = (-1.0, 3e5),
+                        stretch_list = ['asinh'])
+        records = png_stats.read_stats(stats_name + '.jsonl')
+        assert [record['suffix'] for record in records] == \
+            ['linscale', 'logscale', 'asinhscale'] * 2, 'Wrong records.'
+        record = records[0]
+        assert record['nan_count'] == 1, 'Wrong NaN count.'
+        assert record['below_minimum'] == 1, \
+            'Wrong count below the minimum {}'.format(record['below_minimum'])
+        assert record['above_maximum'] == (data > 2e5).sum(), \
+            'Wrong count above the maximum {}'.format(record['above_maximum'])
+        assert record['high'] == 2e5, 'Wrong high limit.'
+        assert record['data_quantiles']['50'] > 1e5, 'Wrong data median.'
+        assert [records[2][key] for key in ['nan_count', 'below_minimum',
+                                            'above_maximum']] == [None] * 3, \
+            'Expected no threshold clip counts for the asinh stretch.'
+        with open(stats_name + '.csv', 'r') as f:
+            rows = list(csv.reader(f))
+        assert rows[0] == png_stats.get_csv_columns(), 'Wrong header.'
+        assert len(rows) == 1 + 6, 'Expected 6 rows, got {}'.format(len(rows))
@@ -0,0 +1,165 @@
+'''
+Nose tests for the preview_store.py module.
+'''
+
+import os
+import shutil
+import tempfile
+
+from astropy.io import fits
+from PIL import Image
+
+from mtpipeline.get_settings import SETTINGS
+from mtpipeline.imaging import png_stats
+from mtpipeline.imaging import preview_store
+from mtpipeline.imaging.run_trim import run_trim
+
+import numpy as N
+
+class test_preview_store(object):
+    '''
+    Test the PNGs rendered from a preview match the ones of the FITS file.
+    '''
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+        self.filename = os.path.join(self.path,
+                                     'u2mi0102t_c0m_wide_single_sci.fits')
+        self.data = N.random.RandomState(0).lognormal(
+            0, 2, (300, 200)).astype(N.float32)
+        self.data[0, :2] = [6e4, -1.0]
+        fits.PrimaryHDU(self.data).writeto(self.filename)
+        self.preview_name = os.path.join(
+            self.path, 'u2mi0102t_c0m_wide_single_sci_preview.npy')
+        self.settings = dict(SETTINGS)
+
+    def teardown(self):
+        SETTINGS.clear()
+        SETTINGS.update(self.settings)
+        shutil.rmtree(self.path)
+
+    def stats_test(self):
+        '''
+        Test the statistics are those of the full precision data.
+        '''
+        self.data[0, 2:4] = [N.nan, 1e5]
+        self.data[-5:] = 1e5
+        fits.PrimaryHDU(self.data).writeto(self.filename, overwrite=True)
+        stats = preview_store.write_preview(self.filename, self.path)
+        finite = self.data[N.isfinite(self.data)]
+        assert stats['maximum'] == 1e5 and stats['minimum'] == -1.0, \
+            'Wrong extremes {0} {1}'.format(stats['minimum'], stats['maximum'])
+        assert abs(stats['mean'] - finite.mean()) < 1e-3, 'Wrong mean.'
+        assert stats['finite_count'] == finite.size, 'Wrong count.'
+        assert stats['percentiles']['99'] == 1e5, \
+            'Expected the percentiles of the float32 data, not the preview.'
+        assert stats['percentiles']['50'] == \
+            N.sort(finite)[int(finite.size * 0.5)], 'Wrong median.'
+        preview, stats = preview_store.read_preview(os.path.join(
+            self.path, 'u2mi0102t_c0m_wide_single_sci_preview.npy'))
+        assert preview.dtype == N.float32 and preview.shape == (300, 200), \
+            'Wrong preview {0} {1}'.format(preview.dtype, preview.shape)
+
+    def rerender_test(self):
+        '''
+        Test the rerendered PNGs are within rounding of the originals.
+        '''
+        run_trim(self.filename, self.path)
+        png_name = os.path.join(self.path,
+                                'u2mi0102t_c0m_wide_single_sci-logscale.png')
+        original = N.asarray(Image.open(png_name)).astype(int)
+        preview_store.write_preview(self.filename, self.path)
+        output_path = os.path.join(self.path, 'rerender')
+        os.mkdir(output_path)
+        preview_store.rerender_previews(
+            [os.path.join(self.path,
+                          'u2mi0102t_c0m_wide_single_sci_preview.npy')],
+            output_path)
+        rerendered = N.asarray(Image.open(os.path.join(
+            output_path, os.path.basename(png_name)))).astype(int)
+        assert N.abs(rerendered - original).max() <= 1, \
+            'The rerendered PNG differs by up to {}.'.format(
+                N.abs(rerendered - original).max())
+
+    def block_test(self):
+        '''
+        Test a block averaged preview isn't rendered over the PNGs.
+        '''
+        preview_store.write_preview(self.filename, self.path, block=2)
+        try:
+            preview_store.rerender_previews([self.preview_name])
+        except AssertionError:
+            pass
+        else:
+            raise AssertionError('Rendered a block 2 preview.')
+        assert not os.path.exists(os.path.join(
+            self.path, 'u2mi0102t_c0m_wide_single_sci-linscale.png')), \
+            'Wrote the PNG of a block 2 preview.'
+
+    def outputs_test(self):
+        '''
+        Test the tiles, thumbnails and statistics are made again, like
+        in the png stage.
+        '''
+        SETTINGS.update({'png_tiles' : True, 'tile_size' : 128,
+                         'png_thumbnails' : True, 'png_stats' : True})
+        preview_store.write_preview(self.filename, self.path)
+        preview_store.rerender_previews([self.preview_name])
+        root = os.path.join(self.path, 'u2mi0102t_c0m_wide_single_sci')
+        for name in [root + '-linscale_tiles.json',
+                     root + '-linscale_tiles/thumbnails',
+                     os.path.join(self.path, 'thumbnails',
+                                  os.path.basename(root) + '-logscale.jpg')]:
+            assert os.path.exists(name), 'Missing ' + name
+        records = png_stats.read_stats(os.path.join(self.path,
+                                                    'png_stats.jsonl'))
+        assert [record['suffix'] for record in records] == \
+            ['linscale', 'logscale'], 'Wrong records.'
+
+    def float16_test(self):
+        '''
+        Test the pixels clipped in a float16 preview stay white.
+        '''
+        self.data[0, 2] = 1e5
+        fits.PrimaryHDU(self.data).writeto(self.filename, overwrite=True)
+        preview_store.write_preview(self.filename, self.path,
+                                    dtype='float16')
+        preview_store.rerender_previews([self.preview_name])
+        image = N.asarray(Image.open(os.path.join(
+            self.path, 'u2mi0102t_c0m_wide_single_sci-linscale.png')))
+        assert image[-1, 1:3].tolist() == [0, 255], \
+            'Wrong levels {}'.format(image[-1, 1:3].tolist())
+
+    def run_trim_test(self):
+        '''
+        Test run_trim writes the same preview from the chunks of the
+        stretch, without reading the FITS file again.
+        '''
+        expected = preview_store.write_preview(self.filename, self.path)
+        preview = N.array(preview_store.read_preview(self.preview_name)[0])
+        os.remove(self.preview_name)
+        get_fits_data = preview_store.get_fits_data
+        def fail(*args, **kwargs):
+            raise AssertionError('Read the FITS file again.')
+        preview_store.get_fits_data = fail
+        try:
+            run_trim(self.filename, self.path, preview_switch=True)
+        finally:
+            preview_store.get_fits_data = get_fits_data
+        data, stats = preview_store.read_preview(self.preview_name)
+        assert (data == preview).all(), 'Wrong preview.'
+        assert stats == expected, 'Wrong statistics.'
+
+    def chunk_block_test(self):
+        '''
+        Test the blocks that span two chunks are averaged.
+        '''
+        data = N.arange(50 * 8, dtype=N.float32).reshape((50, 8))
+        writer = preview_store.PreviewWriter(self.filename, self.path,
+                                             data.shape, block=3)
+        for start in range(0, 50, 7):
+            writer.add_chunk(data[start:start + 7])
+        stats = writer.close()
+        preview = preview_store.read_preview(self.preview_name)[0]
+        assert (preview == preview_store.block_average(data, 3)).all(), \
+            'Wrong block averages.'
+        assert stats['maximum'] == data.max(), 'Wrong maximum.'
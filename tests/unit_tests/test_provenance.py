@@ -0,0 +1,109 @@
+'''
+Nose tests for the provenance.py module.
+'''
+
+from mtpipeline.imaging.provenance import hash_params
+from mtpipeline.imaging.provenance import is_current
+from mtpipeline.imaging.provenance import make_manifest_name
+from mtpipeline.imaging.provenance import read_manifest
+from mtpipeline.imaging.provenance import record_stage
+
+from astropy.io import fits
+
+import datetime
+import numpy as N
+import os
+import shutil
+import tempfile
+
+class test_provenance(object):
+    '''
+    Test the stage records for a small FITS input file.
+    '''
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+        self.input_file = os.path.join(self.path, 'u2eu0101f_c0m.fits')
+        fits.PrimaryHDU(N.arange(100, dtype=N.float32).reshape(10, 10)).\
+            writeto(self.input_file)
+        self.manifest_name = os.path.join(self.path, 'test_provenance.json')
+        self.params_hash = hash_params({'sigclip' : 5.0})
+        record_stage(self.manifest_name, 'cr_reject', [self.input_file],
+                     [], self.params_hash, datetime.datetime.now())
+
+    def teardown(self):
+        shutil.rmtree(self.path)
+
+    def unchanged_test(self):
+        '''
+        Test that a stage is current right after it is recorded.
+        '''
+        manifest = read_manifest(self.manifest_name)
+        assert is_current(manifest, 'cr_reject', [self.input_file],
+                          self.params_hash), 'Expected the stage to be current.'
+
+    def params_test(self):
+        '''
+        Test that a parameter change makes the stage stale.
+        '''
+        manifest = read_manifest(self.manifest_name)
+        params_hash = hash_params({'sigclip' : 4.0})
+        assert not is_current(manifest, 'cr_reject', [self.input_file],
+                              params_hash), 'Expected the stage to be stale.'
+
+    def header_test(self):
+        '''
+        Test that a header edit does not make the stage stale.
+        '''
+        fits.setval(self.input_file, 'date-obs', value='1995-01-01')
+        manifest = read_manifest(self.manifest_name)
+        assert is_current(manifest, 'cr_reject', [self.input_file],
+                          self.params_hash), 'Expected the stage to be current.'
+
+    def wcs_extension_test(self):
+        '''
+        Test that the WCS extensions appended by updatewcs do not make
+        the stage stale.
+        '''
+        table = fits.BinTableHDU.from_columns(
+            [fits.Column(name='WCS_ID', format='24A', array=['OPUS'])],
+            name='WCSCORR')
+        fits.append(self.input_file, table.data, table.header)
+        manifest = read_manifest(self.manifest_name)
+        assert is_current(manifest, 'cr_reject', [self.input_file],
+                          self.params_hash), 'Expected the stage to be current.'
+
+    def data_test(self):
+        '''
+        Test that a data change makes the stage stale.
+        '''
+        with fits.open(self.input_file, mode='update') as hdulist:
+            hdulist[0].data[0, 0] = -1.0
+        manifest = read_manifest(self.manifest_name)
+        assert not is_current(manifest, 'cr_reject', [self.input_file],
+                              self.params_hash), 'Expected the stage to be stale.'
+
+    def missing_stage_test(self):
+        '''
+        Test that a stage that never ran is not current.
+        '''
+        manifest = read_manifest(self.manifest_name)
+        assert not is_current(manifest, 'drizzle', [self.input_file],
+                              self.params_hash), 'Expected the stage to be stale.'
+
+def test_hash_params():
+    '''
+    Test that the parameter hash does not depend on the key order.
+    '''
+    first = hash_params({'a' : 1, 'b' : {'c' : 2.0, 'd' : None}})
+    second = hash_params({'b' : {'d' : None, 'c' : 2.0}, 'a' : 1})
+    assert first == second, 'Expected the same hash.'
+
+def test_make_manifest_name():
+    '''
+    Test the manifest name is built from the weight file name.
+    '''
+    output_file_dict = {'drizzle_weight' :
+        ['dir/hlsp_mt_hst_wfpc2_asdfghjkl-mars_f606w_v1-0_wht.fits']}
+    expected = 'dir/hlsp_mt_hst_wfpc2_asdfghjkl-mars_f606w_v1-0_provenance.json'
+    assert make_manifest_name(output_file_dict) == expected, \
+        'Unexpected manifest name ' + make_manifest_name(output_file_dict)
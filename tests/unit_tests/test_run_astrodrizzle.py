@@ -0,0 +1,94 @@
+'''
+Nose tests for the run_astrodrizzle.py module.
+'''
+
+import os
+import shutil
+import tempfile
+
+from astropy.io import fits
+from mtpipeline.imaging import run_astrodrizzle
+
+import numpy as N
+
+class FakeAstroDrizzle(object):
+    '''
+    Stands in for drizzlepac.astrodrizzle. Writes the outputs and
+    scratch files AstroDrizzle writes next to its input.
+    '''
+    def __init__(self):
+        self.inputs = []
+
+    def AstroDrizzle(self, input, configobj):
+        assert os.path.islink(input), 'Expected a linked input.'
+        self.inputs.append(os.path.abspath(input))
+        root = input[:-9]
+        for suffix in ['_single_sci.fits', '_single_wht.fits']:
+            fits.PrimaryHDU(N.ones((3, 3))).writeto(root + suffix)
+        for name in [root + '_sci1_staticMask.fits', 'astrodrizzle.log']:
+            open(name, 'w').close()
+
+class test_run_astrodrizzle(object):
+    '''
+    Test AstroDrizzle runs in a scratch directory.
+    '''
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+        self.filename = os.path.join(self.path, 'u2mi0102t_c0m.fits')
+        primary = fits.PrimaryHDU()
+        primary.header['PROPOSID'] = 5832
+        primary.header['TARGNAME'] = 'MARS'
+        primary.writeto(self.filename)
+        open(self.filename.replace('c0m', 'c1m'), 'w').close()
+        self.output = os.path.join(self.path, 'u2mi0102t_c0m_sci.fits')
+        self.fake = FakeAstroDrizzle()
+        self.astrodrizzle = run_astrodrizzle.astrodrizzle
+        run_astrodrizzle.astrodrizzle = self.fake
+
+    def teardown(self):
+        run_astrodrizzle.astrodrizzle = self.astrodrizzle
+        shutil.rmtree(self.path)
+
+    def outputs_test(self):
+        '''
+        Test only the wanted outputs are left in the input folder.
+        '''
+        cwd = os.getcwd()
+        run_astrodrizzle.run_astrodrizzle(self.filename, self.output,
+                                          'WFPC2', '1995-01-01')
+        assert os.getcwd() == cwd, 'The working directory changed.'
+        assert sorted(os.listdir(self.path)) == \
+            ['u2mi0102t_c0m.fits', 'u2mi0102t_c0m_sci.fits',
+             'u2mi0102t_c0m_wht.fits', 'u2mi0102t_c1m.fits'], \
+            'Unexpected files {}'.format(os.listdir(self.path))
+        assert fits.getval(self.output, 'DATE-OBS') == '1995-01-01', \
+            'Expected DATE-OBS in the output.'
+        assert fits.getval(self.output, 'PROPOSID') == 5832, \
+            'Expected PROPOSID copied from the input.'
+
+    def keep_weight_test(self):
+        '''
+        Test the weight file is left out without keep_weight.
+        '''
+        run_astrodrizzle.run_astrodrizzle(self.filename, self.output,
+                                          'WFPC2', '1995-01-01',
+                                          keep_weight=False)
+        assert os.path.exists(self.output), 'Expected the output.'
+        assert not os.path.exists(self.output.replace('_sci', '_wht')), \
+            'Expected no weight file.'
+
+    def failure_test(self):
+        '''
+        Test the scratch directory is removed when AstroDrizzle fails.
+        '''
+        def fail(input, configobj):
+            raise ValueError('failed')
+        self.fake.AstroDrizzle = fail
+        try:
+            run_astrodrizzle.run_astrodrizzle(self.filename, self.output,
+                                              'WFPC2', '1995-01-01')
+        except ValueError:
+            pass
+        assert sorted(os.listdir(self.path)) == \
+            ['u2mi0102t_c0m.fits', 'u2mi0102t_c1m.fits'], \
+            'Unexpected files {}'.format(os.listdir(self.path))
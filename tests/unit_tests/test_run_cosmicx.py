@@ -0,0 +1,51 @@
+'''
+Nose tests for the tiling functions in run_cosmicx.py.
+'''
+
+import threading
+
+from mtpipeline.imaging.run_cosmicx import get_chip_pool
+from mtpipeline.imaging.run_cosmicx import get_tile_halo
+from mtpipeline.imaging.run_cosmicx import get_tiles
+
+import numpy as N
+
+def test_get_tiles_cover():
+    '''
+    Test the tiles cover every pixel of the image exactly once.
+    '''
+    count = N.zeros((300, 250), dtype=int)
+    for outer, inner, inner_local in get_tiles(count.shape, 128, 20):
+        count[inner] += 1
+    assert (count == 1).all(), 'Expected every pixel in exactly one tile.'
+
+def test_get_tiles_halo():
+    '''
+    Test the halo is cut at the image edges and inner_local matches inner.
+    '''
+    image = N.arange(300 * 250).reshape(300, 250)
+    for outer, inner, inner_local in get_tiles(image.shape, 128, 20):
+        assert (image[outer][inner_local] == image[inner]).all(), \
+            'inner_local does not select the tile from the outer region.'
+        assert outer[0].start >= 0 and outer[0].stop <= 300, \
+            'Halo extends past the image.'
+
+def test_get_tile_halo():
+    '''
+    Test the halo grows with the number of iterations.
+    '''
+    assert get_tile_halo({'niter' : 5}) > get_tile_halo({'niter' : 4}), \
+        'Expected a wider halo for more iterations.'
+
+def test_get_chip_pool():
+    '''
+    Test the chip pool, and so its threads and their engines, are kept
+    between files.
+    '''
+    name = lambda job: threading.current_thread().name
+    first = get_chip_pool(2)
+    threads = set(thread.name for thread in first._pool)
+    assert get_chip_pool(2) is first, 'Expected the same pool.'
+    assert set(first.map(name, range(8))) <= threads, \
+        'Expected the same threads.'
+    assert get_chip_pool(3) is not first, 'Expected a pool of 3 threads.'
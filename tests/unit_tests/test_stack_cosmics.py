@@ -0,0 +1,62 @@
+'''
+Nose tests for the stack_cosmics.py module.
+'''
+
+from mtpipeline.imaging.stack_cosmics import get_offsets
+from mtpipeline.imaging.stack_cosmics import reject_stack
+from mtpipeline.imaging.stack_cosmics import shift_image
+
+import numpy as N
+
+class test_reject_stack(object):
+    '''
+    Test the stack rejection on synthetic dithered exposures.
+    '''
+    def setup(self):
+        random = N.random.RandomState(0)
+        scene = N.full((130, 110), 50.0)
+        for y, x in random.randint(10, 100, (40, 2)):
+            scene[y - 1:y + 2, x - 1:x + 2] += random.uniform(200.0, 2000.0)
+        self.offsets = [(0, 0), (3, -2), (-4, 5)]
+        self.exptimes = [100.0, 100.0, 200.0]
+        self.stack = []
+        for (dy, dx), exptime in zip(self.offsets, self.exptimes):
+            # The exposure sees the scene moved by -offset, so shifting
+            # it by offset aligns it with the first one.
+            view = scene[10 + dy:120 + dy, 10 + dx:100 + dx] * exptime / 100.0
+            self.stack.append(random.normal(view, N.sqrt(view) + 3.0))
+        self.cosmics = [(0, 20, 30), (1, 60, 61), (2, 90, 15)]
+        for i, y, x in self.cosmics:
+            self.stack[i][y, x] += 5000.0
+        self.params = [{'gain' : 1.0, 'readnoise' : 3.0, 'sigclip' : 6.0,
+                        'sigfrac' : 0.5}] * 3
+
+    def offsets_test(self):
+        '''
+        Test the dithers are found.
+        '''
+        assert get_offsets(self.stack) == self.offsets, \
+            'Wrong offsets {}'.format(get_offsets(self.stack))
+
+    def cosmics_test(self):
+        '''
+        Test the cosmic rays are cleaned and few other pixels change.
+        '''
+        clean_stack, masks = reject_stack(self.stack, self.exptimes,
+                                          self.params)
+        for i, y, x in self.cosmics:
+            assert masks[i][y, x], 'Cosmic ray {} not found.'.format((i, y, x))
+            assert clean_stack[i][y, x] < 1000.0, \
+                'Cosmic ray {} not cleaned.'.format((i, y, x))
+        for mask in masks:
+            assert mask.sum() < 30, 'Too many pixels flagged.'
+
+def test_shift_image():
+    '''
+    Test the shift moves pixels by the offset and fills the rest.
+    '''
+    image = N.arange(20, dtype=N.float32).reshape(4, 5)
+    shifted = shift_image(image, (1, -2))
+    assert (shifted[1:, :3] == image[:3, 2:]).all(), 'Wrong shift.'
+    assert N.isnan(shifted[0]).all() and N.isnan(shifted[:, 3:]).all(), \
+        'Expected the uncovered pixels filled.'
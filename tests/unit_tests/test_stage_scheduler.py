@@ -0,0 +1,161 @@
+'''
+Nose tests for the stage_scheduler.py module.
+'''
+
+import os
+import signal
+import subprocess
+
+from multiprocessing.queues import SimpleQueue
+
+from mtpipeline.get_settings import SETTINGS
+from mtpipeline.imaging import stage_scheduler
+from mtpipeline.imaging.stage_scheduler import StageScheduler
+
+class test_finish(object):
+    '''
+    Test how the scheduler splits and joins the drizzle products.
+    '''
+    def setup(self):
+        self.scheduler = StageScheduler(stages=['drizzle', 'png'],
+                                        stage_cores={'drizzle' : 2,
+                                                     'png' : 1},
+                                        product_priority=-1)
+        self.scheduler.ready = {'drizzle' : [], 'png' : []}
+        self.scheduler.drizzling = {}
+        self.output_file_dict = {'drizzle_output' : ['a_img.fits',
+                                                     'a_sci.fits']}
+        self.recorded = []
+        self.drizzle_record = stage_scheduler.drizzle_record
+        stage_scheduler.drizzle_record = \
+            lambda output_file_dict, drizzle_run: self.recorded.append(
+                drizzle_run)
+
+    def teardown(self):
+        stage_scheduler.drizzle_record = self.drizzle_record
+
+    def make_prep_task(self, drizzle_run):
+        task = self.scheduler.make_task('a_c0m.fits', 'drizzle', {},
+                                        self.output_file_dict)
+        task['drizzle_run'] = drizzle_run
+        task['status'] = 'done'
+        return task
+
+    def products(self):
+        return [item[2] for item in sorted(self.scheduler.ready['drizzle'])]
+
+    def up_to_date_test(self):
+        '''
+        Test a file with current outputs finishes without products.
+        '''
+        finished = self.scheduler.finish(self.make_prep_task(None))
+        assert len(finished) == 1, 'Expected the file to finish.'
+        assert self.products() == [], 'Expected no product tasks.'
+
+    def products_test(self):
+        '''
+        Test the products run as tasks and the stage is recorded once.
+        '''
+        run = {'params_hash' : 'abc', 'started' : None}
+        assert self.scheduler.finish(self.make_prep_task(run)) == [], \
+            'Expected the file to wait for its products.'
+        products = self.products()
+        assert [task['product'] for task in products] == [0, 1], \
+            'Expected one task per product.'
+        assert all(task['priority'] == -1 for task in products), \
+            'Expected the product priority.'
+        for task in products:
+            task['status'] = 'done'
+        assert self.scheduler.finish(products[0]) == [], \
+            'Expected the file to wait for its second product.'
+        finished = self.scheduler.finish(products[1])
+        assert [task['status'] for task in finished] == ['done'], \
+            'Expected the file to finish.'
+        assert self.recorded == [run], 'Expected one provenance record.'
+
+    def failed_product_test(self):
+        '''
+        Test a failed product fails the file without a record.
+        '''
+        run = {'params_hash' : 'abc', 'started' : None}
+        self.scheduler.finish(self.make_prep_task(run))
+        products = self.products()
+        products[0]['status'] = 'failed'
+        products[1]['status'] = 'done'
+        self.scheduler.finish(products[0])
+        finished = self.scheduler.finish(products[1])
+        assert [task['status'] for task in finished] == ['failed'], \
+            'Expected the file to fail.'
+        assert self.recorded == [], 'Expected no provenance record.'
+
+class test_run(object):
+    '''
+    Test the scheduler fails the file of a worker that dies.
+    '''
+    def setup(self):
+        self.functions = {}
+        for name in ['get_metadata', 'make_output_file_dict', 'png_stage']:
+            self.functions[name] = getattr(stage_scheduler, name)
+        stage_scheduler.get_metadata = lambda filename: {}
+        stage_scheduler.make_output_file_dict = \
+            lambda filename, header_data: {'filename' : filename}
+        stage_scheduler.png_stage = self.png_stage
+        self.poll_seconds = stage_scheduler.POLL_SECONDS
+        stage_scheduler.POLL_SECONDS = 0.2
+
+    def teardown(self):
+        for name, function in self.functions.items():
+            setattr(stage_scheduler, name, function)
+        stage_scheduler.POLL_SECONDS = self.poll_seconds
+
+    @staticmethod
+    def png_stage(output_file_dict, output_path, reproc_switch,
+            incremental_switch):
+        if output_file_dict['filename'] == 'b_c0m.fits':
+            os.kill(os.getpid(), signal.SIGKILL)
+
+    def dead_worker_test(self):
+        '''
+        Test a killed worker fails its file and the others complete.
+        '''
+        scheduler = StageScheduler(stages=['png'], stage_cores={'png' : 2})
+        failed = scheduler.run(['a_c0m.fits', 'b_c0m.fits', 'c_c0m.fits'])
+        assert failed == ['b_c0m.fits'], 'Unexpected failures ' + str(failed)
+
+def test_find_lost_tasks():
+    '''
+    Test every start report is read, and only the task of a dead
+    worker is lost.
+    '''
+    scheduler = StageScheduler(stages=['png'], stage_cores={'png' : 1})
+    scheduler.started = SimpleQueue()
+    scheduler.worker_pids = {}
+    scheduler.lost_stages = set()
+    dead = subprocess.Popen(['true'])
+    dead.wait()
+    scheduler.running = {}
+    for task_id, pid in [(1, os.getpid()), (2, dead.pid), (3, dead.pid)]:
+        task = scheduler.make_task('{}_c0m.fits'.format(task_id), 'png')
+        task['task_id'] = task_id
+        if task_id != 3:
+            scheduler.running[task_id] = task
+        scheduler.started.put((task_id, pid))
+    lost = scheduler.find_lost_tasks()
+    assert scheduler.started.empty(), 'Expected every report to be read.'
+    assert [task['task_id'] for task in lost] == [2], \
+        'Unexpected lost tasks ' + str(lost)
+    assert lost[0]['status'] == 'failed', 'Expected the task to fail.'
+
+def test_get_stage_cores():
+    '''
+    Test the stages missing from stage_cores share num_cores.
+    '''
+    settings = dict(SETTINGS)
+    SETTINGS.update({'num_cores' : 8, 'stage_cores' : {'drizzle' : 5}})
+    try:
+        stage_cores = stage_scheduler.get_stage_cores()
+    finally:
+        SETTINGS.clear()
+        SETTINGS.update(settings)
+    assert stage_cores == {'cr_reject' : 2, 'drizzle' : 5, 'png' : 2}, \
+        'Unexpected stage_cores ' + str(stage_cores)
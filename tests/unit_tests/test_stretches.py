@@ -0,0 +1,53 @@
+'''
+Nose tests for the stretches.py module.
+'''
+
+from mtpipeline.imaging import stretches
+from mtpipeline.imaging.run_trim import PNGCreator
+
+import numpy as N
+
+class test_apply_stretches(object):
+    '''
+    Test the lookup table stretches against the curves.
+    '''
+    def setup(self):
+        random = N.random.RandomState(0)
+        self.data = random.normal(100.0, 5.0, (400, 300)).astype(N.float32)
+        self.data[50:60, 50:60] = 5000.0
+        self.data[0, 0] = N.nan
+
+    def curve_test(self):
+        '''
+        Test the sqrt stretch is within one level of the exact curve.
+        '''
+        sample = stretches.get_sample(self.data)
+        low, high = stretches.get_percentile_interval(sample)
+        image = stretches.apply_stretches(self.data, ['sqrt'], flip=False,
+                                          sample=sample)[0]
+        exact = N.sqrt(N.clip((self.data - low) / (high - low), 0, 1)) * 255.
+        finite = N.isfinite(self.data)
+        assert N.abs(image[finite] - exact[finite]).max() <= 4, \
+            'The sqrt stretch is off by {}.'.format(
+                N.abs(image[finite] - exact[finite]).max())
+        assert image[0, 0] == 0, 'Expected NaN to be black.'
+        assert (image[50:60, 50:60] == 255).all(), 'Expected white sources.'
+
+    def zscale_test(self):
+        '''
+        Test the zscale limits bracket the sky and leave out the sources.
+        '''
+        low, high = stretches.get_zscale_limits(
+            stretches.get_sample(self.data))
+        assert 60.0 < low < 100.0 < high < 140.0, \
+            'Wrong zscale limits {0} {1}'.format(low, high)
+
+    def flip_test(self):
+        '''
+        Test PNGCreator.stretch and the flipped images agree.
+        '''
+        pngc = PNGCreator(self.data)
+        pngc.stretch('asinh')
+        flipped = stretches.apply_stretches(self.data, ['asinh'])[0]
+        assert pngc.data.dtype == N.uint8, 'Expected a uint8 image.'
+        assert (flipped == pngc.data[::-1]).all(), 'Wrong flip.'
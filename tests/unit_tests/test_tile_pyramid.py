@@ -0,0 +1,84 @@
+'''
+Nose tests for the tile_pyramid.py module.
+'''
+
+import os
+import shutil
+import tempfile
+
+from PIL import Image
+
+from mtpipeline.imaging import tile_pyramid
+from mtpipeline.imaging.run_trim import make_tile_pngs
+
+import numpy as N
+
+class test_downsample(object):
+    '''
+    Test the 2x2 block average.
+    '''
+    def odd_test(self):
+        '''
+        Test the rounding and the odd last row and column.
+        '''
+        image = N.array([[0, 1, 10],
+                         [2, 2, 20],
+                         [255, 255, 7]], dtype=N.uint8)
+        result = tile_pyramid.downsample(image)
+        assert result.tolist() == [[1, 15], [255, 7]], \
+            'Wrong block average {}'.format(result.tolist())
+
+class test_iter_tiles(object):
+    '''
+    Test the tiles of every level cover their level image.
+    '''
+    def cover_test(self):
+        '''
+        Test the levels and the tile areas of a 130 x 70 image.
+        '''
+        image = N.random.RandomState(0).randint(
+            0, 256, (130, 70)).astype(N.uint8)
+        records = [record for record, tile in
+                   tile_pyramid.iter_tiles(image, tile_size=32)]
+        levels = sorted(set(record['scale_level'] for record in records))
+        assert levels == [0, 1, 2, 3], 'Wrong levels {}'.format(levels)
+        for level, shape in [(0, (130, 70)), (1, (65, 35)), (3, (17, 9))]:
+            area = sum(record['width'] * record['height'] for record in records
+                       if record['scale_level'] == level)
+            assert area == shape[0] * shape[1], \
+                'Level {0} tiles cover {1} pixels.'.format(level, area)
+        assert len([record for record in records
+                    if record['scale_level'] == 0]) == 5 * 3, \
+            'Expected a 5 x 3 grid at level 0.'
+
+class test_make_tile_pngs(object):
+    '''
+    Test the tile PNGs and their manifest.
+    '''
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.path)
+
+    def manifest_test(self):
+        '''
+        Test the manifest describes the tiles written, 256 pixels each.
+        '''
+        image = N.arange(300 * 200, dtype=N.uint32).reshape((300, 200))
+        image = (image % 251).astype(N.uint8)
+        make_tile_pngs(image, self.path, 'u2mi0102t_wide_single_sci.fits',
+                       'linscale')
+        manifest = tile_pyramid.read_manifest(os.path.join(
+            self.path, 'u2mi0102t_wide_single_sci-linscale_tiles.json'))
+        assert manifest['fits_file'] == 'u2mi0102t_wide_single_sci.fits', \
+            'Wrong fits_file {}'.format(manifest['fits_file'])
+        assert manifest['levels'] == 2, 'Expected 2 levels.'
+        assert len(manifest['tiles']) == 2 + 1, \
+            'Expected 3 tiles, got {}'.format(len(manifest['tiles']))
+        tile = manifest['tiles'][1]
+        png = N.asarray(Image.open(os.path.join(manifest['tile_location'],
+                                                tile['name'])))
+        assert (png == image[tile['y']:tile['y'] + tile['height'],
+                             tile['x']:tile['x'] + tile['width']]).all(), \
+            'The tile PNG differs from the image.'
@@ -0,0 +1,87 @@
+'''
+Nose tests for the wcs_cache.py module.
+'''
+
+import os
+import shutil
+import tempfile
+
+from astropy.io import fits
+from mtpipeline.imaging import wcs_cache
+
+import numpy as N
+
+class FakeUpdatewcs(object):
+    '''
+    Stands in for stwcs.updatewcs and counts the calls.
+    '''
+    def __init__(self):
+        self.calls = []
+
+    def updatewcs(self, filename):
+        self.calls.append(filename)
+        with fits.open(filename, mode='update') as hdulist:
+            del hdulist[0].header['OLDWCS']
+            hdulist[0].header['UPWCSVER'] = ('1.0', 'Version of STWCS')
+            for hdu in hdulist[1:]:
+                hdu.header['CD1_1'] = (-1e-5, 'partial of RA')
+                hdu.header['WCSNAME'] = 'IDC_abc'
+            table = fits.BinTableHDU.from_columns(
+                [fits.Column(name='WCS_ID', format='24A', array=['IDC_abc'])],
+                name='WCSCORR')
+            hdulist.append(table)
+
+class test_update_wcs(object):
+    '''
+    Test a second file of an exposure gets the cached solution.
+    '''
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+        self.files = []
+        for name, scale in [('u2mi0102t_c0m.fits', 1.0),
+                            ('hlsp_u2mi0102t_cr_c0m.fits', 0.5)]:
+            primary = fits.PrimaryHDU()
+            primary.header['ROOTNAME'] = 'U2MI0102T'
+            primary.header['OLDWCS'] = 'yes'
+            chips = [fits.ImageHDU(N.ones((4, 4), dtype=N.float32) * scale,
+                                   name='SCI') for i in range(2)]
+            filename = os.path.join(self.path, name)
+            fits.HDUList([primary] + chips).writeto(filename)
+            self.files.append(filename)
+        self.fake = FakeUpdatewcs()
+        self.updatewcs = wcs_cache.updatewcs
+        wcs_cache.updatewcs = self.fake
+        wcs_cache._CACHE.clear()
+
+    def teardown(self):
+        wcs_cache.updatewcs = self.updatewcs
+        wcs_cache._CACHE.clear()
+        shutil.rmtree(self.path)
+
+    def reuse_test(self):
+        '''
+        Test updatewcs runs once and both files end up the same.
+        '''
+        for filename in self.files:
+            wcs_cache.update_wcs(filename)
+        assert self.fake.calls == [self.files[0]], \
+            'Expected one updatewcs call, got {}'.format(self.fake.calls)
+        raw, derived = [fits.open(filename) for filename in self.files]
+        assert [hdu.name for hdu in derived] == \
+            ['PRIMARY', 'SCI', 'SCI', 'WCSCORR'], 'Wrong extensions.'
+        assert 'OLDWCS' not in derived[0].header, 'Expected OLDWCS removed.'
+        assert derived[0].header['UPWCSVER'] == '1.0', 'Missing UPWCSVER.'
+        assert derived[2].header['CD1_1'] == raw[2].header['CD1_1'], \
+            'Wrong CD1_1.'
+        assert (derived[1].data == 0.5).all(), 'Data was changed.'
+        raw.close()
+        derived.close()
+
+    def rerun_test(self):
+        '''
+        Test the WCS extensions are replaced, not duplicated.
+        '''
+        for filename in self.files + self.files[1:]:
+            wcs_cache.update_wcs(filename)
+        names = [hdu.name for hdu in fits.open(self.files[1])]
+        assert names.count('WCSCORR') == 1, 'Expected one WCSCORR.'